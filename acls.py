@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012, RMIT eResearch Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2012, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+"""
+Ownership of ingested experiments.
+
+.. moduleauthor::  Ian Thomas <ianedwardthomas@gmail.com>
+
+"""
+
+import logging
+from tardis.tardis_portal.models import ExperimentACL
+from tardis.tardis_portal.auth.localdb_auth import django_user
+
+logger = logging.getLogger(__name__)
+
+
+def add_owner_acls(exp_id, user_ids):
+    """
+    Adds an owner ACL on experiment exp_id for each of user_ids without
+    one, with one query for the existing ACLs and one insert.  Returns
+    the number added.
+    """
+    existing = set(ExperimentACL.objects.filter(experiment__id=exp_id,
+        pluginId=django_user, isOwner=True)
+        .values_list('entityId', flat=True))
+    acls = []
+    for user_id in user_ids:
+        entity_id = str(user_id)
+        if entity_id in existing:
+            continue
+        existing.add(entity_id)
+        acls.append(ExperimentACL(experiment_id=exp_id,
+                                  pluginId=django_user,
+                                  entityId=entity_id,
+                                  canRead=True,
+                                  canWrite=True,
+                                  canDelete=True,
+                                  isOwner=True,
+                                  aclOwnershipType=ExperimentACL.OWNER_OWNED))
+    if acls:
+        ExperimentACL.objects.bulk_create(acls)
+    return len(acls)
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012, RMIT eResearch Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2012, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+"""
+Bounded caches of data fetched from sources.
+
+.. moduleauthor::  Ian Thomas <ianedwardthomas@gmail.com>
+
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.utils.hashcompat import md5_constructor as md5
+
+logger = logging.getLogger(__name__)
+
+
+class _Stats(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+
+class TTLCache(object):
+    """
+    Process-local, thread-safe cache of at most maxsize entries, each
+    expiring ttl seconds after it is set.  When full, the least recently
+    used entry is evicted.
+    """
+
+    def __init__(self, maxsize=1024, ttl=600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+        self._stats = _Stats()
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None and entry[0] > now:
+                # re-insert as most recently used
+                self._data[key] = entry
+                value = entry[1]
+            else:
+                value = None
+        self._stats.count(value is not None)
+        if value is None:
+            return default
+        return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + self.ttl, value)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        """
+        Returns a dict of hits, misses and current size
+        """
+        stats = self._stats.stats()
+        stats['size'] = len(self)
+        return stats
+
+
+class SharedCache(object):
+    """
+    Cache with the interface of :py:class:`TTLCache`, stored in the django
+    cache so that it is shared by all workers.  Eviction is left to the
+    django cache backend.
+    """
+
+    def __init__(self, name, ttl=600):
+        self.name = name
+        self.ttl = ttl
+        self._stats = _Stats()
+
+    def _key(self, key):
+        return "reposconsumer-%s-%s" % (self.name,
+                                        md5(repr(key)).hexdigest())
+
+    def get(self, key, default=None):
+        from django.core.cache import cache
+        value = cache.get(self._key(key))
+        self._stats.count(value is not None)
+        if value is None:
+            return default
+        return value
+
+    def set(self, key, value):
+        from django.core.cache import cache
+        cache.set(self._key(key), value, self.ttl)
+
+    def delete(self, key):
+        from django.core.cache import cache
+        cache.delete(self._key(key))
+
+    def clear(self):
+        # entries are left to expire in the django cache
+        pass
+
+    def stats(self):
+        return self._stats.stats()
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(name, maxsize=1024, ttl=600):
+    """
+    Returns the cache called name, created on first use.
+
+    The defaults may be overridden with settings.REPOS_CONSUMER_CACHES, a
+    dict of name -> dict of 'maxsize', 'ttl' and 'shared'.  A shared
+    cache is kept in the django cache rather than in the process.
+    """
+    with _caches_lock:
+        if name not in _caches:
+            options = getattr(settings, 'REPOS_CONSUMER_CACHES', {}) \
+                .get(name, {})
+            ttl = options.get('ttl', ttl)
+            if options.get('shared', False):
+                _caches[name] = SharedCache(name, ttl=ttl)
+            else:
+                _caches[name] = TTLCache(
+                    maxsize=options.get('maxsize', maxsize), ttl=ttl)
+        return _caches[name]
+
+
+def cache_stats():
+    """
+    Returns a dict of cache name -> hit/miss statistics
+    """
+    with _caches_lock:
+        caches = dict(_caches)
+    return dict((name, c.stats()) for name, c in caches.items())
+
+
+def clear_caches():
+    """
+    Empties every process-local cache
+    """
+    with _caches_lock:
+        caches = list(_caches.values())
+    for c in caches:
+        c.clear()
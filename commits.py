@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012, RMIT eResearch Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2012, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+"""
+Committing ingested experiments, each as one atomic unit.
+
+.. moduleauthor::  Ian Thomas <ianedwardthomas@gmail.com>
+
+"""
+
+import logging
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import connection, transaction
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_COMMIT_BATCH = 1
+
+
+class CommitBatch(object):
+    """
+    The transaction in which experiments are ingested, each as a unit
+    (see :py:meth:`unit`) that is committed or rolled back as a whole.
+
+    Units are committed size to a transaction, by default
+    settings.REPOS_CONSUMER_COMMIT_BATCH.  With more than one to a
+    transaction, each unit is run in a savepoint, so a failed unit is
+    rolled back alone.  Databases without savepoints commit each unit on
+    its own, as rolling back a failed unit would take the uncommitted
+    units with it, but not what their ingests had recorded outside the
+    database.  Other writes made while the batch is entered are committed
+    with the units, and changes outside the database are made only once
+    they are (see :py:meth:`on_commit`).  Given a
+    :py:class:`~tardis.apps.reposconsumer.metrics.Run`, commits are timed
+    in it as the commit stage.
+    """
+
+    def __init__(self, size=None, run=None):
+        self.size = size or getattr(settings, 'REPOS_CONSUMER_COMMIT_BATCH',
+                                    DEFAULT_COMMIT_BATCH)
+        if self.size > 1 and not connection.features.uses_savepoints:
+            logger.debug("no savepoints, so committing units one at a time")
+            self.size = 1
+        self.run = run
+        self.pending = 0
+        self._locks = []
+        self._actions = []
+
+    def __enter__(self):
+        transaction.enter_transaction_management()
+        transaction.managed(True)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            try:
+                self.commit()
+            except Exception:
+                transaction.rollback()
+                self._undo()
+                if exc_type is None:
+                    raise
+                logger.exception("cannot commit ingested experiments")
+        finally:
+            self._release_locks()
+            transaction.leave_transaction_management()
+
+    @contextmanager
+    def unit(self):
+        """
+        Runs the enclosed block as one unit, committed with its batch, or
+        rolled back if it fails
+        """
+        if self.size > 1:
+            sid = transaction.savepoint()
+        else:
+            # so a failed unit rolls back nothing but itself
+            self.commit()
+            sid = None
+        first_action = len(self._actions)
+        try:
+            yield
+        except:
+            if sid is not None:
+                transaction.savepoint_rollback(sid)
+            else:
+                transaction.rollback()
+            self._undo(first_action)
+            raise
+        if sid is not None:
+            transaction.savepoint_commit(sid)
+        self.pending += 1
+        if self.pending >= self.size:
+            self.commit()
+
+    def commit(self):
+        """
+        Commits the units and other writes made so far, calls the actions
+        waiting on them and releases the locks held for them
+        """
+        if transaction.is_dirty():
+            if self.run is None:
+                transaction.commit()
+            else:
+                with self.run.stage('commit'):
+                    transaction.commit()
+        self.pending = 0
+        actions, self._actions = self._actions, []
+        for action, undo in actions:
+            try:
+                action()
+            except Exception:
+                # committed regardless, so carry on with the rest
+                logger.exception("cannot complete a committed ingest")
+        self._release_locks()
+
+    def on_commit(self, action, undo=None):
+        """
+        Calls action once the writes made so far are committed, such as
+        moving files into place for them.  If they are rolled back instead,
+        undo is called, if given, and action never is.
+        """
+        self._actions.append((action, undo))
+
+    def _undo(self, first=0):
+        actions = self._actions[first:]
+        del self._actions[first:]
+        for action, undo in reversed(actions):
+            if undo is not None:
+                try:
+                    undo()
+                except Exception:
+                    logger.exception("cannot undo a rolled back ingest")
+
+    def release(self, lock):
+        """
+        Releases lock once the units made under it are committed, so other
+        workers cannot ingest the same experiment meanwhile
+        """
+        if self.pending:
+            self._locks.append(lock)
+        else:
+            lock.release()
+
+    def _release_locks(self):
+        locks, self._locks = self._locks, []
+        for lock in locks:
+            lock.release()
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012, RMIT eResearch Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2012, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+"""
+Concurrent fetching of producer requests.
+
+.. moduleauthor::  Ian Thomas <ianedwardthomas@gmail.com>
+
+"""
+
+import logging
+import threading
+from collections import deque
+from Queue import Queue, Empty
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONCURRENCY = 4
+
+
+def get_concurrency(source):
+    """
+    Returns the number of concurrent requests allowed against source.
+
+    Set globally with settings.REPOS_CONSUMER_CONCURRENCY, or per source
+    with settings.REPOS_CONSUMER_SOURCE_CONCURRENCY, a dict of
+    source url -> limit, or with the 'concurrency' option of a source in
+    settings.REPOS_CONSUMER_SOURCES.
+    """
+    per_source = getattr(settings, 'REPOS_CONSUMER_SOURCE_CONCURRENCY', {})
+    if source in per_source:
+        return per_source[source]
+    sources = getattr(settings, 'REPOS_CONSUMER_SOURCES', {})
+    if isinstance(sources, dict) and 'concurrency' in sources.get(source, {}):
+        return sources[source]['concurrency']
+    return getattr(settings, 'REPOS_CONSUMER_CONCURRENCY',
+                   DEFAULT_CONCURRENCY)
+
+
+class FetchResult(object):
+    """
+    The eventual result of a call submitted to a :py:class:`FetchPool`
+    """
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._value = None
+        self._exception = None
+
+    def set_result(self, value):
+        self._value = value
+        self._done.set()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self):
+        """
+        Waits for the call to finish and returns its value, or raises
+        the exception it raised.
+        """
+        self._done.wait()
+        if self._exception is not None:
+            raise self._exception
+        return self._value
+
+
+class FetchPool(object):
+    """
+    Fixed size pool of threads for running blocking producer requests.
+
+    Only network calls should be submitted: database work must stay on
+    the calling thread.  A pool of size 1 or less runs calls inline.
+    """
+
+    def __init__(self, size=DEFAULT_CONCURRENCY):
+        self.size = size
+        self._jobs = Queue()
+        self._threads = []
+        self._closed = False
+
+    def _start(self):
+        for i in range(self.size):
+            t = threading.Thread(target=self._worker,
+                                 name="reposconsumer-fetch-%s" % i)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def _worker(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            result, func, args, kwargs = job
+            try:
+                result.set_result(func(*args, **kwargs))
+            except Exception as e:
+                result.set_exception(e)
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Schedule func(*args, **kwargs) and return its :py:class:`FetchResult`
+        """
+        if self._closed:
+            raise RuntimeError("fetch pool has been shut down")
+        result = FetchResult()
+        if self.size <= 1:
+            try:
+                result.set_result(func(*args, **kwargs))
+            except Exception as e:
+                result.set_exception(e)
+            return result
+        if not self._threads:
+            self._start()
+        self._jobs.put((result, func, args, kwargs))
+        return result
+
+    def shutdown(self):
+        """
+        Drop calls that have not started and stop the worker threads
+        """
+        self._closed = True
+        while True:
+            try:
+                job = self._jobs.get_nowait()
+            except Empty:
+                break
+            job[0].set_exception(RuntimeError("fetch cancelled"))
+        for t in self._threads:
+            self._jobs.put(None)
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+
+def prefetch(items, start, window):
+    """
+    Yields start(item) for each of items, keeping start() called on up to
+    window items beyond the one most recently yielded.
+
+    items is consumed lazily, so at most window + 1 started items are
+    held at any time.
+    """
+    pending = deque()
+    for item in items:
+        pending.append(start(item))
+        if len(pending) > window:
+            yield pending.popleft()
+    while pending:
+        yield pending.popleft()
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012, RMIT eResearch Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2012, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+"""
+Fingerprints of ingested remote experiments.
+
+.. moduleauthor::  Ian Thomas <ianedwardthomas@gmail.com>
+
+"""
+
+import logging
+from django.utils.hashcompat import sha_constructor as sha1
+from tardis.apps.reposconsumer.models import IngestedExperiment
+
+logger = logging.getLogger(__name__)
+
+
+def fingerprint(source, exp_id, key_value, datestamp, mets_digest):
+    """
+    Returns the fingerprint of remote experiment exp_id from source
+    """
+    parts = [source, exp_id, key_value,
+             datestamp.isoformat() if datestamp else '', mets_digest or '']
+    return sha1(u"\n".join(map(unicode, parts)).encode('utf-8')).hexdigest()
+
+
+class FingerprintIndex(object):
+    """
+    The fingerprints of the experiments ingested from source, loaded with
+    one query.  If exp_ids is given, only those experiments are loaded.
+    """
+
+    def __init__(self, source, exp_ids=None):
+        self.source = source
+        ingested = IngestedExperiment.objects.filter(source=source)
+        if exp_ids is not None:
+            ingested = ingested.filter(exp_id__in=exp_ids)
+        self._ingested = dict((i.exp_id, i) for i in ingested)
+
+    def __len__(self):
+        return len(self._ingested)
+
+    def unchanged(self, exp_id, datestamp):
+        """
+        Returns whether experiment exp_id, whose record now has datestamp,
+        was ingested as it is and has not since been found changed
+        """
+        ingested = self._ingested.get(exp_id)
+        if ingested is None or ingested.changed or datestamp is None:
+            return False
+        return ingested.fingerprint == fingerprint(self.source, exp_id,
+            ingested.key_value, datestamp, ingested.mets_digest)
+
+    def get(self, exp_id):
+        """
+        Returns the :py:class:`IngestedExperiment` of exp_id, or None
+        """
+        return self._ingested.get(exp_id)
+
+    def record(self, exp_id, local_id, key_value, datestamp,
+               mets_digest=None):
+        """
+        Records that exp_id, with key_value and whose record has datestamp,
+        is ingested as local experiment local_id
+        """
+        ingested = self._ingested.get(exp_id)
+        if ingested is None:
+            ingested = IngestedExperiment(source=self.source, exp_id=exp_id)
+        ingested.experiment_id = local_id
+        ingested.key_value = key_value
+        ingested.datestamp = datestamp
+        ingested.mets_digest = mets_digest or ''
+        ingested.fingerprint = fingerprint(self.source, exp_id, key_value,
+                                           datestamp, mets_digest)
+        ingested.changed = False
+        ingested.save()
+        self._ingested[exp_id] = ingested
+
+    def mark_changed(self, exp_id):
+        """
+        Flags the local copy of exp_id as needing an update
+        """
+        ingested = self._ingested.get(exp_id)
+        if ingested is not None and not ingested.changed:
+            logger.info("experiment %s from %s has changed"
+                        % (exp_id, self.source))
+            ingested.changed = True
+            ingested.save()
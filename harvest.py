@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012, RMIT eResearch Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2012, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+"""
+Incremental OAI-PMH harvesting of source experiment listings.
+
+.. moduleauthor::  Ian Thomas <ianedwardthomas@gmail.com>
+
+"""
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def complete_harvest(state, started):
+    """
+    Records in state that the harvest started at started has been
+    processed, so the next harvest requests records from then on
+    """
+    state.resumption_token = ''
+    if started and (not state.last_datestamp
+                    or started > state.last_datestamp):
+        state.last_datestamp = started
+    state.harvest_started = None
+    state.save()
+
+
+class PageEnd(object):
+    """
+    Marks the end of a ListRecords page in a stream of records.
+
+    :attribute token: the resumption token of the following page, or None
+        if this was the last page
+    :attribute response_date: the responseDate of the page
+    """
+
+    def __init__(self, token, response_date):
+        self.token = token
+        self.response_date = response_date
+
+
+def _response_date(client, tree):
+    from lxml import etree
+    from oaipmh.datestamp import datestamp_to_datetime
+    evaluator = etree.XPathEvaluator(tree, namespaces=client.getNamespaces())
+    datestamp = evaluator.evaluate(
+        'string(/oai:OAI-PMH/oai:responseDate/text())')
+    if not datestamp:
+        return None
+    return datestamp_to_datetime(datestamp)
+
+
+class Harvest(object):
+    """
+    A ListRecords harvest of a source, resumable across runs through its
+    :py:class:`~tardis.apps.reposconsumer.models.HarvestState`.
+
+    Records are requested from the state's high-water mark, or from its
+    resumption token if the previous harvest did not complete.  The number
+    of records listed so far is kept in records_seen.  Given a
+    :py:class:`~tardis.apps.reposconsumer.metrics.Run`, each request is
+    timed in it as the list_records stage.
+    """
+
+    def __init__(self, client, registry, state, metadata_prefix='oai_dc',
+                 run=None):
+        self.client = client
+        self.registry = registry
+        self.state = state
+        self.metadata_prefix = metadata_prefix
+        self.run = run
+        self.records_seen = 0
+
+    def _request(self, **args):
+        if self.run is None:
+            tree = self.client.makeRequestErrorHandling(verb='ListRecords',
+                                                        **args)
+        else:
+            with self.run.stage('list_records'):
+                tree = self.client.makeRequestErrorHandling(
+                    verb='ListRecords', **args)
+        records, token = self.client.buildRecords(self.metadata_prefix,
+            self.client.getNamespaces(), self.registry, tree)
+        return records, token, _response_date(self.client, tree)
+
+    def _first_page(self):
+        from oaipmh import error
+        from oaipmh.datestamp import datetime_to_datestamp
+        if self.state.resumption_token:
+            try:
+                logger.info("resuming harvest of %s" % self.state.source)
+                return self._request(
+                    resumptionToken=self.state.resumption_token)
+            except error.BadResumptionTokenError:
+                logger.warn("resumption token for %s expired, restarting"
+                            % self.state.source)
+                self.state.resumption_token = ''
+                self.state.harvest_started = None
+                self.state.save()
+        args = {'metadataPrefix': self.metadata_prefix}
+        if self.state.last_datestamp:
+            args['from'] = datetime_to_datestamp(self.state.last_datestamp)
+        return self._request(**args)
+
+    def records(self, pool=None):
+        """
+        Yields the (header, metadata, about) records of the harvest,
+        followed by a :py:class:`PageEnd` after each page.  Deleted
+        records are skipped.
+
+        Pages are requested as the records are consumed.  If a
+        :py:class:`~tardis.apps.reposconsumer.fetch.FetchPool` is given, the
+        following page is requested on it while a page is being consumed,
+        so at most two pages are held at once.
+        """
+        records, token, response_date = self._first_page()
+        if not self.state.harvest_started:
+            self.state.harvest_started = response_date
+        while True:
+            next_page = None
+            if token and pool is not None:
+                next_page = pool.submit(self._request, resumptionToken=token)
+            for record in records:
+                header, metadata, about = record
+                if header.isDeleted() or metadata is None:
+                    continue
+                self.records_seen += 1
+                yield record
+            yield PageEnd(token, response_date)
+            if not token:
+                return
+            if next_page is not None:
+                records, token, response_date = next_page.result()
+            else:
+                records, token, response_date = self._request(
+                    resumptionToken=token)
+
+    def page_done(self, page_end):
+        """
+        Records that all records up to page_end have been processed
+        """
+        if page_end.token:
+            self.state.resumption_token = page_end.token
+            self.state.save()
+        else:
+            complete_harvest(self.state, self.state.harvest_started)
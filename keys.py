@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012, RMIT eResearch Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2012, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+"""
+Lookup of local experiments by their experiment key.
+
+.. moduleauthor::  Ian Thomas <ianedwardthomas@gmail.com>
+
+"""
+
+import logging
+from tardis.tardis_portal.models import ExperimentParameter
+
+logger = logging.getLogger(__name__)
+
+
+def find_experiment_by_key(key_schema, key_name, key_value):
+    """
+    Returns the id of the local experiment holding key_value, or None.
+
+    Issues a single query, filtered on the (indexed) parameter name
+    foreign key rather than walking every experiment.
+    """
+    ids = ExperimentParameter.objects.filter(name=key_name,
+        parameterset__schema=key_schema,
+        string_value=key_value) \
+        .order_by('parameterset__experiment') \
+        .values_list('parameterset__experiment', flat=True)[:1]
+    if ids:
+        return ids[0]
+    return None
+
+
+class ExperimentKeyIndex(object):
+    """
+    In-memory map of experiment key -> local experiment id.
+
+    Built with one query when first used within a harvest run, and kept
+    in sync with :py:meth:`add` as new experiments are ingested.  If
+    preload is False, each lookup is a single query instead.
+    """
+
+    def __init__(self, key_schema, key_name, preload=True):
+        self.key_schema = key_schema
+        self.key_name = key_name
+        self.preload = preload
+        self._keys = None
+
+    def _load(self):
+        params = ExperimentParameter.objects.filter(name=self.key_name,
+            parameterset__schema=self.key_schema) \
+            .order_by('parameterset__experiment') \
+            .values_list('string_value', 'parameterset__experiment')
+        self._keys = {}
+        for key_value, exp_id in params:
+            # keep the first experiment for a key, as the old scan did
+            self._keys.setdefault(key_value, exp_id)
+        logger.debug("loaded %s experiment keys" % len(self._keys))
+
+    def lookup(self, key_value, refresh=False):
+        """
+        Returns the id of the local experiment with key_value, or None
+
+        With refresh, a key missing from the preloaded map is checked
+        against the database, so experiments ingested by other workers
+        since the map was loaded are found.
+        """
+        if not self.preload:
+            return find_experiment_by_key(self.key_schema, self.key_name,
+                                          key_value)
+        if self._keys is None:
+            self._load()
+        exp_id = self._keys.get(key_value)
+        if exp_id is None and refresh:
+            exp_id = find_experiment_by_key(self.key_schema, self.key_name,
+                                            key_value)
+            if exp_id is not None:
+                self._keys[key_value] = exp_id
+        return exp_id
+
+    def add(self, key_value, exp_id):
+        """
+        Record a newly created local experiment for key_value
+        """
+        if self._keys is not None:
+            self._keys.setdefault(key_value, exp_id)
+
+    def __len__(self):
+        if self._keys is None:
+            self._load()
+        return len(self._keys)
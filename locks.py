@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012, RMIT eResearch Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2012, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+"""
+Locking of remote experiments while they are ingested.
+
+.. moduleauthor::  Ian Thomas <ianedwardthomas@gmail.com>
+
+"""
+
+import logging
+import os
+import socket
+import threading
+import uuid
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.hashcompat import md5_constructor as md5
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LOCK_EXPIRE = 60 * 5
+
+_stats_lock = threading.Lock()
+_stats = {'acquired': 0, 'contended': 0, 'lost': 0}
+
+
+def _count(counter):
+    with _stats_lock:
+        _stats[counter] += 1
+
+
+def lock_stats():
+    """
+    Returns counts of the experiment locks acquired, the attempts that
+    found the lock already held, and leases lost before release, by this
+    process.
+    """
+    with _stats_lock:
+        return dict(_stats)
+
+
+class ExperimentLock(object):
+    """
+    A lease on ingesting the experiment with key_value from source, held
+    in the django cache.
+
+    While held the lease is renewed every third of its expiry time, so
+    expiry need only cover the renewal interval rather than the whole
+    METS ingest.  A lease whose worker dies lapses after expire seconds,
+    settings.REPOS_CONSUMER_LOCK_EXPIRE by default.
+    """
+
+    def __init__(self, source, key_value, expire=None):
+        self.source = source
+        self.key_value = key_value
+        self.expire = expire or getattr(settings,
+            'REPOS_CONSUMER_LOCK_EXPIRE', DEFAULT_LOCK_EXPIRE)
+        digest = md5("%s|%s" % (source, key_value)).hexdigest()
+        self.lock_id = "consume_experiment-lock-%s" % digest
+        # names the worker holding the lease, for monitoring
+        self.holder = "%s:%s:%s" % (socket.gethostname(), os.getpid(),
+                                    uuid.uuid4().hex)
+        self._stop = threading.Event()
+        self._renewer = None
+        self._detached = False
+
+    def __str__(self):
+        return "experiment %s from %s" % (self.key_value, self.source)
+
+    def holds(self):
+        """
+        Returns True if this lease is still held
+        """
+        return cache.get(self.lock_id) == self.holder
+
+    def is_locked(self):
+        """
+        Returns True if this or another worker holds the lease
+        """
+        return self.held_by() is not None
+
+    def held_by(self):
+        """
+        Returns the host:pid:lease of the worker holding the lease, or None
+        """
+        return cache.get(self.lock_id)
+
+    def acquire(self):
+        """
+        Returns True if the lease was acquired, False if another worker
+        holds it
+        """
+        # cache.add fails if if the key already exists
+        if not cache.add(self.lock_id, self.holder, self.expire):
+            _count('contended')
+            logger.info("%s is locked by another worker" % self)
+            return False
+        _count('acquired')
+        self._stop.clear()
+        self._renewer = threading.Thread(target=self._renew,
+            name="reposconsumer-lock-%s" % self)
+        self._renewer.daemon = True
+        self._renewer.start()
+        return True
+
+    def _renew(self):
+        while not self._stop.wait(self.expire / 3.0):
+            # NOTE: get then set is not atomic, but only the holder renews
+            if not self.holds():
+                _count('lost')
+                logger.error("lost lock on %s" % self)
+                return
+            cache.set(self.lock_id, self.holder, self.expire)
+
+    def _stop_renewing(self):
+        self._stop.set()
+        if self._renewer is not None:
+            self._renewer.join()
+            self._renewer = None
+
+    def release(self):
+        """
+        Stops renewing the lease, and deletes it if it is still ours,
+        unless it has been detached
+        """
+        self._stop_renewing()
+        if not self._detached and self.holds():
+            cache.delete(self.lock_id)
+
+    def detach(self, expire):
+        """
+        Stops renewing the lease and leaves it held for expire seconds,
+        for another task to release with :py:func:`release_lease`.
+        Returns the (lock_id, holder) of the lease, or None if it has
+        already been lost.
+        """
+        self._stop_renewing()
+        if not self.holds():
+            return None
+        cache.set(self.lock_id, self.holder, expire)
+        self._detached = True
+        return self.lock_id, self.holder
+
+
+def release_lease(lock_id, holder):
+    """
+    Releases the lease detached as (lock_id, holder), if it is still held
+    """
+    # NOTE: get then delete is not atomic, but only the holder releases
+    if cache.get(lock_id) == holder:
+        cache.delete(lock_id)
+
+
+class HarvestLock(ExperimentLock):
+    """
+    A lease on harvesting source, so that runs for the same source never
+    overlap.
+    """
+
+    def __init__(self, source, expire=None):
+        ExperimentLock.__init__(self, source, '', expire)
+        self.lock_id = "consume_experiments-lock-%s" \
+            % md5(source).hexdigest()
+
+    def __str__(self):
+        return "harvest of %s" % self.source
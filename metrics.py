@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012, RMIT eResearch Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2012, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+"""
+Timings and counts of harvest runs, sent to a pluggable metrics sink.
+
+.. moduleauthor::  Ian Thomas <ianedwardthomas@gmail.com>
+
+"""
+
+import json
+import logging
+import socket
+import threading
+import time
+import urlparse
+from contextlib import contextmanager
+from datetime import datetime
+from django.conf import settings
+from django.db import connection
+from django.utils.importlib import import_module
+from tardis.apps.reposconsumer.caches import cache_stats
+from tardis.apps.reposconsumer.locks import lock_stats
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RUN_HISTORY = 1000
+
+# the counters of a run, as fields of HarvestRun
+COUNTERS = ('records', 'ingested', 'updated', 'unchanged', 'duplicates',
+            'skipped', 'failed', 'bytes_received', 'bytes_decoded',
+            'locks_acquired', 'locks_contended', 'locks_lost')
+
+
+class MetricsSink(object):
+    """
+    Receives the metrics of harvest runs, discarding them.  Subclasses
+    send them elsewhere.
+    """
+
+    def timing(self, name, seconds):
+        pass
+
+    def incr(self, name, count=1):
+        pass
+
+    def summary(self, name, summary):
+        """
+        Receives the summary dict of a finished run
+        """
+        pass
+
+
+class MemorySink(MetricsSink):
+    """
+    Keeps every metric in memory, e.g. for tests
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.timings = {}
+        self.counters = {}
+        self.summaries = []
+
+    def timing(self, name, seconds):
+        with self._lock:
+            self.timings.setdefault(name, []).append(seconds)
+
+    def incr(self, name, count=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + count
+
+    def summary(self, name, summary):
+        with self._lock:
+            self.summaries.append((name, summary))
+
+
+class StatsdSink(MetricsSink):
+    """
+    Sends metrics to a statsd server over UDP, named
+    prefix.<source host>.<metric>.  The counts of a run summary are sent
+    as gauges.
+    """
+
+    def __init__(self, host='127.0.0.1', port=8125, prefix='reposconsumer'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _send(self, data):
+        try:
+            self._socket.sendto(data, self.address)
+        except socket.error as e:
+            # metrics are never worth failing a harvest over
+            logger.debug("cannot send metrics: %s" % e)
+
+    def timing(self, name, seconds):
+        self._send("%s.%s:%d|ms" % (self.prefix, name, seconds * 1000))
+
+    def incr(self, name, count=1):
+        self._send("%s.%s:%d|c" % (self.prefix, name, count))
+
+    def summary(self, name, summary):
+        for counter in COUNTERS + ('duration', 'queries'):
+            if summary.get(counter) is not None:
+                self._send("%s.%s.last_%s:%s|g" % (self.prefix, name,
+                                                  counter, summary[counter]))
+
+
+_sink = []
+
+
+def get_sink():
+    """
+    Returns the metrics sink of this process, configured with
+    settings.REPOS_CONSUMER_METRICS, a dict of 'sink', the dotted path of
+    a :py:class:`MetricsSink` class, and its keyword arguments.
+    """
+    if not _sink:
+        options = dict(getattr(settings, 'REPOS_CONSUMER_METRICS', {}))
+        options.pop('queries', None)
+        path = options.pop('sink', None)
+        if path:
+            module, name = path.rsplit('.', 1)
+            _sink.append(getattr(import_module(module), name)(**options))
+        else:
+            _sink.append(MetricsSink())
+    return _sink[0]
+
+
+def set_sink(sink):
+    """
+    Replaces the metrics sink of this process, or with None, has it
+    configured from settings again
+    """
+    del _sink[:]
+    if sink is not None:
+        _sink.append(sink)
+
+
+def source_name(source):
+    """
+    Returns the name of source in metric names
+    """
+    return urlparse.urlsplit(source).netloc.replace('.', '_') \
+        .replace(':', '_')
+
+
+def percentile(values, fraction):
+    """
+    Returns the value at fraction (0..1) of the sorted values
+    """
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+class Run(object):
+    """
+    The timings and counts of one harvest run of source.
+
+    Stages may be timed from several threads.  Database queries are only
+    counted with settings.REPOS_CONSUMER_METRICS['queries'], as that logs
+    every query for the length of a stage.
+    """
+
+    def __init__(self, source, sink=None, count_queries=None):
+        self.source = source
+        self.name = source_name(source)
+        self.sink = sink or get_sink()
+        if count_queries is None:
+            count_queries = getattr(settings, 'REPOS_CONSUMER_METRICS',
+                                    {}).get('queries', False)
+        self.count_queries = count_queries
+        self.queries = 0 if count_queries else None
+        self.started = datetime.now()
+        self._started = time.time()
+        self._lock = threading.Lock()
+        self.timings = {}
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self._host = urlparse.urlsplit(source).netloc
+        self._bytes = self._host_stats()
+        self._caches = cache_stats()
+        self._locks = lock_stats()
+
+    def _host_stats(self):
+        from tardis.apps.reposconsumer.transport import get_session
+        stats = get_session().host_stats().get(self._host, {})
+        return dict((counter, stats.get(counter, 0))
+                    for counter in ('bytes_received', 'bytes_decoded'))
+
+    @contextmanager
+    def stage(self, stage):
+        """
+        Times the enclosed block as stage, counting its queries if asked
+        to and on the task thread.  Queries of nested stages are counted
+        by the outermost.
+        """
+        started = time.time()
+        counting = self.count_queries and not connection.use_debug_cursor
+        if counting:
+            connection.use_debug_cursor = True
+            first = len(connection.queries)
+        try:
+            yield
+        finally:
+            self.time(stage, time.time() - started)
+            if counting:
+                with self._lock:
+                    self.queries += len(connection.queries) - first
+                # forget them, so they do not pile up over the run
+                del connection.queries[first:]
+                connection.use_debug_cursor = False
+
+    def time(self, stage, seconds):
+        with self._lock:
+            self.timings.setdefault(stage, []).append(seconds)
+        self.sink.timing("%s.%s" % (self.name, stage), seconds)
+
+    def incr(self, counter, count=1):
+        with self._lock:
+            self.counters[counter] += count
+        self.sink.incr("%s.%s" % (self.name, counter), count)
+
+    def stage_summary(self):
+        """
+        Returns a dict of stage -> dict of 'count', 'total', 'p50', 'p99'
+        and 'max' seconds
+        """
+        with self._lock:
+            timings = dict((stage, list(values))
+                           for stage, values in self.timings.items())
+        return dict((stage, {'count': len(values),
+                             'total': sum(values),
+                             'p50': percentile(values, 0.5),
+                             'p99': percentile(values, 0.99),
+                             'max': max(values)})
+                    for stage, values in timings.items())
+
+    def cache_summary(self):
+        """
+        Returns a dict of cache -> dict of the 'hits' and 'misses' of this
+        process since the run started
+        """
+        summary = {}
+        for name, stats in cache_stats().items():
+            before = self._caches.get(name, {})
+            summary[name] = dict((counter,
+                                  stats[counter] - before.get(counter, 0))
+                                 for counter in ('hits', 'misses'))
+        return summary
+
+    def finish(self, error=None):
+        """
+        Records the summary of the run as a
+        :py:class:`~tardis.apps.reposconsumer.models.HarvestRun`, with the
+        backlog and high-water mark of the source as they are now, sends
+        it to the sink and returns it.  Only the last
+        settings.REPOS_CONSUMER_RUN_HISTORY runs of the source are kept.
+        """
+        from tardis.apps.reposconsumer.models import HarvestRun, \
+            HarvestState, SkippedExperiment
+        for counter, count in self._host_stats().items():
+            self.counters[counter] = count - self._bytes[counter]
+        for counter, count in lock_stats().items():
+            self.counters['locks_' + counter] = count - self._locks[counter]
+        high_water_mark = None
+        for state in HarvestState.objects.filter(source=self.source):
+            high_water_mark = state.last_datestamp
+        summary = HarvestRun(source=self.source, started=self.started,
+            duration=time.time() - self._started,
+            queries=self.queries,
+            backlog=SkippedExperiment.objects.filter(
+                source=self.source).count(),
+            high_water_mark=high_water_mark,
+            stages=json.dumps(self.stage_summary()),
+            caches=json.dumps(self.cache_summary()),
+            error=error or '', **self.counters)
+        summary.save()
+        prune_runs(self.source)
+        values = dict(self.counters, duration=summary.duration,
+                      queries=self.queries)
+        self.sink.summary(self.name, values)
+        logger.info("harvest of %s: %s" % (self.source, ", ".join(
+            "%s %s" % (name, values[name]) for name in sorted(values)
+            if values[name] is not None)))
+        return summary
+
+
+def prune_runs(source):
+    """
+    Deletes all but the last settings.REPOS_CONSUMER_RUN_HISTORY
+    :py:class:`~tardis.apps.reposconsumer.models.HarvestRun` rows of
+    source.  A history of 0 keeps them all.
+    """
+    from tardis.apps.reposconsumer.models import HarvestRun
+    history = getattr(settings, 'REPOS_CONSUMER_RUN_HISTORY',
+                      DEFAULT_RUN_HISTORY)
+    if not history:
+        return
+    runs = HarvestRun.objects.filter(source=source)
+    newest_dropped = runs.order_by('-pk').values_list('pk',
+        flat=True)[history:history + 1]
+    if newest_dropped:
+        runs.filter(pk__lte=newest_dropped[0]).delete()
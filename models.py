@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012, RMIT eResearch Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2012, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+"""
+
+.. moduleauthor::  Ian Thomas <ianedwardthomas@gmail.com>
+
+"""
+
+import uuid
+from django.core.cache import cache
+from django.db import models
+from django.db.models.signals import post_save, post_delete
+from tardis.tardis_portal.models import Schema, ParameterName
+
+
+class HarvestState(models.Model):
+    """
+    Progress of incremental harvesting from a source.
+
+    :attribute source: the source url, as passed to the consume task
+    :attribute last_datestamp: the OAI-PMH responseDate at the start of the
+        last complete harvest, used as the from argument of the next
+    :attribute resumption_token: token for the next page of an
+        unfinished harvest, or empty
+    :attribute harvest_started: the responseDate at the start of an
+        unfinished harvest
+    """
+    source = models.CharField(max_length=400, unique=True)
+    last_datestamp = models.DateTimeField(null=True, blank=True)
+    resumption_token = models.TextField(blank=True)
+    harvest_started = models.DateTimeField(null=True, blank=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __unicode__(self):
+        return self.source
+
+
+class SkippedExperiment(models.Model):
+    """
+    A remote experiment that could not be ingested, and is left alone
+    until its record changes or it is due to be checked again.
+
+    :attribute source: the source url, as passed to the consume task
+    :attribute exp_id: the id of the experiment at the source
+    :attribute creator_id: the id of its creator at the source
+    :attribute reason: why it could not be ingested, e.g. 'private'
+    :attribute datestamp: the OAI-PMH datestamp of its record when it was
+        skipped
+    :attribute checks: the number of times in a row it has been skipped
+    :attribute recheck_after: when it is next due to be checked again
+    """
+    source = models.CharField(max_length=400)
+    exp_id = models.CharField(max_length=100)
+    creator_id = models.CharField(max_length=100)
+    reason = models.CharField(max_length=100)
+    datestamp = models.DateTimeField(null=True, blank=True)
+    checks = models.IntegerField(default=0)
+    recheck_after = models.DateTimeField()
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = (('source', 'exp_id'),)
+
+    def __unicode__(self):
+        return "%s %s" % (self.source, self.exp_id)
+
+
+class IngestedExperiment(models.Model):
+    """
+    The fingerprint of a remote experiment as it was ingested, so that an
+    unchanged record need not be fetched again.
+
+    :attribute source: the source url, as passed to the consume task
+    :attribute exp_id: the id of the experiment at the source
+    :attribute experiment: the local copy of the experiment
+    :attribute key_value: the experiment key
+    :attribute datestamp: the OAI-PMH datestamp of its record when ingested
+    :attribute mets_digest: the md5 of its METS document when ingested,
+        if known
+    :attribute fingerprint: hash of all of the above
+    :attribute changed: whether the remote experiment has changed since,
+        so the local copy needs updating
+    """
+    source = models.CharField(max_length=400)
+    exp_id = models.CharField(max_length=100)
+    experiment = models.ForeignKey('tardis_portal.Experiment')
+    key_value = models.CharField(max_length=400)
+    datestamp = models.DateTimeField(null=True, blank=True)
+    mets_digest = models.CharField(max_length=32, blank=True)
+    fingerprint = models.CharField(max_length=40)
+    changed = models.BooleanField(default=False)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = (('source', 'exp_id'),)
+
+    def __unicode__(self):
+        return "%s %s" % (self.source, self.exp_id)
+
+
+class SourceSchedule(models.Model):
+    """
+    When a registered source is next harvested, adapted to how often it
+    changes and how long its harvests take.
+
+    :attribute source: the source url, as passed to the consume task
+    :attribute enabled: whether the source is harvested by the scheduler
+    :attribute interval: seconds from one harvest to the next
+    :attribute next_run: when the source is next due, or None if now
+    :attribute last_started: when the last harvest started
+    :attribute last_duration: seconds the last harvest took
+    :attribute last_records: records listed by the last harvest
+    :attribute last_error: the error that ended the last harvest, if any
+    """
+    source = models.CharField(max_length=400, unique=True)
+    enabled = models.BooleanField(default=True)
+    interval = models.FloatField()
+    next_run = models.DateTimeField(null=True, blank=True)
+    last_started = models.DateTimeField(null=True, blank=True)
+    last_duration = models.FloatField(null=True, blank=True)
+    last_records = models.IntegerField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+
+    def __unicode__(self):
+        return self.source
+
+
+class HarvestRun(models.Model):
+    """
+    Summary of a run harvesting a source.
+
+    :attribute source: the source url, as passed to the consume task
+    :attribute started: when the run started
+    :attribute duration: seconds the run took
+    :attribute records: records listed
+    :attribute ingested: new experiments ingested
+    :attribute updated: experiments updated in place
+    :attribute unchanged: records passed over as already ingested
+    :attribute duplicates: records found to be local experiments
+    :attribute skipped: records that could not be ingested yet
+    :attribute failed: records whose ingest failed, ending the run
+    :attribute bytes_received: body bytes received from the source
+    :attribute bytes_decoded: those bytes once decompressed
+    :attribute locks_acquired: experiment locks acquired by the worker
+    :attribute locks_contended: experiment locks found held by another
+    :attribute locks_lost: experiment locks that lapsed before release
+    :attribute queries: database queries, if counted
+    :attribute backlog: skipped experiments of the source left to ingest
+        at the end of the run
+    :attribute high_water_mark: datestamp of the last complete harvest of
+        the source at the end of the run
+    :attribute stages: JSON dict of stage -> count, total, p50, p99 and
+        max seconds
+    :attribute caches: JSON dict of cache -> hits and misses in the run
+    :attribute error: the error that ended the run, if any
+    """
+    source = models.CharField(max_length=400, db_index=True)
+    started = models.DateTimeField()
+    duration = models.FloatField()
+    records = models.IntegerField(default=0)
+    ingested = models.IntegerField(default=0)
+    updated = models.IntegerField(default=0)
+    unchanged = models.IntegerField(default=0)
+    duplicates = models.IntegerField(default=0)
+    skipped = models.IntegerField(default=0)
+    failed = models.IntegerField(default=0)
+    bytes_received = models.BigIntegerField(default=0)
+    bytes_decoded = models.BigIntegerField(default=0)
+    locks_acquired = models.IntegerField(default=0)
+    locks_contended = models.IntegerField(default=0)
+    locks_lost = models.IntegerField(default=0)
+    queries = models.IntegerField(null=True, blank=True)
+    backlog = models.IntegerField(default=0)
+    high_water_mark = models.DateTimeField(null=True, blank=True)
+    stages = models.TextField(blank=True)
+    caches = models.TextField(blank=True)
+    error = models.TextField(blank=True)
+
+    class Meta:
+        ordering = ['-started']
+
+    def __unicode__(self):
+        return "%s %s" % (self.source, self.started)
+
+
+# Bumped in the django cache whenever a Schema or ParameterName changes, so
+# every worker re-resolves the key parameter.  Connected here rather than in
+# tasks, so that changes made in the web process are seen too.
+KEY_PARAMETER_VERSION = "reposconsumer-key-parameter-version"
+
+
+def _key_parameter_changed(sender, **kwargs):
+    cache.set(KEY_PARAMETER_VERSION, uuid.uuid4().hex)
+
+
+for _model in (Schema, ParameterName):
+    post_save.connect(_key_parameter_changed, sender=_model,
+        dispatch_uid="reposconsumer-key-parameter-save-%s" % _model.__name__)
+    post_delete.connect(_key_parameter_changed, sender=_model,
+        dispatch_uid="reposconsumer-key-parameter-delete-%s" % _model.__name__)
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012, RMIT eResearch Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2012, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+"""
+Scheduling harvests of the registered sources.
+
+.. moduleauthor::  Ian Thomas <ianedwardthomas@gmail.com>
+
+"""
+
+import logging
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.hashcompat import md5_constructor as md5
+from tardis.apps.reposconsumer.models import SourceSchedule
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MIN_INTERVAL = 30
+DEFAULT_MAX_INTERVAL = 60 * 60
+DEFAULT_QUEUE_EXPIRE = 60 * 10
+
+
+def get_sources():
+    """
+    Returns the registered sources, settings.REPOS_CONSUMER_SOURCES, as a
+    dict of source url -> dict of options:
+
+    'min_interval', 'max_interval'
+        bounds in seconds on the time between harvests of the source
+    'concurrency'
+        the number of concurrent requests allowed against the source
+    """
+    sources = getattr(settings, 'REPOS_CONSUMER_SOURCES', {})
+    if not isinstance(sources, dict):
+        sources = dict((source, {}) for source in sources)
+    return sources
+
+
+def _options(source):
+    options = get_sources().get(source, {})
+    return (options.get('min_interval', DEFAULT_MIN_INTERVAL),
+            options.get('max_interval', DEFAULT_MAX_INTERVAL))
+
+
+def next_interval(interval, records, duration, min_interval, max_interval):
+    """
+    Returns the seconds until the next harvest of a source, from the
+    current interval and the records and duration of the last harvest.
+
+    The interval halves while records keep changing, and grows by half
+    while they do not, within min_interval and max_interval.  It is never
+    less than twice the last harvest took, so slow sources are not
+    harvested back to back.
+    """
+    if records:
+        interval = interval / 2.0
+    else:
+        interval = interval * 1.5
+    interval = max(min(interval, max_interval), min_interval)
+    return max(interval, 2 * duration)
+
+
+def due_schedules(now=None):
+    """
+    Returns the schedules of the enabled sources due to be harvested,
+    creating those of newly registered sources
+    """
+    now = now or datetime.now()
+    known = set(SourceSchedule.objects.values_list('source', flat=True))
+    for source in get_sources():
+        if source not in known:
+            SourceSchedule.objects.create(source=source,
+                                          interval=_options(source)[0])
+    return [schedule for schedule in SourceSchedule.objects.filter(
+        enabled=True).order_by('next_run')
+        if schedule.next_run is None or schedule.next_run <= now]
+
+
+def _queued_key(source):
+    return "consume_experiments-queued-%s" % md5(source).hexdigest()
+
+
+def mark_queued(source):
+    """
+    Returns True if a harvest of source may be queued, marking it as
+    queued until it starts.  The mark lapses after
+    settings.REPOS_CONSUMER_QUEUE_EXPIRE seconds, in case the queued
+    harvest is lost.
+    """
+    return cache.add(_queued_key(source), 1, getattr(settings,
+        'REPOS_CONSUMER_QUEUE_EXPIRE', DEFAULT_QUEUE_EXPIRE))
+
+
+def clear_queued(source):
+    cache.delete(_queued_key(source))
+
+
+def harvest_queued(schedule, now=None):
+    """
+    Records that a harvest of schedule's source has been queued, so it is
+    not due again until its interval has passed
+    """
+    now = now or datetime.now()
+    schedule.next_run = now + timedelta(seconds=schedule.interval)
+    schedule.save()
+
+
+def harvest_started(source, now=None):
+    SourceSchedule.objects.filter(source=source) \
+        .update(last_started=now or datetime.now())
+
+
+def harvest_done(source, records, duration, error=None, now=None):
+    """
+    Records the outcome of a harvest of source that listed records in
+    duration seconds, and sets when it is next due
+    """
+    now = now or datetime.now()
+    try:
+        schedule = SourceSchedule.objects.get(source=source)
+    except SourceSchedule.DoesNotExist:
+        # not a registered source
+        return
+    min_interval, max_interval = _options(source)
+    schedule.interval = next_interval(schedule.interval, records, duration,
+                                      min_interval, max_interval)
+    schedule.next_run = now + timedelta(seconds=schedule.interval)
+    schedule.last_duration = duration
+    schedule.last_records = records
+    schedule.last_error = error or ''
+    schedule.save()
+    logger.debug("next harvest of %s in %.0fs" % (source, schedule.interval))
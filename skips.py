@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012, RMIT eResearch Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2012, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+"""
+Remembering remote experiments that could not be ingested.
+
+.. moduleauthor::  Ian Thomas <ianedwardthomas@gmail.com>
+
+"""
+
+import logging
+from datetime import datetime, timedelta
+from django.conf import settings
+from tardis.apps.reposconsumer.models import SkippedExperiment
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RECHECK_MIN = 60
+DEFAULT_RECHECK_MAX = 60 * 60 * 24
+
+
+def recheck_interval(checks):
+    """
+    Returns the seconds to wait before checking again an experiment that
+    has been skipped checks times in a row, doubling from
+    settings.REPOS_CONSUMER_RECHECK_MIN up to
+    settings.REPOS_CONSUMER_RECHECK_MAX.
+    """
+    least = getattr(settings, 'REPOS_CONSUMER_RECHECK_MIN',
+                    DEFAULT_RECHECK_MIN)
+    most = getattr(settings, 'REPOS_CONSUMER_RECHECK_MAX',
+                   DEFAULT_RECHECK_MAX)
+    return min(least * 2 ** max(checks - 1, 0), most)
+
+
+class SkipList(object):
+    """
+    The skipped experiments of source, loaded with one query.
+
+    An experiment is skipped until its record's datestamp changes, or
+    until it is due to be checked again.  If exp_ids is given, only
+    those experiments are loaded.
+    """
+
+    def __init__(self, source, exp_ids=None):
+        self.source = source
+        skipped = SkippedExperiment.objects.filter(source=source)
+        if exp_ids is not None:
+            skipped = skipped.filter(exp_id__in=exp_ids)
+        self._skipped = dict((s.exp_id, s) for s in skipped)
+
+    def __len__(self):
+        return len(self._skipped)
+
+    def skips(self, exp_id, datestamp, now=None):
+        """
+        Returns whether the experiment exp_id, whose record has datestamp,
+        should be left alone for now
+        """
+        skipped = self._skipped.get(exp_id)
+        if skipped is None or skipped.datestamp != datestamp:
+            return False
+        return (now or datetime.now()) < skipped.recheck_after
+
+    def due(self, now=None):
+        """
+        Yields the (exp_id, creator_id, datestamp) of the skipped
+        experiments that are due to be checked again.  Experiments
+        skipped or cleared while this is consumed are not yielded.
+        """
+        now = now or datetime.now()
+        for exp_id in sorted(self._skipped.keys()):
+            skipped = self._skipped.get(exp_id)
+            if skipped is not None and skipped.recheck_after <= now:
+                yield skipped.exp_id, skipped.creator_id, skipped.datestamp
+
+    def skip(self, exp_id, creator_id, datestamp, reason, now=None):
+        """
+        Records that the experiment exp_id, whose record has datestamp,
+        could not be ingested for reason
+        """
+        skipped = self._skipped.get(exp_id)
+        if skipped is None:
+            skipped = SkippedExperiment(source=self.source, exp_id=exp_id)
+        elif skipped.datestamp != datestamp:
+            # the record has changed since, so back off from the start
+            skipped.checks = 0
+        skipped.creator_id = creator_id
+        skipped.datestamp = datestamp
+        skipped.reason = reason
+        skipped.checks += 1
+        skipped.recheck_after = (now or datetime.now()) + \
+            timedelta(seconds=recheck_interval(skipped.checks))
+        skipped.save()
+        self._skipped[exp_id] = skipped
+        logger.info("skipping experiment %s from %s (%s) until %s"
+                    % (exp_id, self.source, reason, skipped.recheck_after))
+
+    def clear(self, exp_id):
+        """
+        Forgets that the experiment exp_id was skipped
+        """
+        skipped = self._skipped.pop(exp_id, None)
+        if skipped is not None:
+            skipped.delete()
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012, RMIT eResearch Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2012, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+"""
+On-disk spool of METS documents downloaded from sources.
+
+.. moduleauthor::  Ian Thomas <ianedwardthomas@gmail.com>
+
+"""
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import uuid
+from django.conf import settings
+from django.utils.hashcompat import md5_constructor as md5
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SPOOL_SIZE = 1024 ** 3
+
+
+class MetsSpool(object):
+    """
+    Directory of METS documents keyed by source and remote experiment id.
+
+    Each document is stored with the ETag and Last-Modified of its
+    response, and is revalidated with If-None-Match/If-Modified-Since when
+    fetched again, so an unchanged document costs a 304 rather than a
+    transfer.  Documents are evicted least recently used first once the
+    spool exceeds max_bytes.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_SPOOL_SIZE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # made by another worker meanwhile
+                if not os.path.isdir(directory):
+                    raise
+
+    def _paths(self, source, exp_id):
+        name = md5("%s|%s" % (source, exp_id)).hexdigest()
+        base = os.path.join(self.directory, name)
+        return base + '.xml', base + '.json'
+
+    def _read_meta(self, meta_path):
+        try:
+            f = open(meta_path)
+            try:
+                return json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            return None
+
+    def _write_meta(self, meta_path, meta):
+        fd, partname = tempfile.mkstemp(dir=self.directory, suffix='.part')
+        f = os.fdopen(fd, 'w')
+        try:
+            json.dump(meta, f)
+        finally:
+            f.close()
+        os.rename(partname, meta_path)
+
+    def fetch(self, url, source, exp_id, download):
+        """
+        Returns (path, meta) of the METS of exp_id at source, fetching url
+        if it is not spooled or has changed.  path is a private link to the
+        spooled document (see :py:meth:`pin`), which the caller moves into
+        place or removes.  meta is a dict of the document's 'size', 'md5',
+        'etag' and 'last_modified'.
+
+        download(url, filename, headers) must stream url to filename and
+        return a :py:class:`~tardis.apps.reposconsumer.transport.Download`.
+        """
+        path, meta_path = self._paths(source, exp_id)
+        meta = self._read_meta(meta_path)
+        headers = {}
+        if meta and os.path.exists(path):
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        result = download(url, path, headers)
+        if result.not_modified:
+            logger.debug("spooled METS of %s from %s is current"
+                         % (exp_id, source))
+            try:
+                # mark as recently used
+                os.utime(path, None)
+                return self.pin(path), meta
+            except (OSError, IOError):
+                # evicted by another worker since it was revalidated
+                logger.debug("spooled METS of %s from %s was evicted, "
+                             "fetching it again" % (exp_id, source))
+                result = download(url, path, {})
+        meta = {'url': url,
+                'size': result.size,
+                'md5': result.digest,
+                'etag': result.etag,
+                'last_modified': result.last_modified}
+        self._write_meta(meta_path, meta)
+        pinned = self.pin(path)
+        self.evict(keep=path)
+        return pinned, meta
+
+    def pin(self, path):
+        """
+        Returns the name of a private hard link to the spooled document at
+        path, which eviction leaves alone, or of a copy of it where the
+        spool's file system cannot link.  The caller moves it into place or
+        removes it.
+        """
+        pinned = "%s.%s.pin" % (path[:-len('.xml')], uuid.uuid4().hex)
+        try:
+            os.link(path, pinned)
+        except (OSError, AttributeError):
+            shutil.copyfile(path, pinned)
+        return pinned
+
+    def evict(self, keep=None):
+        """
+        Removes least recently used documents, other than keep, until the
+        spool is within max_bytes
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith('.xml'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            total += st.st_size
+            entries.append((st.st_mtime, st.st_size, path))
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            for p in (path, path[:-len('.xml')] + '.json'):
+                try:
+                    os.remove(p)
+                except OSError:
+                    pass
+            total -= size
+            logger.debug("evicted %s from METS spool" % path)
+
+
+def get_spool():
+    """
+    Returns the METS spool in settings.REPOS_CONSUMER_SPOOL_DIR, of at most
+    settings.REPOS_CONSUMER_SPOOL_SIZE bytes
+    """
+    directory = getattr(settings, 'REPOS_CONSUMER_SPOOL_DIR', None) \
+        or os.path.join(tempfile.gettempdir(), 'reposconsumer-spool')
+    return MetsSpool(directory, getattr(settings, 'REPOS_CONSUMER_SPOOL_SIZE',
+                                        DEFAULT_SPOOL_SIZE))
@@ -41,14 +41,35 @@ from django.conf import settings
 from os import path
 import logging
 import json
-from urllib2 import Request, urlopen, URLError, HTTPError
+import os
+import shutil
+import time
+from functools import partial
+from itertools import chain
+from lxml import etree
+from urllib2 import URLError, HTTPError
 from django.contrib.auth.models import User
-from django.db import transaction
-from tardis.tardis_portal.models import Experiment, ExperimentACL, UserProfile, Schema, ParameterName, ExperimentParameter
+from tardis.tardis_portal.models import Experiment, UserProfile, Schema, ParameterName
 from tardis.tardis_portal.metsparser import parseMets
 from tardis.tardis_portal.ProcessExperiment import ProcessExperiment
-from tardis.tardis_portal.auth import auth_service
-from tardis.tardis_portal.auth.localdb_auth import django_user
+from tardis.apps.reposconsumer.acls import add_owner_acls
+from tardis.apps.reposconsumer.commits import CommitBatch
+from tardis.apps.reposconsumer.keys import ExperimentKeyIndex
+from tardis.apps.reposconsumer.locks import ExperimentLock, HarvestLock, \
+    release_lease
+from tardis.apps.reposconsumer.metrics import Run
+from tardis.apps.reposconsumer.schedule import due_schedules, mark_queued, \
+    clear_queued, harvest_queued, harvest_started, harvest_done
+from tardis.apps.reposconsumer.caches import get_cache
+from tardis.apps.reposconsumer.fingerprints import FingerprintIndex
+from tardis.apps.reposconsumer.skips import SkipList
+from tardis.apps.reposconsumer.spool import get_spool
+from tardis.apps.reposconsumer.update import update_experiment
+from tardis.apps.reposconsumer.fetch import FetchPool, get_concurrency, prefetch
+from tardis.apps.reposconsumer.transport import get_session
+from tardis.apps.reposconsumer.harvest import Harvest, PageEnd, complete_harvest
+from tardis.apps.reposconsumer.models import HarvestState, \
+    KEY_PARAMETER_VERSION
 
 
 logger = logging.getLogger(__name__)
@@ -78,19 +99,38 @@ class MetsParseError(ErrorBase):
     pass
 
 
+class DeferredError(ErrorBase):
+    """ The experiment cannot be ingested yet, so try again later"""
+
+    def __init__(self, msg, reason):
+        ErrorBase.__init__(self, msg)
+        self.reason = reason
+
+
 def getURL(source):
-    request = Request(source, {}, {})
-    response = urlopen(request)
-    xmldata = response.read()
-    return xmldata
+    """
+    Returns the body at the source url, over a pooled keep-alive connection
+    """
+    return get_session().get(source)
 
 
-def _get_or_create_user(source, user_id):
+def downloadURL(source, filename, headers=None):
     """
-    Retrieves information about the user_id at the source
-    and creates equivalent record here
+    Streams the body at the source url to filename, returning a
+    :py:class:`~tardis.apps.reposconsumer.transport.Download`
     """
-    # get the founduser
+    return get_session().download(source, filename, headers)
+
+
+def _get_user_profile(source, user_id):
+    """
+    Retrieves information about the user_id at the source, from the
+    user_profiles cache if it was recently retrieved
+    """
+    profiles = get_cache('user_profiles')
+    user_profile = profiles.get((source, user_id))
+    if user_profile is not None:
+        return user_profile
     try:
         xmldata = getURL("%s/apps/reposproducer/user/%s/"
             % (source, user_id))
@@ -104,292 +144,982 @@ def _get_or_create_user(source, user_id):
         msg = "cannot parse user information."
         logger.error(msg)
         raise
+    profiles.set((source, user_id), user_profile)
+    return user_profile
+
+
+def _create_user(user_profile):
+    """
+    Returns the local user matching user_profile from a source, creating
+    it if needed.
+    """
+    return _create_users([user_profile])[0]
+
+
+def _create_users(user_profiles):
+    """
+    Returns the local users matching user_profiles from a source, in the
+    same order, creating those that are missing.  The existing users are
+    found with one query, however many profiles there are.
+    """
     # NOTE: we assume that a person username is same across all nodes in BDP
     # FIXME: should new user have same id as original?
+    usernames = set(profile['username'] for profile in user_profiles)
+    found = dict((user.username, user) for user
+                 in User.objects.filter(username__in=usernames))
+    users = []
+    for user_profile in user_profiles:
+        found_user = found.get(user_profile['username'])
+        if not found_user:
+            #FIXME: If there is a exception with readingfeeds, oaipmh from source,
+            # then may end up with redundant users here.  Solution is to check for existing users,
+            # and then create later once all source data has been fetched.
+            found_user = User(username=user_profile['username'],
+                first_name=user_profile['first_name'],
+                last_name=user_profile['last_name'],
+                email=user_profile['email'])
+            found_user.save()
+            UserProfile(user=found_user).save()
+            found[found_user.username] = found_user
+        users.append(found_user)
+    return users
 
-    found_user = None
-    try:
-        found_user = User.objects.get(username=user_profile['username'])
-    except User.DoesNotExist:
-        pass
-    if not found_user:
-        #FIXME: If there is a exception with readingfeeds, oaipmh from source,
-        # then may end up with redundant users here.  Solution is to check for existing users,
-        # and then create later once all source data has been fetched.
-        user1 = User(username=user_profile['username'],
-            first_name=user_profile['first_name'],
-            last_name=user_profile['last_name'],
-            email=user_profile['email'])
-        user1.save()
-        UserProfile(user=user1).save()
-        found_user = user1
-
-    return found_user
 
+def _get_or_create_user(source, user_id):
+    """
+    Retrieves information about the user_id at the source
+    and creates equivalent record here
+    """
+    return _create_user(_get_user_profile(source, user_id))
 
-@task(name="reposconsumer.consume_experiments", ignore_result=True)
-def transfer_experiment(source):
+
+def _get_exp_state(source, exp_id):
     """
-    Pull public experiments from source into current mytardis.
+    Retrieves the public access state of exp_id at the source
     """
+    try:
+        xmldata = getURL("%s/apps/reposproducer/expstate/%s/"
+        % (source, exp_id))
+    except HTTPError as e:
+        msg = "cannot get public state of experiment %s" % exp_id
+        logger.error(msg)
+        raise BadAccessError(msg)
+    try:
+        exp_state = json.loads(xmldata)
+    except ValueError as e:
+        msg = "cannot parse public state of experiment %s" % exp_id
+        logger.error(msg)
+        raise BadAccessError(msg)
+    return exp_state
 
-    #TODO: Cleanup error messages
-    #TODO: does not transfer liences as not part of METS format.
-    #NOTE: As this is a pull we trust the data from the other tardis
-    # Check identity of the feed
-    from oaipmh.client import Client
-    from oaipmh import error
-    from oaipmh.metadata import MetadataRegistry, oai_dc_reader
 
-    from django.core.cache import cache
-    from django.utils.hashcompat import md5_constructor as md5
-
-    # The cache key consists of the task name and the MD5 digest
-    # of the feed URL.
-    cache_key = md5("token").hexdigest()
-    lock_id = "%s-lock-%s" % ("consume_experiment", cache_key)
-    LOCK_EXPIRE = 60 * 5
-    # cache.add fails if if the key already exists
-    acquire_lock = lambda: cache.add(lock_id, "true", LOCK_EXPIRE)
-    # memcache delete is very slow, but we have to use it to take
-    # advantage of using add() for atomic locking
-    release_lock = lambda: cache.delete(lock_id)
-
-    registry = MetadataRegistry()
-    registry.registerReader('oai_dc', oai_dc_reader)
-    source_url = "%s/apps/oaipmh/?verb=Identify" % source
-
-    client = Client(source_url, registry)
+def _get_owner_profiles(source, exp_id):
+    """
+    Retrieves the user information for the isOwner django_user ACLs of
+    exp_id at the source
+    """
     try:
-        identify = client.identify()
-    except AttributeError as e:
-        msg = "Error reading repos identity: %s:%s" % (source, e)
+        xmldata = getURL("%s/apps/reposproducer/acls/%s/"
+        % (source, exp_id))
+
+    except HTTPError as e:
+        msg = "Cannot get acl list of experiment %s" % exp_id
         logger.error(msg)
         raise ReposReadError(msg)
-    except error.ErrorBase as e:
-        msg = "OAIPMH error: %s" % e
+    try:
+        acls = json.loads(xmldata)
+    except ValueError as e:
+        msg = "cannot parse acl list of experiment %s" % exp_id
         logger.error(msg)
-        raise OAIPMHError(msg)
-    except URLError as e:
-        logger.error(e)
-        raise
-    repos = identify.baseURL()
-    import urlparse
-    repos_url = urlparse.urlparse(repos)
-    dest_name = "%s://%s" % (repos_url.scheme, repos_url.netloc)
-    if dest_name != source:
-        msg = "Source directory reports incorrect name: %s" % dest_name
+        raise BadAccessError(msg)
+    return _get_acl_owner_profiles(source, acls)
+
+
+def _get_acl_owner_profiles(source, acls):
+    """
+    Retrieves the user information for the isOwner django_user acls
+    """
+    owner_profiles = []
+    for acl in acls:
+        if acl['pluginId'] == 'django_user' and acl['isOwner']:
+            owner_profiles.append(_get_user_profile(source, acl['entityId']))
+        else:
+            # FIXME: skips all other types of acl for now
+            pass
+    return owner_profiles
+
+
+def _get_exp_key(source, exp_id):
+    """
+    Retrieves the experiment key of exp_id at the source, or None
+    if it is not yet available
+    """
+    try:
+        xmldata = getURL("%s/apps/reposproducer/key/%s/"
+        % (source, exp_id))
+    except HTTPError as e:
+        msg = "cannot get key of experiment %s" % exp_id
         logger.error(msg)
         raise BadAccessError(msg)
-    # Get list of public experiments at sources
-    registry = MetadataRegistry()
-    registry.registerReader('oai_dc', oai_dc_reader)
-    client = Client(source
-        + "/apps/oaipmh/?verb=ListRecords&metadataPrefix=oai_dc", registry)
+    if not xmldata:
+        logger.warn("Unable to retrieve experiment %s key.  Will try again later" % exp_id)
+        return None
+
     try:
-        exps_metadata = [meta
-            for (header, meta, extra)
-            in client.listRecords(metadataPrefix='oai_dc')]
-    except AttributeError as e:
-        msg = "Error reading experiment %s" % e
+        key_value = json.loads(xmldata)
+    except ValueError as e:
+        msg = "cannot parse key list of experiment %s" % exp_id
         logger.error(msg)
-        raise OAIPMHError(msg)
-    except error.NoRecordsMatchError as e:
-        msg = "no public records found on source %s" % e
-        logger.warn(msg)
-        return
+        raise BadAccessError(msg)
+    if not key_value:
+        logger.warn("Unable to retrieve experiment %s key value.  Will try again later" % exp_id)
+        return None
+    return key_value
 
-    local_ids = []
-    for exp_metadata in exps_metadata:
-        exp_id = exp_metadata.getField('identifier')[0]
-        user = exp_metadata.getField('creator')[0]
 
-        found_user = _get_or_create_user(source, user)
+def _get_mets(source, exp_id):
+    """
+    Retrieves the METS document of exp_id at the source by way of the METS
+    spool, returning the name of a private link to it (see
+    :py:meth:`~tardis.apps.reposconsumer.spool.MetsSpool.fetch`) and its
+    meta data.  The caller moves the file into place or removes it.
+    """
+    url = "%s/experiment/metsexport/%s/?force_http_urls" % (source, exp_id)
+    #url = "%s/experiment/metsexport/%s/" % (source, exp_id)
+    spool = get_spool()
+    try:
+        mets_file, meta = spool.fetch(url, source, exp_id, downloadURL)
+    except HTTPError as e:
+        msg = "cannot get METS for experiment %s" % exp_id
+        logger.error(msg)
+        raise ReposReadError(msg)
+    logger.debug("retrieved METS for experiment %s: %s bytes, md5 %s"
+                 % (exp_id, meta['size'], meta['md5']))
+    return mets_file, meta
+
 
-        #make sure experiment is publicish
+BATCH_URL = "%s/apps/reposproducer/batch/?ids=%s"
+
+DEFAULT_BATCH_SIZE = 50
+
+
+def _get_batch_size(source):
+    """
+    Returns the number of experiments to fetch per batch request from
+    source, or 0 if source does not offer batch requests.
+
+    Whether it does is probed once, and then remembered in the
+    producer_capabilities cache.  Batching is turned off altogether with
+    settings.REPOS_CONSUMER_BATCH_SIZE = 0.
+    """
+    batch_size = getattr(settings, 'REPOS_CONSUMER_BATCH_SIZE',
+                         DEFAULT_BATCH_SIZE)
+    if not batch_size:
+        return 0
+    capabilities = get_cache('producer_capabilities', ttl=3600)
+    supported = capabilities.get((source, 'batch'))
+    if supported is None:
         try:
-            xmldata = getURL("%s/apps/reposproducer/expstate/%s/"
-            % (source, exp_id))
-        except HTTPError as e:
-            msg = "cannot get public state of experiment %s" % exp_id
-            logger.error(msg)
-            raise BadAccessError(msg)
+            supported = isinstance(json.loads(getURL(BATCH_URL
+                % (source, ''))), dict)
+        except (HTTPError, ValueError):
+            supported = False
+        logger.debug("source %s %s batch requests"
+            % (source, "supports" if supported else "does not support"))
+        capabilities.set((source, 'batch'), supported)
+    return batch_size if supported else 0
+
+
+def _get_exp_batch(source, exp_ids):
+    """
+    Retrieves the public access state, acls and key of each of exp_ids at
+    the source, as a dict of exp_id -> dict of 'expstate', 'acls' and
+    'key'.  Experiments unknown to the source are left out.
+    """
+    try:
+        xmldata = getURL(BATCH_URL % (source, ",".join(exp_ids)))
+    except HTTPError as e:
+        msg = "cannot get batch of experiments %s" % ",".join(exp_ids)
+        logger.error(msg)
+        raise ReposReadError(msg)
+    try:
+        return json.loads(xmldata)
+    except ValueError as e:
+        msg = "cannot parse batch of experiments %s" % ",".join(exp_ids)
+        logger.error(msg)
+        raise BadAccessError(msg)
+
+
+def _get_batch_entry(batch, exp_id, field, error):
+    """
+    Returns field of exp_id from the finished batch, raising error if the
+    source did not return it
+    """
+    entry = batch.result().get(exp_id)
+    if entry is None or field not in entry:
+        msg = "cannot get %s of experiment %s" % (field, exp_id)
+        logger.error(msg)
+        raise error(msg)
+    return entry[field]
+
+
+def _get_batch_owner_profiles(source, batch, exp_id):
+    acls = _get_batch_entry(batch, exp_id, 'acls', ReposReadError)
+    return _get_acl_owner_profiles(source, acls)
+
+
+def _get_batch_key(batch, exp_id):
+    key_value = _get_batch_entry(batch, exp_id, 'key', BadAccessError)
+    if not key_value:
+        logger.warn("Unable to retrieve experiment %s key value.  Will try again later" % exp_id)
+        return None
+    return key_value
+
+
+class _BatchResult(object):
+    """
+    The part of a batch request for one experiment, read from the batch
+    result when it is needed
+    """
+
+    def __init__(self, read, *args):
+        self._read = read
+        self._args = args
+
+    def result(self):
+        return self._read(*self._args)
+
+
+class ExperimentFetch(object):
+    """
+    The producer requests needed to ingest one remote experiment, running
+    concurrently on a :py:class:`FetchPool`.
+
+    Given the result of a batch request (see :py:func:`_get_exp_batch`),
+    its state, acls and key are taken from that instead of being
+    requested one by one.
+    """
+
+    def __init__(self, pool, source, exp_id, creator_id, datestamp=None,
+                 batch=None):
+        self.source = source
+        self.exp_id = exp_id
+        self.creator_id = creator_id
+        self.datestamp = datestamp
+        self.creator = pool.submit(_get_user_profile, source, creator_id)
+        if batch is None:
+            self.exp_state = pool.submit(_get_exp_state, source, exp_id)
+            self.owners = pool.submit(_get_owner_profiles, source, exp_id)
+            self.key = pool.submit(_get_exp_key, source, exp_id)
+        else:
+            # batch was submitted first, so is already running when the
+            # owners are fetched
+            self.exp_state = _BatchResult(_get_batch_entry, batch, exp_id,
+                                          'expstate', BadAccessError)
+            self.owners = pool.submit(_get_batch_owner_profiles, source,
+                                      batch, exp_id)
+            self.key = _BatchResult(_get_batch_key, batch, exp_id)
+
+
+def _batched(records, size):
+    """
+    Yields lists of up to size records, ending each list early at the end
+    of a page so that progress is recorded as soon as the page is done
+    """
+    batch = []
+    for record in records:
+        batch.append(record)
+        if isinstance(record, PageEnd) or len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+@task(name="reposconsumer.consume_experiments", ignore_result=True)
+def transfer_experiment(source, summary=None, lock=None):
+    """
+    Pull public experiments from source into current mytardis.
+
+    The timings and counts of the run are recorded as a
+    :py:class:`~tardis.apps.reposconsumer.models.HarvestRun`.  If a summary
+    dict is given, the number of records listed is set in it as 'records',
+    and the HarvestRun as 'run'.
+
+    The run holds the :py:class:`~tardis.apps.reposconsumer.locks.HarvestLock`
+    of source, lock if given, so runs of a source never overlap; if another
+    worker holds it, nothing is done and None is returned.  When
+    experiments are dispatched in fan-out mode, the lock is held until they
+    have all been ingested.
+    """
+    if lock is None:
+        lock = HarvestLock(source)
+        if not lock.acquire():
+            logger.info("harvest of %s is already running as %s"
+                        % (source, lock.held_by()))
+            return None
         try:
-            exp_state = json.loads(xmldata)
-        except ValueError as e:
-            msg = "cannot parse public state of experiment %s" % exp_id
-            logger.error(msg)
-            raise BadAccessError(msg)
-        if not exp_state in [Experiment.PUBLIC_ACCESS_FULL,
-                              Experiment.PUBLIC_ACCESS_METADATA]:
-            msg = 'cannot ingest private experiments.' % exp_id
-            logger.error(msg)
-            raise BadAccessError(msg)
+            return transfer_experiment(source, summary, lock)
+        finally:
+            lock.release()
+    if summary is None:
+        summary = {}
+    run = Run(source)
+    error = None
+    try:
+        return _transfer_experiment(source, run, lock)
+    except Exception as e:
+        error = "%s: %s" % (e.__class__.__name__, e)
+        raise
+    finally:
+        summary['records'] = run.counters['records']
+        summary['run'] = run.finish(error)
+
+
+def _transfer_experiment(source, run, lock=None):
+
+    #TODO: Cleanup error messages
+    #TODO: does not transfer liences as not part of METS format.
+    #NOTE: As this is a pull we trust the data from the other tardis
 
-        # Get the usernames of isOwner django_user ACLs for the experiment
+    # Check local configuration before contacting the source
+    key_schema, key_name = _get_key_parameter()
+
+    # Check identity of the feed
+    identify_client, client = _get_clients(source)
+    with run.stage('identify'):
+        _check_identity(source, identify_client)
+    # Get list of public experiments at sources changed since the last harvest
+    registry = _get_registry()
+    state, _ = HarvestState.objects.get_or_create(source=source)
+    harvest = Harvest(client, registry, state, run=run)
+
+    if getattr(settings, 'REPOS_CONSUMER_FANOUT', False):
         try:
-            xmldata = getURL("%s/apps/reposproducer/acls/%s/"
-            % (source, exp_id))
+            return _dispatch_experiments(source, harvest, run, lock)
+        finally:
+            run.incr('records', harvest.records_seen)
+
+    skips = SkipList(source)
+    fingerprints = FingerprintIndex(source)
+    batch_size = _get_batch_size(source)
+    pool = FetchPool(get_concurrency(source))
+
+    def start_fetch(item, batch=None):
+        if isinstance(item, PageEnd):
+            return item
+        exp_id, user, datestamp = item
+        return ExperimentFetch(pool, source, exp_id, user, datestamp, batch)
+
+    def start_batch(items):
+        exp_ids = [item[0] for item in items if not isinstance(item, PageEnd)]
+        batch = None
+        if exp_ids:
+            batch = pool.submit(_get_exp_batch, source, exp_ids)
+        return [start_fetch(item, batch) for item in items]
+
+    # Records stream through as each page arrives, with only the records
+    # being prefetched held ahead of the one being ingested.
+    exps_metadata = _harvested(source, harvest, pool, skips, fingerprints,
+                               run)
+    if batch_size:
+        # one batch request for the state, acls and keys of many
+        # records, fetched a batch ahead
+        fetches = chain.from_iterable(prefetch(
+            _batched(exps_metadata, batch_size), start_batch, 1))
+    else:
+        fetches = prefetch(exps_metadata, start_fetch, pool.size)
+    try:
+        key_index = ExperimentKeyIndex(key_schema, key_name,
+            preload=getattr(settings, 'REPOS_CONSUMER_PRELOAD_KEYS', True))
+        with CommitBatch(run=run) as commits:
+            local_ids = _ingest_experiments(source, fetches, harvest,
+                key_index, skips, fingerprints, run, commits)
+    finally:
+        pool.shutdown()
+        run.incr('records', harvest.records_seen)
+    return local_ids
+
 
-        except HTTPError as e:
-            msg = "Cannot get acl list of experiment %s" % exp_id
+_registry = []
+
+
+def _get_registry():
+    """
+    Returns the oai_dc metadata registry, built once per worker process
+    """
+    if not _registry:
+        from oaipmh.metadata import MetadataRegistry, oai_dc_reader
+        registry = MetadataRegistry()
+        registry.registerReader('oai_dc', oai_dc_reader)
+        _registry.append(registry)
+    return _registry[0]
+
+
+def _get_clients(source):
+    """
+    Returns the (Identify, ListRecords) OAI-PMH clients of source, kept
+    in the oaipmh_clients cache of this worker process
+    """
+    clients = get_cache('oaipmh_clients', ttl=3600)
+    pair = clients.get(source)
+    if pair is None:
+        from oaipmh.client import Client
+        registry = _get_registry()
+        pair = (Client("%s/apps/oaipmh/?verb=Identify" % source, registry),
+                Client(source
+                    + "/apps/oaipmh/?verb=ListRecords&metadataPrefix=oai_dc",
+                    registry))
+        clients.set(source, pair)
+    return pair
+
+
+def _check_identity(source, client):
+    """
+    Checks that source identifies itself as source.  Once checked, this
+    is remembered in the source_identities cache, so runs within its ttl
+    need not contact the source.
+    """
+    identities = get_cache('source_identities', ttl=3600)
+    if identities.get(source):
+        return
+    from oaipmh import error
+    try:
+        try:
+            identify = client.identify()
+        except AttributeError as e:
+            msg = "Error reading repos identity: %s:%s" % (source, e)
             logger.error(msg)
             raise ReposReadError(msg)
-        try:
-            acls = json.loads(xmldata)
-        except ValueError as e:
-            msg = "cannot parse acl list of experiment %s" % exp_id
+        except error.ErrorBase as e:
+            msg = "OAIPMH error: %s" % e
+            logger.error(msg)
+            raise OAIPMHError(msg)
+        except URLError as e:
+            logger.error(e)
+            raise
+        repos = identify.baseURL()
+        import urlparse
+        repos_url = urlparse.urlparse(repos)
+        dest_name = "%s://%s" % (repos_url.scheme, repos_url.netloc)
+        if dest_name != source:
+            msg = "Source directory reports incorrect name: %s" % dest_name
             logger.error(msg)
             raise BadAccessError(msg)
-        owners = []
-        for acl in acls:
-            if acl['pluginId'] == 'django_user' and acl['isOwner']:
-                user = _get_or_create_user(source, acl['entityId'])
-                owners.append(user.username)
-            else:
-                # FIXME: skips all other types of acl for now
-                pass
+    except:
+        # build new clients next time, in case the source has moved
+        get_cache('oaipmh_clients').delete(source)
+        raise
+    identities.set(source, True)
 
-        # Get the METS for the experiment
-        metsxml = ""
-        try:
-            metsxml = getURL("%s/experiment/metsexport/%s/?force_http_urls"
-            % (source, exp_id))
-            #metsxml = getURL("%s/experiment/metsexport/%s/"
-            #% (source, exp_id))
 
-        except HTTPError as e:
-            msg = "cannot get METS for experiment %s" % exp_id
-            logger.error(msg)
-            raise ReposReadError(msg)
+@task(name="reposconsumer.schedule_harvests", ignore_result=True)
+def schedule_harvests():
+    """
+    Queue a harvest of each registered source that is due, unless one is
+    already queued or running for it
+    """
+    for schedule in due_schedules():
+        if HarvestLock(schedule.source).is_locked():
+            continue
+        if not mark_queued(schedule.source):
+            continue
+        harvest_queued(schedule)
+        harvest_source.delay(schedule.source)
 
-        # load schema and parametername for experiment keys
-        try:
-            key_schema = Schema.objects.get(namespace=settings.KEY_NAMESPACE)
-        except Schema.DoesNotExist as e:
-            msg = "No ExperimentKeyService Schema found"
-            logger.error(msg)
-            raise BadAccessError(msg)
 
-        try:
-            key_name = ParameterName.objects.get(name=settings.KEY_NAME)
-        except ParameterName.DoesNotExist as e:
-            msg = "No ExperimentKeyService ParameterName found"
-            logger.error(msg)
-            raise BadAccessError(msg)
+@task(name="reposconsumer.harvest_source", ignore_result=True)
+def harvest_source(source):
+    """
+    Harvest source as :py:func:`transfer_experiment`, unless another
+    harvest of it is running, and schedule the next harvest
+    """
+    clear_queued(source)
+    lock = HarvestLock(source)
+    if not lock.acquire():
+        return None
+    summary = {}
+    error = None
+    started = time.time()
+    harvest_started(source)
+    try:
+        return transfer_experiment(source, summary, lock)
+    except Exception as e:
+        error = "%s: %s" % (e.__class__.__name__, e)
+        raise
+    finally:
+        lock.release()
+        harvest_done(source, summary.get('records', 0),
+                     time.time() - started, error)
 
-        try:
-            xmldata = getURL("%s/apps/reposproducer/key/%s/"
-            % (source, exp_id))
-        except HTTPError as e:
-            msg = "cannot get key of experiment %s" % exp_id
-            logger.error(msg)
-            raise BadAccessError(msg)
-        if not xmldata:
-            logger.warn("Unable to retrieve experiment %s key.  Will try again later" % exp_id)
-            return
 
+DEFAULT_FANOUT_LOCK_EXPIRE = 60 * 60 * 2
+
+
+def _dispatch_experiments(source, harvest, run, lock=None):
+    """
+    Dispatch an ingest_experiment subtask for each harvested record, as a
+    chord whose callback completes the harvest and returns the local ids.
+
+    No progress is recorded until the callback runs, so if listing or any
+    subtask fails, the next harvest lists every record again.  The harvest
+    lock, if given, is handed to the callback to release.  Should the
+    callback never run, it lapses after
+    settings.REPOS_CONSUMER_FANOUT_LOCK_EXPIRE seconds.
+    """
+    from celery.task.chords import chord
+    subtasks = []
+    for item in _harvested(source, harvest, None, SkipList(source),
+                           FingerprintIndex(source), run):
+        if isinstance(item, PageEnd):
+            # resumption tokens are not saved, as the records before them
+            # are not ingested yet
+            continue
+        subtasks.append(ingest_experiment.subtask((source,) + item))
+    started = harvest.state.harvest_started
+    if not subtasks:
+        complete_harvest(harvest.state, started)
+        return []
+    lease = None
+    if lock is not None:
+        lease = lock.detach(getattr(settings,
+            'REPOS_CONSUMER_FANOUT_LOCK_EXPIRE', DEFAULT_FANOUT_LOCK_EXPIRE))
+    logger.info("dispatching %s experiments from %s"
+                % (len(subtasks), source))
+    return chord(subtasks)(
+        harvest_complete.subtask((source, started, lease))).task_id
+
+
+@task(name="reposconsumer.harvest_complete")
+def harvest_complete(results, source, started, lease=None):
+    """
+    Records that every experiment of the harvest of source started at
+    started has been ingested, releases the harvest lock lease, if any,
+    and returns their new local ids
+    """
+    try:
+        state = HarvestState.objects.get(source=source)
+        complete_harvest(state, started)
+    finally:
+        if lease:
+            release_lease(*lease)
+    return [local_id for local_id in results if local_id]
+
+
+@task(name="reposconsumer.ingest_experiment")
+def ingest_experiment(source, exp_id, creator_id, datestamp=None):
+    """
+    Ingest experiment exp_id from source, returning its local id, or None
+    if it has already been ingested or cannot be ingested yet.
+
+    Its timings and counts are sent to the metrics sink, but not recorded
+    as a run.
+    """
+    key_schema, key_name = _get_key_parameter()
+    key_index = ExperimentKeyIndex(key_schema, key_name, preload=False)
+    pool = FetchPool(get_concurrency(source))
+    try:
+        fetch = ExperimentFetch(pool, source, exp_id, creator_id, datestamp)
+        run = Run(source)
+        with CommitBatch(1, run) as commits:
+            return _ingest_or_skip(source, fetch, key_index,
+                                   SkipList(source, [exp_id]),
+                                   FingerprintIndex(source, [exp_id]),
+                                   run, commits)
+    finally:
+        pool.shutdown()
+
+
+_key_parameter = {}
+
+
+def _get_key_parameter():
+    """
+    Returns the (Schema, ParameterName) of experiment keys.
+
+    These are resolved once and then cached across task runs until either
+    model is changed, in any process (see
+    :py:data:`~tardis.apps.reposconsumer.models.KEY_PARAMETER_VERSION`).
+    """
+    from django.core.cache import cache
+    version = cache.get(KEY_PARAMETER_VERSION)
+    cached = _key_parameter.get(version)
+    if cached:
+        return cached
+
+    # load schema and parametername for experiment keys
+    try:
+        key_schema = Schema.objects.get(namespace=settings.KEY_NAMESPACE)
+    except Schema.DoesNotExist as e:
+        msg = "No ExperimentKeyService Schema found"
+        logger.error(msg)
+        raise BadAccessError(msg)
+
+    try:
+        key_name = ParameterName.objects.get(schema=key_schema,
+                                             name=settings.KEY_NAME)
+    except ParameterName.DoesNotExist as e:
+        msg = "No ExperimentKeyService ParameterName found"
+        logger.error(msg)
+        raise BadAccessError(msg)
+    _key_parameter.clear()
+    _key_parameter[version] = (key_schema, key_name)
+    return key_schema, key_name
+
+
+def _harvest_records(source, harvest, pool):
+    """
+    Yields the records of harvest, mapping OAI-PMH failures to our errors
+    """
+    from oaipmh import error
+    records = harvest.records(pool)
+    while True:
         try:
-            key_value = json.loads(xmldata)
-        except ValueError as e:
-            msg = "cannot parse key list of experiment %s" % exp_id
+            record = next(records)
+        except StopIteration:
+            return
+        except AttributeError as e:
+            msg = "Error reading experiment %s" % e
             logger.error(msg)
-            raise BadAccessError(msg)
-        if not key_value:
-            logger.warn("Unable to retrieve experiment %s key value.  Will try again later" % exp_id)
+            raise OAIPMHError(msg)
+        except error.NoRecordsMatchError as e:
+            if harvest.state.last_datestamp:
+                logger.debug("no records changed on source %s since %s"
+                    % (source, harvest.state.last_datestamp))
+            else:
+                msg = "no public records found on source %s" % e
+                logger.warn(msg)
             return
+        yield record
 
-        logger.debug("retrieved key %s from experiment %s" % (key_value, exp_id))
-        exps = Experiment.objects.all()
 
-        got_lock = True
-        if not acquire_lock():
-            logger.warning("another worker has access to consume experiment")
-            return
+def _harvested(source, harvest, pool, skips, fingerprints, run):
+    """
+    Yields the (exp_id, creator_id, datestamp) of each record of harvest
+    not in skips, with the :py:class:`PageEnd` of each page, and then
+    those of the skipped experiments that are due to be checked again.
+
+    Records of experiments ingested as they are, according to
+    fingerprints, are left out before any request is made for them.  Both
+    kinds of record left out are counted in run.
+    """
+    for record in _harvest_records(source, harvest, pool):
+        if isinstance(record, PageEnd):
+            yield record
+            continue
+        header, exp_metadata, about = record
+        exp_id = exp_metadata.getField('identifier')[0]
+        if skips.skips(exp_id, header.datestamp()):
+            logger.debug("skipping experiment %s from %s" % (exp_id, source))
+            run.incr('skipped')
+            continue
+        if fingerprints.unchanged(exp_id, header.datestamp()):
+            logger.debug("experiment %s from %s is unchanged"
+                         % (exp_id, source))
+            run.incr('unchanged')
+            continue
+        yield (exp_id, exp_metadata.getField('creator')[0],
+               header.datestamp())
+    for item in skips.due():
+        yield item
+
+
+def _ingest_experiments(source, fetches, harvest, key_index, skips,
+                        fingerprints, run, commits):
+    """
+    Ingest each fetched remote experiment from source, returning the
+    local ids of the new experiments.  Progress is recorded in harvest
+    at the end of each page of records, and committed with commits.
+
+    Experiments that cannot be ingested yet are recorded in skips and
+    left out, and the rest carry on.
+    """
+    local_ids = []
+    for fetch in fetches:
+        if isinstance(fetch, PageEnd):
+            harvest.page_done(fetch)
+            continue
+        local_id = _ingest_or_skip(source, fetch, key_index, skips,
+                                   fingerprints, run, commits)
+        if local_id:
+            local_ids.append(local_id)
+    return local_ids
 
-        duplicate_exp = 0
-        for exp in exps:
-            #logger.warn("exp = %s" % exp.id)
-            params = ExperimentParameter.objects.filter(name=key_name,
-                                    parameterset__schema=key_schema,
-                                    parameterset__experiment=exp)
-            #logger.warn("params.count() = %s" % params.count())
-            if params.count() >= 1:
-                key = params[0].string_value
-                if key == key_value:
-                    duplicate_exp = exp.id
-                    #logger.warn("found duplicate for %s" % duplicate_exp)
-                    break
+
+def _ingest_or_skip(source, fetch, key_index, skips, fingerprints, run,
+                    commits):
+    """
+    Ingest a fetched remote experiment from source as
+    :py:func:`_ingest_experiment`, recording it in skips instead if it
+    cannot be ingested yet
+    """
+    try:
+        with run.stage('ingest'):
+            local_id = _ingest_experiment(source, fetch, key_index,
+                                          fingerprints, run, commits)
+    except DeferredError as e:
+        logger.warn("Will try again later: %s" % e)
+        skips.skip(fetch.exp_id, fetch.creator_id, fetch.datestamp,
+                   e.reason)
+        run.incr('skipped')
+        return None
+    except Exception:
+        run.incr('failed')
+        raise
+    skips.clear(fetch.exp_id)
+    return local_id
+
+
+def _wait(run, future):
+    """
+    Returns the result of a producer request, timing the wait for it
+    """
+    with run.stage('fetch_wait'):
+        return future.result()
+
+
+def _ingest_experiment(source, fetch, key_index, fingerprints, run,
+                       commits):
+    """
+    Ingest a fetched remote experiment from source, returning the new
+    local id, or None if it is a duplicate of a local experiment or is
+    being ingested by another worker.  Raises DeferredError if it cannot
+    be ingested yet.
+
+    The experiment, its METS, ACLs and fingerprint are written as one
+    unit of commits, so a failed ingest leaves nothing behind.  Its
+    timings and counts are kept in run.
+    """
+    exp_id = fetch.exp_id
+
+    creator = _wait(run, fetch.creator)
+
+    #make sure experiment is publicish
+    exp_state = _wait(run, fetch.exp_state)
+    if not exp_state in [Experiment.PUBLIC_ACCESS_FULL,
+                          Experiment.PUBLIC_ACCESS_METADATA]:
+        raise DeferredError("experiment %s is not public" % exp_id,
+                            'private')
+
+    # The creator and the users of isOwner django_user ACLs for the
+    # experiment, resolved together
+    users = _create_users([creator] + list(_wait(run, fetch.owners)))
+    found_user, owner_users = users[0], users[1:]
+
+    key_value = _wait(run, fetch.key)
+    if not key_value:
+        raise DeferredError("key of experiment %s not yet available"
+                            % exp_id, 'no key')
+
+    logger.debug("retrieved key %s from experiment %s" % (key_value, exp_id))
+
+    with run.stage('key_lookup'):
+        duplicate_exp = key_index.lookup(key_value)
+    if duplicate_exp and not _needs_update(fetch, fingerprints):
+        return _found_duplicate(source, fetch, key_value, duplicate_exp,
+                                fingerprints, run)
+
+    # Hold the lock until the key is committed with the ingested
+    # experiment, so no other worker can ingest it meanwhile
+    lock = ExperimentLock(source, key_value)
+    if not lock.acquire():
+        return None
+    try:
+        with run.stage('key_lookup'):
+            duplicate_exp = key_index.lookup(key_value, refresh=True)
+
+        if duplicate_exp and _needs_update(fetch, fingerprints):
+            _update_experiment(source, fetch, key_value, duplicate_exp,
+                               exp_state, owner_users, fingerprints, run,
+                               commits)
+            return None
 
         if duplicate_exp:
-            logger.warn("Found duplicate experiment form %s exp %s to  exp %s"
-                % (source, exp_id, duplicate_exp))
-            if got_lock:
-                release_lock()
-            return
+            return _found_duplicate(source, fetch, key_value, duplicate_exp,
+                                    fingerprints, run)
 
-        # TODO: Need someway of updating and existing experiment.  Problem is
-        # that copy will have different id from original, so need unique identifier
-        # to allow matching
-
-        # We have not pulled everything we need from producer and are ready to create
-        # experiment.
-
-        # Make placeholder experiment and ready metadata
-        e = Experiment(
-            title='Placeholder Title',
-            approved=True,
-            created_by=found_user,
-            public_access=exp_state,
-            locked=False  # so experiment can then be altered.
-            )
-        e.save()
-
-        # store the key
-        #eps, was_created = ExperimentParameterSet.objects.\
-        #    get_or_create(experiment=e, schema=key_schema)
-        #if was_created:
-        #    logger.warn("was created")
-        #ep, was_created = ExperimentParameter.objects.get_or_create(parameterset=eps,
-        #    name=key_name,
-        #    string_value=key_value)
-        #if was_created:
-        #    logger.warn("was created again")
-        #ep.save()
-
-        if got_lock:
-            release_lock()
-
-        local_id = e.id
-        filename = path.join(e.get_or_create_directory(),
-                             'mets_upload.xml')
-        f = open(filename, 'wb+')
-        f.write(metsxml)
-        f.close()
-
-        # Ingest this experiment META data and isOwner ACLS
-        eid = None
+        # fetched before the transaction, so none is held open over the
+        # network
+        mets_file, mets = _fetch_mets(source, exp_id, run)
         try:
-            eid, sync_path = _registerExperimentDocument(filename=filename,
-                                               created_by=found_user,
-                                               expid=local_id,
-                                               owners=owners)
-            logger.info('=== processing experiment %s: DONE' % local_id)
+            with commits.unit():
+                local_id = _create_experiment(source, exp_id, exp_state,
+                    found_user, owner_users, mets_file, run, commits)
+                fingerprints.record(exp_id, local_id, key_value,
+                                    fetch.datestamp, mets['md5'])
+                # only once the experiment is committed
+                commits.on_commit(partial(key_index.add, key_value,
+                                          local_id))
+                commits.on_commit(partial(run.incr, 'ingested'))
         except:
-            # FIXME: what errors can mets return?
-            msg = '=== processing experiment %s: FAILED!' \
-                % local_id
-            logger.error(msg)
-            raise MetsParseError(msg)
+            _discard(mets_file)
+            raise
+    finally:
+        commits.release(lock)
 
-        # FIXME: if METS parse fails then we should go back and delete the placeholder experiment
+    return local_id
 
+
+def _found_duplicate(source, fetch, key_value, local_id, fingerprints, run):
+    """
+    Records that the fetched remote experiment from source is the local
+    experiment local_id, and flags it as changed if its record is not as
+    it was when ingested.  Returns None.
+    """
+    logger.warn("Found duplicate experiment form %s exp %s to  exp %s"
+        % (source, fetch.exp_id, local_id))
+    run.incr('duplicates')
+    ingested = fingerprints.get(fetch.exp_id)
+    if ingested is None:
+        # ingested before fingerprints were kept
+        fingerprints.record(fetch.exp_id, local_id, key_value,
+                            fetch.datestamp)
+    elif fetch.datestamp and ingested.datestamp != fetch.datestamp:
+        fingerprints.mark_changed(fetch.exp_id)
+    return None
+
+
+def _needs_update(fetch, fingerprints):
+    """
+    Returns whether the fetched remote experiment was ingested, has
+    changed since, and should be updated in place
+    """
+    if not getattr(settings, 'REPOS_CONSUMER_UPDATE', False):
+        return False
+    ingested = fingerprints.get(fetch.exp_id)
+    if ingested is None:
+        return False
+    return ingested.changed or (fetch.datestamp is not None
+                                and ingested.datestamp != fetch.datestamp)
+
+
+def _update_experiment(source, fetch, key_value, local_id, exp_state,
+                       owner_users, fingerprints, run, commits):
+    """
+    Update local experiment local_id in place from the fetched remote
+    experiment from source, if its METS or public state has changed.  The
+    update and new fingerprint are written as one unit of commits, and the
+    new METS replaces the experiment's only once they are committed.
+    """
+    exp = Experiment.objects.get(id=local_id)
+    with run.stage('mets'):
+        mets_file, mets = _get_mets(source, fetch.exp_id)
+    ingested = fingerprints.get(fetch.exp_id)
+    try:
+        with commits.unit():
+            commits.on_commit(partial(_store_mets, exp, mets_file),
+                              undo=partial(_discard, mets_file))
+            if mets['md5'] != ingested.mets_digest \
+                    or exp.public_access != exp_state:
+                try:
+                    with run.stage('update'):
+                        changes = update_experiment(exp, mets_file,
+                            public_access=exp_state, owners=owner_users,
+                            audit_message=get_audit_message(source,
+                                                            fetch.exp_id))
+                except etree.LxmlError as e:
+                    msg = '=== updating experiment %s: FAILED! %s' \
+                        % (local_id, e)
+                    logger.error(msg)
+                    raise MetsParseError(msg)
+                logger.info("updated experiment %s from %s exp %s: %s"
+                    % (local_id, source, fetch.exp_id,
+                       ", ".join("%s %s" % (count, change) for change, count
+                                 in sorted(changes.items()) if count)))
+                run.incr('updated')
+            fingerprints.record(fetch.exp_id, local_id, key_value,
+                                fetch.datestamp, mets['md5'])
+    except:
+        _discard(mets_file)
+        raise
+
+
+def _store_mets(exp, mets_file):
+    """
+    Moves mets_file into the directory of experiment exp as its METS,
+    replacing any it had.  On the same file system it is not copied.
+    """
+    shutil.move(mets_file, path.join(exp.get_or_create_directory(),
+                                     'mets_upload.xml'))
+
+
+def _discard(filename):
+    if path.exists(filename):
+        os.remove(filename)
+
+
+def _fetch_mets(source, exp_id, run):
+    """
+    Retrieves the METS document of exp_id at the source, returning the
+    name of a private link to it in the METS spool and the METS meta data
+    (see :py:meth:`~tardis.apps.reposconsumer.spool.MetsSpool.fetch`)
+    """
+    with run.stage('mets'):
+        return _get_mets(source, exp_id)
+
+
+def _create_experiment(source, exp_id, exp_state, found_user, owner_users,
+                       mets_file, run, commits):
+    """
+    Create a local copy of experiment exp_id from source from its METS in
+    mets_file, returning the local id.  mets_file is moved into the
+    experiment's directory once commits are committed.
+
+    This writes in the caller's transaction, so that if the METS cannot be
+    ingested, rolling back leaves no placeholder experiment behind, and
+    nothing on disk.
+    """
+    # We have not pulled everything we need from producer and are ready to create
+    # experiment.
+
+    # Make placeholder experiment and ready metadata
+    e = Experiment(
+        title='Placeholder Title',
+        approved=True,
+        created_by=found_user,
+        public_access=exp_state,
+        locked=False  # so experiment can then be altered.
+        )
+    e.save()
+
+    # store the key
+    #eps, was_created = ExperimentParameterSet.objects.\
+    #    get_or_create(experiment=e, schema=key_schema)
+    #if was_created:
+    #    logger.warn("was created")
+    #ep, was_created = ExperimentParameter.objects.get_or_create(parameterset=eps,
+    #    name=key_name,
+    #    string_value=key_value)
+    #if was_created:
+    #    logger.warn("was created again")
+    #ep.save()
+
+    local_id = e.id
+    commits.on_commit(partial(_store_mets, e, mets_file),
+                      undo=partial(_discard, mets_file))
+
+    # Ingest this experiment META data and isOwner ACLS
+    eid = None
+    try:
+        with run.stage('parse_mets'):
+            eid, sync_path = _registerExperimentDocument(
+                filename=mets_file, created_by=found_user,
+                expid=local_id,
+                owner_ids=[user.id for user in owner_users])
+        logger.info('=== processing experiment %s: DONE' % local_id)
+    except:
+        # FIXME: what errors can mets return?
+        msg = '=== processing experiment %s: FAILED!' \
+            % local_id
+        logger.error(msg)
+        raise MetsParseError(msg)
+
+    with run.stage('datafiles'):
         exp = Experiment.objects.get(id=eid)
 
         # so that tardis does not copy the data
-        for datafile in exp.get_datafiles():
-            datafile.stay_remote = True
-            datafile.save()
+        # NOTE: a single UPDATE, so Dataset_File save signals are not sent
+        exp.get_datafiles().update(stay_remote=True)
 
         #import nose.tools
         #nose.tools.set_trace()
@@ -398,8 +1128,7 @@ def transfer_experiment(source):
         exp.description += get_audit_message(source, exp_id)
         exp.save()
 
-        local_ids.append(local_id)
-    return local_ids
+    return local_id
 
 
 def get_audit_message(source, exp_id):
@@ -408,11 +1137,11 @@ def get_audit_message(source, exp_id):
 
 # TODO removed username from arguments
 # FIXME: from tardis_portal_views as private.
-@transaction.commit_on_success
 def _registerExperimentDocument(filename, created_by, expid=None,
-                                owners=[], username=None):
+                                owner_ids=[], username=None):
     '''
-    Register the experiment document and return the experiment id.
+    Register the experiment document and return the experiment id, in the
+    caller's transaction.
 
     :param filename: path of the document to parse (METS or notMETS)
     :type filename: string
@@ -420,8 +1149,8 @@ def _registerExperimentDocument(filename, created_by, expid=None,
     :type created_by: :py:class:`django.contrib.auth.models.User`
     :param expid: the experiment ID to use
     :type expid: int
-    :param owners: a list of owners
-    :type owner: list
+    :param owner_ids: the ids of the local users to make owners
+    :type owner_ids: list
     :param username: **UNUSED**
     :rtype: int
 
@@ -442,47 +1171,7 @@ def _registerExperimentDocument(filename, created_by, expid=None,
         logger.debug('processing METS')
         eid, sync_root = parseMets(filename, created_by, expid)
 
-    auth_key = ''
-    try:
-        auth_key = settings.DEFAULT_AUTH
-    except AttributeError:
-        logger.error('no default authentication for experiment' +
-            ' ownership set (settings.DEFAULT_AUTH)')
-
-    force_user_create = False
-    try:
-        force_user_create = settings.DEFAULT_AUTH_FORCE_USER_CREATE
-    except AttributeError:
-        pass
-
-    if auth_key:
-        for owner in owners:
-            # for each PI
-            if not owner:
-                continue
-
-            owner_username = None
-            if '@' in owner:
-                owner_username = auth_service.getUsernameByEmail(auth_key,
-                                    owner)
-            if not owner_username:
-                owner_username = owner
-
-            owner_user = auth_service.getUser(auth_key, owner_username,
-                      force_user_create=force_user_create)
-            # if exist, create ACL
-            if owner_user:
-                #logger.debug('registering owner: ' + owner)
-                e = Experiment.objects.get(pk=eid)
-
-                acl = ExperimentACL(experiment=e,
-                                    pluginId=django_user,
-                                    entityId=str(owner_user.id),
-                                    canRead=True,
-                                    canWrite=True,
-                                    canDelete=True,
-                                    isOwner=True,
-                                    aclOwnershipType=ExperimentACL.OWNER_OWNED)
-                acl.save()
+    # for each PI
+    add_owner_acls(eid, owner_ids)
 
     return (eid, sync_root)
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012, RMIT eResearch Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2012, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+"""
+Benchmark of marking the datafiles of an ingested METS as remote.
+
+Not collected by the normal test run.  Run explicitly with, e.g.::
+
+    bin/django test tardis/apps/reposconsumer/tests/bench_datafiles.py -s
+
+"""
+
+import tempfile
+import time
+from django.contrib.auth.models import User
+from django.test import TransactionTestCase
+from bench_keys import QueryCounter
+from fakeproducer import mets_document
+from tardis.tardis_portal.models import Experiment
+from tardis.apps.reposconsumer import tasks
+
+DATAFILES = 50000
+
+
+def write_mets(datafiles):
+    """
+    Returns the name of a temporary METS file of one dataset holding
+    datafiles files
+    """
+    f = tempfile.NamedTemporaryFile(suffix='.xml', delete=False)
+    f.write(mets_document(datafiles))
+    f.close()
+    return f.name
+
+
+class StayRemoteBenchmark(TransactionTestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='bench')
+        self.filename = write_mets(DATAFILES)
+
+    def _ingest(self):
+        exp = Experiment(title='Placeholder Title', created_by=self.user)
+        exp.save()
+        started = time.time()
+        eid, sync_path = tasks._registerExperimentDocument(
+            filename=self.filename, created_by=self.user, expid=exp.id)
+        print("%d datafiles: METS ingest %.3fs"
+              % (DATAFILES, time.time() - started))
+        return Experiment.objects.get(id=eid)
+
+    def _report(self, label, counter):
+        print("%d datafiles: %-20s %7d queries %8.3fs"
+              % (DATAFILES, label, counter.count, counter.elapsed))
+
+    def test_stay_remote(self):
+        exp = self._ingest()
+        with QueryCounter() as counter:
+            for datafile in exp.get_datafiles():
+                datafile.stay_remote = True
+                datafile.save()
+        self._report("save per datafile", counter)
+
+        exp = self._ingest()
+        with QueryCounter() as counter:
+            exp.get_datafiles().update(stay_remote=True)
+        self._report("bulk update", counter)
+        self.assertEquals(counter.count, 1)
+        self.assertEquals(exp.get_datafiles().filter(stay_remote=False)
+                          .count(), 0)
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012, RMIT eResearch Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2012, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+"""
+Benchmark of concurrent producer fetches against a local fake producer.
+
+Not collected by the normal test run.  Run explicitly with, e.g.::
+
+    bin/django test tardis/apps/reposconsumer/tests/bench_fetch.py -s
+
+"""
+
+import time
+from unittest import TestCase
+from fakeproducer import FakeProducer
+from tardis.apps.reposconsumer.caches import clear_caches
+from tardis.apps.reposconsumer.fetch import FetchPool, prefetch
+from tardis.apps.reposconsumer.tasks import ExperimentFetch, _batched, \
+    _get_batch_size, _get_exp_batch
+
+EXPERIMENTS = 50
+LATENCY = 0.02
+CONCURRENCY = (1, 2, 4, 8, 16)
+
+
+class FetchBenchmark(TestCase):
+
+    def setUp(self):
+        self.producer = FakeProducer(experiments=EXPERIMENTS,
+                                     latency=LATENCY)
+        self.source = self.producer.start()
+
+    def tearDown(self):
+        self.producer.stop()
+
+    def _check(self, fetch):
+        fetch.creator.result()
+        fetch.exp_state.result()
+        fetch.owners.result()
+        self.assertTrue(fetch.key.result())
+
+    def _fetch_all(self, concurrency):
+        exp_ids = [str(i) for i in range(1, EXPERIMENTS + 1)]
+        batch_size = _get_batch_size(self.source)
+        with FetchPool(concurrency) as pool:
+
+            def start_fetch(exp_id):
+                return ExperimentFetch(pool, self.source, exp_id, 1)
+
+            def start_batch(exp_ids):
+                batch = pool.submit(_get_exp_batch, self.source, exp_ids)
+                return [ExperimentFetch(pool, self.source, exp_id, 1,
+                                        batch=batch) for exp_id in exp_ids]
+
+            if batch_size:
+                for fetches in prefetch(_batched(exp_ids, batch_size),
+                                        start_batch, 1):
+                    for fetch in fetches:
+                        self._check(fetch)
+            else:
+                for fetch in prefetch(exp_ids, start_fetch, pool.size):
+                    self._check(fetch)
+
+    def test_fetch(self):
+        print("%s experiments, %.0fms latency per request"
+              % (EXPERIMENTS, LATENCY * 1000))
+        for batch in (False, True):
+            self.producer.batch = batch
+            for concurrency in CONCURRENCY:
+                clear_caches()
+                self.producer.requests = 0
+                started = time.time()
+                self._fetch_all(concurrency)
+                elapsed = time.time() - started
+                print("batch %-5s concurrency %3d: %4d requests %7.3fs "
+                      "%7.1f exps/s" % (batch, concurrency,
+                      self.producer.requests, elapsed, EXPERIMENTS / elapsed))
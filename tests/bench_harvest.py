@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012, RMIT eResearch Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2012, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+"""
+Benchmark of whole harvests by transfer_experiment from a local fake
+producer, over the network stack and the database.
+
+For each catalogue, reports records per second, the p50 and p99 time to
+ingest a record, the peak RSS during the harvest and how far it grew, and
+the database queries of the run.  Set
+BENCH_RESULTS to a file name to also append the results to it as JSON
+lines, to compare across changes.
+
+Not collected by the normal test run.  Run explicitly with, e.g.::
+
+    bin/django test tardis/apps/reposconsumer/tests/bench_harvest.py -s
+
+"""
+
+import json
+import os
+import resource
+import threading
+import time
+from django.conf import settings
+from django.test import TransactionTestCase
+from fakeproducer import FakeProducer
+from tardis.tardis_portal.models import Experiment, Schema, ParameterName
+from tardis.apps.reposconsumer.caches import clear_caches
+from tardis.apps.reposconsumer.metrics import MemorySink, get_sink, set_sink
+from tardis.apps.reposconsumer.tasks import transfer_experiment
+
+# (experiments, datafiles per experiment, latency per request)
+CATALOGUES = (
+    (100, 1, 0.0),
+    (100, 1, 0.01),
+    (100, 500, 0.01),
+    (20, 10000, 0.01),
+)
+PAGE_SIZE = 50
+
+
+def rss():
+    """
+    Returns the resident set size of this process in kilobytes, or None
+    where there is no /proc
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (IOError, OSError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE') // 1024
+
+
+class PeakRSS(object):
+    """
+    Samples the resident set size of this process while entered, so each
+    harvest reports its own peak rather than the peak of every harvest
+    run in the process so far.  Without /proc, the peak is ru_maxrss, the
+    peak of the process, and growth is unknown.
+    """
+
+    interval = 0.01
+
+    def __enter__(self):
+        self.start = self.peak = rss()
+        self._stop = threading.Event()
+        self._thread = None
+        if self.start is not None:
+            self._thread = threading.Thread(target=self._sample)
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, rss())
+
+    def __exit__(self, *args):
+        self._stop.set()
+        if self._thread is None:
+            self.peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return
+        self._thread.join()
+        self.peak = max(self.peak, rss())
+
+    @property
+    def growth(self):
+        if self.start is None:
+            return None
+        return self.peak - self.start
+
+
+class HarvestBenchmark(TransactionTestCase):
+
+    def setUp(self):
+        schema, _ = Schema.objects.get_or_create(
+            namespace=settings.KEY_NAMESPACE, name="Experiment Key")
+        ParameterName.objects.get_or_create(schema=schema,
+                                            name=settings.KEY_NAME)
+        self.previous_sink = get_sink()
+        set_sink(MemorySink())
+
+    def tearDown(self):
+        set_sink(self.previous_sink)
+
+    def _harvest(self, experiments, datafiles, latency, batch):
+        producer = FakeProducer(experiments=experiments, latency=latency,
+                                batch=batch, page_size=PAGE_SIZE,
+                                datafiles=datafiles,
+                                key_prefix="bench-%s" % time.time())
+        source = producer.start()
+        clear_caches()
+        existing = Experiment.objects.count()
+        summary = {}
+        try:
+            with self.settings(REPOS_CONSUMER_METRICS={'queries': True}):
+                with PeakRSS() as memory:
+                    transfer_experiment(source, summary)
+        finally:
+            producer.stop()
+        self.assertEquals(Experiment.objects.count() - existing, experiments)
+        run = summary['run']
+        ingest = json.loads(run.stages)['ingest']
+        result = {
+            'experiments': experiments,
+            'datafiles': datafiles,
+            'latency': latency,
+            'batch': batch,
+            'records_per_second': run.records / run.duration,
+            'p50': ingest['p50'],
+            'p99': ingest['p99'],
+            'peak_rss_kb': memory.peak,
+            'rss_growth_kb': memory.growth,
+            'queries': run.queries,
+            'queries_per_record': float(run.queries) / run.records,
+            'requests': producer.requests,
+        }
+        print("%4d exps x %5d datafiles, %3.0fms, batch %-5s: "
+              "%7.1f records/s p50 %7.1fms p99 %7.1fms peak RSS %7dkB "
+              "(+%skB) %6d queries (%.1f per record) %5d requests"
+              % (experiments, datafiles, latency * 1000, batch,
+                 result['records_per_second'], result['p50'] * 1000,
+                 result['p99'] * 1000, result['peak_rss_kb'],
+                 result['rss_growth_kb'],
+                 run.queries, result['queries_per_record'],
+                 producer.requests))
+        return result
+
+    def test_harvest(self):
+        results = []
+        for experiments, datafiles, latency in CATALOGUES:
+            for batch in (False, True):
+                results.append(self._harvest(experiments, datafiles,
+                                             latency, batch))
+        filename = os.environ.get('BENCH_RESULTS')
+        if filename:
+            with open(filename, 'a') as f:
+                for result in results:
+                    result['time'] = time.time()
+                    f.write(json.dumps(result) + "\n")
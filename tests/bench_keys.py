@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012, RMIT eResearch Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2012, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+"""
+Benchmark of duplicate key lookup against large local catalogues.
+
+Not collected by the normal test run.  Run explicitly with, e.g.::
+
+    bin/django test tardis/apps/reposconsumer/tests/bench_keys.py -s
+
+"""
+
+import time
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TransactionTestCase
+from tardis.tardis_portal.models import Experiment, Schema, ParameterName
+from tardis.tardis_portal.models import ExperimentParameterSet, ExperimentParameter
+from tardis.apps.reposconsumer.keys import ExperimentKeyIndex
+
+SIZES = (10000, 100000)
+LOOKUPS = 100
+CHUNK = 1000
+
+
+class QueryCounter(object):
+    """ Counts the queries issued on the default connection """
+
+    def __enter__(self):
+        self.old_debug = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        self.start = len(connection.queries)
+        self.started = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.elapsed = time.time() - self.started
+        self.count = len(connection.queries) - self.start
+        connection.use_debug_cursor = self.old_debug
+
+
+def _legacy_scan(key_schema, key_name, key_value):
+    """ The per experiment scan replaced by ExperimentKeyIndex """
+    for exp in Experiment.objects.all():
+        params = ExperimentParameter.objects.filter(name=key_name,
+                                parameterset__schema=key_schema,
+                                parameterset__experiment=exp)
+        if params.count() >= 1:
+            if params[0].string_value == key_value:
+                return exp.id
+    return None
+
+
+class KeyLookupBenchmark(TransactionTestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='bench')
+        self.key_schema, _ = Schema.objects.get_or_create(
+            namespace=settings.KEY_NAMESPACE, name="Experiment Key")
+        self.key_name, _ = ParameterName.objects.get_or_create(
+            schema=self.key_schema, name=settings.KEY_NAME)
+        self.created = 0
+
+    def _populate(self, total):
+        while self.created < total:
+            count = min(CHUNK, total - self.created)
+            first = self.created
+            Experiment.objects.bulk_create([
+                Experiment(title='bench%s' % i, created_by=self.user)
+                for i in xrange(first, first + count)])
+            exps = Experiment.objects.filter(created_by=self.user) \
+                .order_by('-id')[:count]
+            ExperimentParameterSet.objects.bulk_create([
+                ExperimentParameterSet(experiment=exp, schema=self.key_schema)
+                for exp in exps])
+            psets = ExperimentParameterSet.objects \
+                .filter(schema=self.key_schema).order_by('-id')[:count]
+            ExperimentParameter.objects.bulk_create([
+                ExperimentParameter(parameterset=pset, name=self.key_name,
+                    string_value="key%s" % pset.experiment_id)
+                for pset in psets])
+            self.created += count
+
+    def _report(self, size, label, counter):
+        print("%7d experiments %-16s %7d queries %8.3fs"
+              % (size, label, counter.count, counter.elapsed))
+
+    def test_key_lookup(self):
+        for size in SIZES:
+            self._populate(size)
+            missing = ["missing%s" % i for i in xrange(LOOKUPS)]
+
+            with QueryCounter() as counter:
+                _legacy_scan(self.key_schema, self.key_name, missing[0])
+            self._report(size, "legacy scan x1", counter)
+
+            index = ExperimentKeyIndex(self.key_schema, self.key_name,
+                                       preload=False)
+            with QueryCounter() as counter:
+                for key_value in missing:
+                    index.lookup(key_value)
+            self._report(size, "indexed x%s" % LOOKUPS, counter)
+            self.assertEquals(counter.count, LOOKUPS)
+
+            index = ExperimentKeyIndex(self.key_schema, self.key_name)
+            with QueryCounter() as counter:
+                for key_value in missing:
+                    index.lookup(key_value)
+            self._report(size, "preloaded x%s" % LOOKUPS, counter)
+            self.assertEquals(counter.count, 1)
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012, RMIT eResearch Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2012, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+"""
+Benchmark of the overhead of a consume run when a source has no new
+records.
+
+Not collected by the normal test run.  Run explicitly with, e.g.::
+
+    bin/django test tardis/apps/reposconsumer/tests/bench_startup.py -s
+
+"""
+
+import time
+from flexmock import flexmock
+from django.conf import settings
+from django.test import TestCase
+from oaipmh import error
+from oaipmh.client import Client as oaipmhclient
+from tardis.tardis_portal.models import Schema, ParameterName
+from tardis.apps.reposconsumer.caches import clear_caches
+from tardis.apps.reposconsumer.tasks import transfer_experiment
+
+RUNS = 50
+LATENCY = 0.02
+SOURCE = "http://127.0.0.1:9000"
+
+
+class StartupBenchmark(TestCase):
+
+    def setUp(self):
+        schema, _ = Schema.objects.get_or_create(
+            namespace=settings.KEY_NAMESPACE, name="Experiment Key")
+        ParameterName.objects.get_or_create(schema=schema,
+                                            name=settings.KEY_NAME)
+        self.requests = {'Identify': 0, 'ListRecords': 0}
+
+        def identify():
+            self.requests['Identify'] += 1
+            time.sleep(LATENCY)
+            return flexmock(baseURL=lambda: "%s/apps/oaipmh" % SOURCE)
+
+        def list_records(**args):
+            self.requests['ListRecords'] += 1
+            time.sleep(LATENCY)
+            raise error.NoRecordsMatchError()
+
+        fake = flexmock(identify=identify,
+                        makeRequestErrorHandling=list_records)
+        flexmock(oaipmhclient).new_instances(fake)
+
+    def _runs(self, cold):
+        for requests in self.requests:
+            self.requests[requests] = 0
+        clear_caches()
+        started = time.time()
+        for i in range(RUNS):
+            if cold:
+                clear_caches()
+            transfer_experiment(SOURCE)
+        elapsed = time.time() - started
+        print("%-5s %7.2fms per run, %.1f Identify %.1f ListRecords requests"
+              " per run" % ("cold" if cold else "warm",
+                            elapsed * 1000 / RUNS,
+                            self.requests['Identify'] / float(RUNS),
+                            self.requests['ListRecords'] / float(RUNS)))
+
+    def test_startup(self):
+        print("%s runs without new records, %.0fms latency per request"
+              % (RUNS, LATENCY * 1000))
+        # the fake source does not serve the batch endpoint
+        with self.settings(REPOS_CONSUMER_BATCH_SIZE=0):
+            self._runs(cold=True)
+            self._runs(cold=False)
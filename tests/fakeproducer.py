@@ -0,0 +1,363 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012, RMIT eResearch Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2012, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+"""
+A local stand-in for a producer MyTardis, for tests and benchmarks.
+
+Serves the OAI-PMH Identify and ListRecords verbs and the reposproducer
+endpoints for a synthetic catalogue of experiments from an in-process
+HTTP server, optionally with injected latency per request.
+
+.. moduleauthor::  Ian Thomas <ianedwardthomas@gmail.com>
+
+"""
+
+import json
+import re
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+from hashlib import md5
+from os import path
+from urlparse import parse_qs, urlsplit
+from xml.sax.saxutils import escape
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+PUBLIC_ACCESS_FULL = 100
+
+METS_FILE = path.join(path.abspath(path.dirname(__file__)), 'mets.xml')
+
+# datestamp of the record of experiment 1; each following experiment's
+# record is a minute later
+FIRST_DATESTAMP = datetime(2012, 11, 27)
+
+METS_HEAD = """<?xml version="1.0" encoding="UTF-8"?>
+<mets PROFILE="Scientific Dataset Profile 1.0" xmlns="http://www.loc.gov/METS/" xmlns:xlink="http://www.w3.org/1999/xlink" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" LABEL="" TYPE="study" OBJID="A-1">
+  <dmdSec ID="E-1">
+    <mdWrap MDTYPE="MODS">
+      <xmlData><mods:mods xmlns:mods="http://www.loc.gov/mods/v3"><mods:titleInfo><mods:title>bench</mods:title></mods:titleInfo><mods:genre>experiment</mods:genre><mods:abstract>benchmark</mods:abstract></mods:mods></xmlData>
+    </mdWrap>
+  </dmdSec>
+  <dmdSec ID="D-1">
+    <mdWrap MDTYPE="MODS">
+      <xmlData><mods:mods xmlns:mods="http://www.loc.gov/mods/v3"><mods:titleInfo><mods:title>ds1</mods:title></mods:titleInfo></mods:mods></xmlData>
+    </mdWrap>
+  </dmdSec>
+  <amdSec>
+    <techMD ID="A-1"><mdWrap OTHERMDTYPE="TARDISEXPERIMENT" MDTYPE="OTHER"/></techMD>
+    <techMD ID="A-2"><mdWrap OTHERMDTYPE="TARDISDATASET" MDTYPE="OTHER"/></techMD>
+  </amdSec>
+  <fileSec>
+    <fileGrp USE="original">
+"""
+
+METS_FILE_ENTRY = """      <file ID="F-%(i)d" MIMETYPE="text/plain" SIZE="10" CHECKSUM="d41d8cd98f00b204e9800998ecf8427e" CHECKSUMTYPE="MD5" OWNERID="file%(i)d.txt">
+        <FLocat LOCTYPE="URL" xlink:href="http://127.0.0.1:9000/file%(i)d.txt"/>
+      </file>
+"""
+
+METS_MIDDLE = """    </fileGrp>
+  </fileSec>
+  <structMap TYPE="logical">
+    <div ADMID="A-1" TYPE="investigation" DMDID="E-1">
+      <div ADMID="A-2" TYPE="dataset" DMDID="D-1">
+"""
+
+METS_FPTR = """        <fptr FILEID="F-%(i)d"/>
+"""
+
+METS_TAIL = """      </div>
+    </div>
+  </structMap>
+</mets>
+"""
+
+OAI_HEAD = """<?xml version="1.0" encoding="UTF-8"?>
+<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">
+<responseDate>%(now)s</responseDate>
+<request verb="%(verb)s">%(url)s</request>
+"""
+
+OAI_IDENTIFY = """<Identify>
+<repositoryName>fake producer</repositoryName>
+<baseURL>%(url)s</baseURL>
+<protocolVersion>2.0</protocolVersion>
+<adminEmail>admin@example.com</adminEmail>
+<earliestDatestamp>%(earliest)s</earliestDatestamp>
+<deletedRecord>no</deletedRecord>
+<granularity>YYYY-MM-DDThh:mm:ssZ</granularity>
+</Identify>
+"""
+
+OAI_RECORD = """<record><header><identifier>%(url)s/experiment/view/%(id)s/</identifier><datestamp>%(datestamp)s</datestamp></header>
+<metadata><oai_dc:dc xmlns:oai_dc="http://www.openarchives.org/OAI/2.0/oai_dc/" xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:title>Experiment %(id)s</dc:title><dc:identifier>%(id)s</dc:identifier><dc:creator>1</dc:creator></oai_dc:dc></metadata></record>
+"""
+
+OAI_ERROR = """<error code="%(code)s">%(message)s</error>
+"""
+
+OAI_TAIL = """</OAI-PMH>
+"""
+
+
+def mets_document(datafiles):
+    """
+    Returns a METS document of one dataset holding datafiles files
+    """
+    parts = [METS_HEAD]
+    parts.extend(METS_FILE_ENTRY % {'i': i} for i in xrange(datafiles))
+    parts.append(METS_MIDDLE)
+    parts.extend(METS_FPTR % {'i': i} for i in xrange(datafiles))
+    parts.append(METS_TAIL)
+    return "".join(parts)
+
+
+def _datestamp(value):
+    return value.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    # keep-alive, so clients may reuse connections
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self._respond(parse_qs(urlsplit(self.path).query))
+
+    def do_POST(self):
+        # OAI-PMH clients post their arguments
+        length = int(self.headers.getheader('Content-Length') or 0)
+        args = parse_qs(urlsplit(self.path).query)
+        args.update(parse_qs(self.rfile.read(length)))
+        self._respond(args)
+
+    def _respond(self, args):
+        self.args = dict((name, values[0]) for name, values in args.items())
+        producer = self.server.producer
+        producer.requests += 1
+        if producer.latency:
+            time.sleep(producer.latency)
+        headers = {}
+        for pattern, handler in producer.routes:
+            match = re.match(pattern, self.path)
+            if match:
+                result = handler(self, *match.groups())
+                status, body = result[:2]
+                if len(result) > 2:
+                    headers = result[2]
+                break
+        else:
+            status, body = 404, "not found"
+        if producer.compress and status == 200 and 'gzip' in \
+                (self.headers.getheader('Accept-Encoding') or ''):
+            encoder = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            body = encoder.compress(body) + encoder.flush()
+            headers = dict(headers, **{"Content-Encoding": "gzip"})
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeProducer(object):
+    """
+    Producer of experiments 1..experiments, each created by user 1 and
+    owned by users 1 and 2.  With compress, responses are gzip encoded for
+    clients that accept it.  With batch, the state, acls and key of many
+    experiments are also served in one request.
+
+    Experiments are listed page_size records to a ListRecords page.  The
+    METS of every experiment is tests/mets.xml, or if datafiles is given,
+    a generated document of that many datafiles.  The key of experiment
+    n is key_prefix-n.
+    """
+
+    def __init__(self, experiments=10, latency=0.0, compress=False,
+                 batch=False, page_size=100, datafiles=None,
+                 key_prefix="key"):
+        self.experiments = experiments
+        self.latency = latency
+        self.compress = compress
+        self.batch = batch
+        self.page_size = page_size
+        self.key_prefix = key_prefix
+        self.requests = 0
+        self.mets_requests = 0
+        self.batch_requests = 0
+        self.list_requests = 0
+        if datafiles is None:
+            self.mets = open(METS_FILE, 'r').read()
+        else:
+            self.mets = mets_document(datafiles)
+        self.routes = [
+            (r'^/apps/oaipmh/', self.oaipmh),
+            (r'^/apps/reposproducer/user/(\d+)/$', self.user),
+            (r'^/apps/reposproducer/expstate/(\d+)/$', self.expstate),
+            (r'^/apps/reposproducer/acls/(\d+)/$', self.acls),
+            (r'^/apps/reposproducer/key/(\d+)/$', self.key),
+            (r'^/apps/reposproducer/batch/\?ids=([\d,]*)$', self.batch_),
+            (r'^/experiment/metsexport/(\d+)/', self.metsexport),
+        ]
+        self._server = None
+
+    def start(self):
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self._server.producer = self
+        t = threading.Thread(target=self._server.serve_forever)
+        t.daemon = True
+        t.start()
+        host, port = self._server.server_address
+        self.url = "http://%s:%s" % (host, port)
+        return self.url
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _exists(self, exp_id):
+        return 1 <= int(exp_id) <= self.experiments
+
+    def datestamp(self, exp_id):
+        """
+        Returns the datestamp of the record of experiment exp_id
+        """
+        return FIRST_DATESTAMP + timedelta(minutes=int(exp_id) - 1)
+
+    def _oai_response(self, verb, body):
+        url = "%s/apps/oaipmh" % self.url
+        return 200, (OAI_HEAD % {'now': _datestamp(datetime.utcnow()),
+                                 'verb': escape(verb), 'url': url}
+                     + body + OAI_TAIL), {"Content-Type": "text/xml"}
+
+    def _oai_error(self, verb, code, message):
+        return self._oai_response(verb, OAI_ERROR % {'code': code,
+                                                     'message': message})
+
+    def oaipmh(self, request):
+        verb = request.args.get('verb', '')
+        if verb == 'Identify':
+            return self._oai_response(verb, OAI_IDENTIFY % {
+                'url': "%s/apps/oaipmh" % self.url,
+                'earliest': _datestamp(FIRST_DATESTAMP)})
+        if verb != 'ListRecords':
+            return self._oai_error(verb, 'badVerb', "unsupported verb")
+        return self.list_records(request.args)
+
+    def list_records(self, args):
+        """
+        Lists the records from args['from'], page_size to a page.  The
+        resumption token of a page is the offset and from of the next.
+        """
+        self.list_requests += 1
+        verb = 'ListRecords'
+        if 'resumptionToken' in args:
+            try:
+                offset, start = args['resumptionToken'].split('|')
+                offset = int(offset)
+            except ValueError:
+                return self._oai_error(verb, 'badResumptionToken',
+                                       "bad token")
+        else:
+            offset, start = 0, args.get('from', '')
+        exp_ids = [exp_id for exp_id in range(1, self.experiments + 1)
+                   if _datestamp(self.datestamp(exp_id)) >= start]
+        if not exp_ids:
+            return self._oai_error(verb, 'noRecordsMatch', "no records")
+        page = exp_ids[offset:offset + self.page_size]
+        body = ["<ListRecords>\n"]
+        for exp_id in page:
+            body.append(OAI_RECORD % {'url': self.url, 'id': exp_id,
+                'datestamp': _datestamp(self.datestamp(exp_id))})
+        if offset + self.page_size < len(exp_ids):
+            body.append("<resumptionToken>%s|%s</resumptionToken>\n"
+                        % (offset + self.page_size, start))
+        elif offset:
+            # an empty token marks the last page of a resumed list
+            body.append("<resumptionToken/>\n")
+        body.append("</ListRecords>\n")
+        return self._oai_response(verb, "".join(body))
+
+    def user(self, request, user_id):
+        return 200, json.dumps({"username": "user%s" % user_id,
+                                "first_name": "First%s" % user_id,
+                                "last_name": "Last%s" % user_id,
+                                "email": "user%s@example.com" % user_id})
+
+    def expstate(self, request, exp_id):
+        if not self._exists(exp_id):
+            return 404, ""
+        return 200, json.dumps(PUBLIC_ACCESS_FULL)
+
+    def acls(self, request, exp_id):
+        if not self._exists(exp_id):
+            return 404, ""
+        return 200, json.dumps([
+            {"pluginId": "django_user", "isOwner": True, "entityId": "1"},
+            {"pluginId": "django_user", "isOwner": True, "entityId": "2"}])
+
+    def key(self, request, exp_id):
+        if not self._exists(exp_id):
+            return 404, ""
+        return 200, json.dumps("%s-%s" % (self.key_prefix, exp_id))
+
+    def batch_(self, request, exp_ids):
+        if not self.batch:
+            return 404, "not found"
+        self.batch_requests += 1
+        entries = {}
+        for exp_id in filter(None, exp_ids.split(',')):
+            if self._exists(exp_id):
+                entries[exp_id] = {
+                    "expstate": json.loads(self.expstate(request, exp_id)[1]),
+                    "acls": json.loads(self.acls(request, exp_id)[1]),
+                    "key": json.loads(self.key(request, exp_id)[1])}
+        return 200, json.dumps(entries)
+
+    def metsexport(self, request, exp_id):
+        if not self._exists(exp_id):
+            return 404, ""
+        self.mets_requests += 1
+        etag = '"%s"' % md5(self.mets).hexdigest()
+        if request.headers.getheader('If-None-Match') == etag:
+            return 304, "", {"ETag": etag}
+        return 200, self.mets, {"ETag": etag}
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012, RMIT eResearch Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2012, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+"""
+Counting and classifying the SQL issued by the consumer, so tests can
+hold ingests to a query budget.
+
+.. moduleauthor::  Ian Thomas <ianedwardthomas@gmail.com>
+
+"""
+
+import re
+from collections import Counter
+from django.db import connection
+
+_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE)\s+["`]?(\w+)', re.IGNORECASE)
+_LITERALS = [
+    (re.compile(r"'(?:[^']|'')*'"), "?"),
+    (re.compile(r"\b\d+(?:\.\d+)?\b"), "?"),
+    # IN lists of any length are the same statement
+    (re.compile(r"\((?:\s*\?\s*,)*\s*\?\s*\)"), "(...)"),
+]
+
+
+def classify(sql):
+    """
+    Returns the class of statement sql, its verb and first table, e.g.
+    'SELECT tardis_portal_experiment'
+    """
+    verb = sql.split(None, 1)[0].upper() if sql.strip() else ''
+    match = _TABLE.search(sql)
+    if match:
+        return "%s %s" % (verb, match.group(1))
+    return verb
+
+
+def normalise(sql):
+    """
+    Returns sql with its literal values replaced, so the statements an
+    N+1 loop issues are all the same
+    """
+    for pattern, replacement in _LITERALS:
+        sql = pattern.sub(replacement, sql)
+    return sql
+
+
+class QueryLog(object):
+    """
+    Logs the statements issued on the default connection while entered.
+    Statements issued so far are in statements, and mark() returns a
+    position in them, so the statements of part of the block may be
+    picked out.
+    """
+
+    def __enter__(self):
+        self._debug = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        self._start = len(connection.queries)
+        self._statements = None
+        return self
+
+    def __exit__(self, *args):
+        self._statements = self.statements
+        connection.use_debug_cursor = self._debug
+
+    def mark(self):
+        return len(connection.queries) - self._start
+
+    @property
+    def statements(self):
+        if self._statements is not None:
+            return self._statements
+        return [query['sql'] for query in connection.queries[self._start:]]
+
+
+def report(statements, top=5):
+    """
+    Returns a description of statements, counted by class and by their
+    most frequent normalised forms
+    """
+    classes = Counter(classify(sql) for sql in statements)
+    lines = ["by class:"]
+    lines.extend("  %5d %s" % (count, name)
+                 for name, count in classes.most_common())
+    lines.append("top statements:")
+    lines.extend("  %5d x %s" % (count, sql[:300]) for sql, count
+                 in Counter(normalise(sql) for sql in statements)
+                 .most_common(top))
+    return "\n".join(lines)
+
+
+def assert_within_budget(testcase, statements, budget, what):
+    """
+    Fails testcase if statements number more than budget, showing the top
+    offending statements
+    """
+    if len(statements) > budget:
+        testcase.fail("%s issued %d queries, over its budget of %d\n%s"
+                      % (what, len(statements), budget, report(statements)))
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012, RMIT eResearch Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2012, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+from tardis.tardis_portal.models import Experiment, ExperimentACL
+from tardis.tardis_portal.auth.localdb_auth import django_user
+from tardis.apps.reposconsumer.acls import add_owner_acls
+from tardis.apps.reposconsumer.caches import clear_caches
+
+
+class OwnerACLTest(TestCase):
+
+    def setUp(self):
+        clear_caches()
+        self.users = [User.objects.create(username='user%s' % i,
+                                          email='user%s@example.com' % i)
+                      for i in range(5)]
+        self.exp = Experiment(title='exp', created_by=self.users[0])
+        self.exp.save()
+
+    def _owner_acls(self):
+        return sorted(ExperimentACL.objects.filter(experiment=self.exp,
+            pluginId=django_user, isOwner=True)
+            .values_list('entityId', flat=True))
+
+    def test_add_owner_acls(self):
+        ids = [user.id for user in self.users]
+        with self.assertNumQueries(2):
+            self.assertEquals(add_owner_acls(self.exp.id, ids[:2] + ids[:1]),
+                              2)
+        # queries do not grow with the owners, and existing ACLs are kept
+        with self.assertNumQueries(2):
+            self.assertEquals(add_owner_acls(self.exp.id, ids), 3)
+        with self.assertNumQueries(1):
+            self.assertEquals(add_owner_acls(self.exp.id, ids), 0)
+        self.assertEquals(self._owner_acls(),
+                          sorted(str(user_id) for user_id in ids))
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012, RMIT eResearch Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2012, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import time
+from django.test import TestCase
+from flexmock import flexmock
+from tardis.apps.reposconsumer import caches
+from tardis.apps.reposconsumer.caches import TTLCache, SharedCache
+
+
+class TTLCacheTest(TestCase):
+
+    def test_lru_eviction(self):
+        cache = TTLCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEquals(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertEquals(cache.get('b'), None)
+        self.assertEquals(cache.get('a'), 1)
+        self.assertEquals(cache.get('c'), 3)
+        self.assertEquals(cache.stats(), {'hits': 3, 'misses': 1, 'size': 2})
+
+    def test_expiry(self):
+        cache = TTLCache(ttl=10)
+        cache.set('a', 1)
+        flexmock(time).should_receive('time').and_return(time.time() + 11)
+        self.assertEquals(cache.get('a', 'expired'), 'expired')
+
+    def test_shared(self):
+        cache = SharedCache('test', ttl=10)
+        cache.set(('http://127.0.0.1:9000', '1'), {'username': 'tom'})
+        other = SharedCache('test', ttl=10)
+        self.assertEquals(other.get(('http://127.0.0.1:9000', '1')),
+                          {'username': 'tom'})
+        self.assertEquals(other.get(('http://127.0.0.1:9000', '2')), None)
+        self.assertEquals(other.stats(), {'hits': 1, 'misses': 1})
+        cache.delete(('http://127.0.0.1:9000', '1'))
+
+    def test_get_cache(self):
+        cache = caches.get_cache('test_get_cache', maxsize=5)
+        self.assertTrue(caches.get_cache('test_get_cache') is cache)
+        cache.get('a')
+        self.assertEquals(caches.cache_stats()['test_get_cache']['misses'], 1)
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012, RMIT eResearch Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2012, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import json
+import os
+import shutil
+import tempfile
+from flexmock import flexmock
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection, transaction, DatabaseError
+from django.test import TransactionTestCase, skipUnlessDBFeature
+from fakeproducer import FakeProducer
+from tardis.tardis_portal.models import Experiment, Schema, ParameterName
+from tardis.apps.reposconsumer import tasks
+from tardis.apps.reposconsumer.caches import clear_caches
+from tardis.apps.reposconsumer.commits import CommitBatch
+from tardis.apps.reposconsumer.models import IngestedExperiment
+
+
+class FakeLock(object):
+
+    released = False
+
+    def release(self):
+        self.released = True
+
+
+class CommitBatchTest(TransactionTestCase):
+
+    def test_unit(self):
+        with CommitBatch() as commits:
+            User.objects.create(username='before')
+            try:
+                with commits.unit():
+                    User.objects.create(username='failed')
+                    raise ValueError()
+            except ValueError:
+                pass
+            with commits.unit():
+                User.objects.create(username='done')
+            self.assertEquals(commits.pending, 0)
+        self.assertEquals(sorted(User.objects.values_list('username',
+                                                          flat=True)),
+                          ['before', 'done'])
+
+    @skipUnlessDBFeature('uses_savepoints')
+    def test_batch(self):
+        lock = FakeLock()
+        with CommitBatch(3) as commits:
+            with commits.unit():
+                User.objects.create(username='first')
+            with commits.unit():
+                User.objects.create(username='second')
+            commits.release(lock)
+            # held until its unit is committed
+            self.assertEquals(commits.pending, 2)
+            self.assertFalse(lock.released)
+            with commits.unit():
+                User.objects.create(username='third')
+            self.assertEquals(commits.pending, 0)
+            self.assertTrue(lock.released)
+        self.assertEquals(User.objects.count(), 3)
+
+    def test_no_savepoints(self):
+        flexmock(connection.features, uses_savepoints=False)
+        lock = FakeLock()
+        with CommitBatch(3) as commits:
+            self.assertEquals(commits.size, 1)
+            with commits.unit():
+                User.objects.create(username='first')
+            commits.release(lock)
+            self.assertEquals(commits.pending, 0)
+            self.assertTrue(lock.released)
+            try:
+                with commits.unit():
+                    User.objects.create(username='failed')
+                    raise ValueError()
+            except ValueError:
+                pass
+        # the failed unit took no other with it
+        self.assertEquals(list(User.objects.values_list('username',
+                                                        flat=True)),
+                          ['first'])
+
+    def test_on_commit(self):
+        done = []
+        with CommitBatch() as commits:
+            try:
+                with commits.unit():
+                    commits.on_commit(lambda: done.append('failed'),
+                                      undo=lambda: done.append('undone'))
+                    raise ValueError()
+            except ValueError:
+                pass
+            with commits.unit():
+                commits.on_commit(lambda: done.append('done'))
+        self.assertEquals(done, ['undone', 'done'])
+
+    def test_exit_on_error(self):
+        lock = FakeLock()
+        try:
+            with CommitBatch(3) as commits:
+                with commits.unit():
+                    User.objects.create(username='done')
+                commits.release(lock)
+                raise ValueError()
+        except ValueError:
+            pass
+        # what was done is kept
+        self.assertEquals(User.objects.filter(username='done').count(), 1)
+        self.assertTrue(lock.released)
+
+
+class AtomicIngestTest(TransactionTestCase):
+    """
+    Ingests from a local producer, each committed as a whole
+    """
+
+    def setUp(self):
+        clear_caches()
+        schema, _ = Schema.objects.get_or_create(
+            namespace=settings.KEY_NAMESPACE, name="Experiment Key")
+        ParameterName.objects.get_or_create(schema=schema,
+                                            name=settings.KEY_NAME)
+        self.producer = FakeProducer(experiments=5)
+        self.source = self.producer.start()
+
+    def tearDown(self):
+        self.producer.stop()
+
+    def test_failed_ingest(self):
+        register = tasks._registerExperimentDocument
+
+        def fail_third(filename, created_by, expid=None, owner_ids=[]):
+            if Experiment.objects.count() == 3:
+                register(filename, created_by, expid, owner_ids)
+                raise ValueError("broken METS")
+            return register(filename, created_by, expid, owner_ids)
+
+        flexmock(tasks).should_receive('_registerExperimentDocument') \
+            .replace_with(fail_third)
+        try:
+            tasks.transfer_experiment(self.source)
+        except tasks.MetsParseError:
+            pass
+        else:
+            self.fail("Expected MetsParseError")
+        # the two before are kept, and nothing of the third
+        self.assertEquals(Experiment.objects.count(), 2)
+        self.assertEquals(IngestedExperiment.objects.count(), 2)
+        self.assertEquals(Experiment.objects.filter(
+            title='Placeholder Title').count(), 0)
+
+    def test_failed_commit(self):
+        store, spool = tempfile.mkdtemp(), tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, store)
+        self.addCleanup(shutil.rmtree, spool)
+        flexmock(transaction).should_receive('commit') \
+            .and_raise(DatabaseError("disk full"))
+        with self.settings(FILE_STORE_PATH=store,
+                           REPOS_CONSUMER_SPOOL_DIR=spool):
+            self.assertRaises(DatabaseError, tasks.transfer_experiment,
+                              self.source)
+        self.assertEquals(Experiment.objects.count(), 0)
+        # no METS moved into an experiment, nor left pinned in the spool
+        self.assertEquals([name for _, _, names in os.walk(store)
+                           for name in names], [])
+        self.assertEquals([name for name in os.listdir(spool)
+                           if name.endswith('.pin')], [])
+
+    @skipUnlessDBFeature('uses_savepoints')
+    def test_batched(self):
+        with self.settings(REPOS_CONSUMER_COMMIT_BATCH=10):
+            summary = {}
+            local_ids = tasks.transfer_experiment(self.source, summary)
+        self.assertEquals(len(local_ids), 5)
+        self.assertEquals(Experiment.objects.count(), 5)
+        commits = json.loads(summary['run'].stages)['commit']['count']
+        self.assertTrue(commits < 5, commits)
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012, RMIT eResearch Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2012, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+from datetime import datetime
+from django.contrib.auth.models import User
+from django.test import TestCase
+from tardis.tardis_portal.models import Experiment
+from tardis.apps.reposconsumer.fingerprints import FingerprintIndex, fingerprint
+
+
+class FingerprintIndexTest(TestCase):
+
+    source = "http://127.0.0.1:9000"
+
+    def setUp(self):
+        user = User.objects.create(username='tom')
+        self.exp = Experiment(title='exp', created_by=user)
+        self.exp.save()
+
+    def test_fingerprint(self):
+        stamp = datetime(2012, 11, 27)
+        self.assertEquals(fingerprint(self.source, "1", "key1", stamp, "d"),
+                          fingerprint(self.source, "1", "key1", stamp, "d"))
+        self.assertNotEquals(fingerprint(self.source, "1", "key1", stamp, "d"),
+            fingerprint(self.source, "1", "key1", datetime(2012, 11, 28), "d"))
+        self.assertNotEquals(fingerprint(self.source, "1", "key1", stamp, "d"),
+            fingerprint(self.source, "1", "key2", stamp, "d"))
+
+    def test_unchanged(self):
+        stamp = datetime(2012, 11, 27)
+        fingerprints = FingerprintIndex(self.source)
+        self.assertFalse(fingerprints.unchanged("1", stamp))
+        fingerprints.record("1", self.exp.id, "key1", stamp, "digest")
+
+        with self.assertNumQueries(1):
+            fingerprints = FingerprintIndex(self.source)
+            self.assertEquals(len(fingerprints), 1)
+            self.assertTrue(fingerprints.unchanged("1", stamp))
+            self.assertFalse(fingerprints.unchanged("1", None))
+            self.assertFalse(fingerprints.unchanged("1",
+                                                    datetime(2012, 11, 28)))
+            self.assertFalse(fingerprints.unchanged("2", stamp))
+
+        fingerprints.mark_changed("1")
+        self.assertFalse(FingerprintIndex(self.source).unchanged("1", stamp))
+        self.assertEquals(len(FingerprintIndex(self.source, ["2"])), 0)
+        self.assertEquals(len(FingerprintIndex("http://127.0.0.1:9001")), 0)
@@ -31,22 +31,43 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 
+import json
+import unittest
 from os import path
+from hashlib import md5
+from datetime import datetime
 from flexmock import flexmock
+from lxml import etree
 from urllib2 import URLError, HTTPError
 from django.test import TestCase
 from django.test.client import Client
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from oaipmh.client import Client as oaipmhclient
 from tardis.tardis_portal.models import UserProfile, ExperimentACL, Experiment, Author_Experiment
 from tardis.tardis_portal.models import License, Schema, ParameterName
+from tardis.tardis_portal.models import ExperimentParameterSet, ExperimentParameter
 from tardis.apps.reposconsumer.tasks import OAIPMHError, ReposReadError, BadAccessError
 from tardis.apps.reposconsumer.tasks import MetsParseError
 from tardis.apps.reposconsumer import tasks
+from tardis.apps.reposconsumer.models import HarvestState, SkippedExperiment
+from tardis.apps.reposconsumer.models import IngestedExperiment, HarvestRun
+from tardis.apps.reposconsumer.caches import clear_caches
+from tardis.apps.reposconsumer.fetch import FetchPool
+from tardis.apps.reposconsumer.fingerprints import FingerprintIndex
+from tardis.apps.reposconsumer.locks import HarvestLock
+from tardis.apps.reposconsumer.metrics import MemorySink, get_sink, set_sink
 from tardis.tardis_portal.auth.localdb_auth import django_user, django_group
+from fakeproducer import FakeProducer
 
 
+OAI_NS = 'http://www.openarchives.org/OAI/2.0/'
+
+LIST_RECORDS_RESPONSE = """<OAI-PMH xmlns="%s">
+<responseDate>2012-11-28T01:02:03Z</responseDate>
+</OAI-PMH>""" % OAI_NS
+
 
 def _create_test_data():
     """
@@ -113,8 +134,9 @@ class TransferExpTest(TestCase):
     def setUp(self):
         self._client = Client()
         self.user1, self.user2, self.exp = _create_test_data()
+        clear_caches()
 
-    def _setup_mocks(self, source):
+    def _setup_mocks(self, source, batch=False):
 
         # fake the OAIPMH connections
         #identify_fake = flexmock(identify=lambda: identify_fake1)
@@ -130,10 +152,16 @@ class TransferExpTest(TestCase):
             .with_args('creator') \
             .and_return([str(self.user1.id)])
 
+        header_fake = flexmock(isDeleted=lambda: False,
+                               datestamp=lambda: datetime(2012, 11, 27))
+        response_tree = etree.XML(LIST_RECORDS_RESPONSE)
+
         fake = flexmock(identify=lambda: identify_fake1,
                         baseURL=lambda: "%s/apps/oaipmh" % source,
-                        listRecords=lambda metadataPrefix:
-                             [({}, metadata_fake, {})])
+                        getNamespaces=lambda: {'oai': OAI_NS},
+                        makeRequestErrorHandling=lambda **kw: response_tree,
+                        buildRecords=lambda prefix, ns, registry, tree:
+                             ([(header_fake, metadata_fake, None)], None))
         flexmock(oaipmhclient).new_instances(fake)
 
         # fake the urllib2 based connections and the mets pull
@@ -165,9 +193,18 @@ class TransferExpTest(TestCase):
                 (self.user2.username, self.user2.first_name, self.user2.last_name,
                  self.user2.email))
 
-        flexmock(tasks).should_receive('getURL').with_args(
-            "%s/experiment/metsexport/%s/?force_http_urls" % (source, self.exp.id)) \
-            .and_return(metsdata)
+        def download_mets(url, filename, headers):
+            f = open(filename, 'wb')
+            f.write(metsdata)
+            f.close()
+            return flexmock(not_modified=False, size=len(metsdata),
+                            digest=md5(metsdata).hexdigest(),
+                            etag=None, last_modified=None)
+
+        flexmock(tasks).should_receive('downloadURL').with_args(
+            "%s/experiment/metsexport/%s/?force_http_urls" % (source, self.exp.id),
+            basestring, dict) \
+            .replace_with(download_mets)
 
         flexmock(tasks).should_receive('get_audit_message') \
             .and_return(" audit message here")
@@ -182,6 +219,34 @@ class TransferExpTest(TestCase):
             "%s/apps/reposproducer/key/%s/" % (source, self.exp.id)) \
            .and_return('"sdgfkhagkuashiuatihaghs7igtyweatihawtuhatjkhzsdg"')
 
+        # the source offers batch requests only if asked to
+        if batch:
+            flexmock(tasks).should_receive('getURL').with_args(
+                "%s/apps/reposproducer/batch/?ids=" % source) \
+                .and_return('{}')
+        else:
+            flexmock(tasks).should_receive('getURL').with_args(
+                "%s/apps/reposproducer/batch/?ids=" % source) \
+                .and_raise(HTTPError("", 404, "", {}, None))
+
+    def test_create_users(self):
+        """
+        The local users of many profiles are found with one query, and
+        missing ones created
+        """
+        profiles = [{'username': username, 'first_name': "First",
+                     'last_name': "Last",
+                     'email': "%s@example.com" % username}
+                    for username in ("tom", "joe", "tom", "ann")]
+        with self.assertNumQueries(1):
+            users = tasks._create_users(profiles[:3])
+        self.assertEquals([user.id for user in users],
+                          [self.user1.id, self.user2.id, self.user1.id])
+        users = tasks._create_users(profiles)
+        self.assertEquals(users[3].username, "ann")
+        self.assertEquals(UserProfile.objects.filter(user=users[3]).count(),
+                          1)
+
     def test_correct_run(self):
         """
         This is an initial test of a basic consumption of service
@@ -312,7 +377,7 @@ class TransferExpTest(TestCase):
         fake = flexmock(identify=lambda: identify_fake1,
                         baseURL=lambda: "%s/apps/oaipmh" % source)
         #                listRecords=lambda metadataPrefix: AttributeErrorFake)
-        fake.should_receive('listRecords').and_raise(AttributeErrorFake)
+        fake.should_receive('makeRequestErrorHandling').and_raise(AttributeErrorFake)
         flexmock(oaipmhclient).new_instances(fake)
 
         from tardis.apps.reposconsumer.tasks import transfer_experiment
@@ -340,6 +405,135 @@ class TransferExpTest(TestCase):
         else:
             self.assertTrue(False, "Expected BadAccessError")
 
+    def test_private_skipped(self):
+        """
+        A private experiment is skipped, and not looked at again until it
+        is due or its record changes
+        """
+        source = "http://127.0.0.1:9000"
+        self._setup_mocks(source)
+        states = []
+
+        def get_exp_state(url):
+            states.append(url)
+            return str(public_access[0])
+        public_access = [Experiment.PUBLIC_ACCESS_NONE]
+        flexmock(tasks).should_receive('getURL').with_args(
+            "%s/apps/reposproducer/expstate/%s/" % (source, self.exp.id)) \
+            .replace_with(get_exp_state)
+
+        from tardis.apps.reposconsumer.tasks import transfer_experiment
+        self.assertEquals(transfer_experiment(source), [])
+        skipped = SkippedExperiment.objects.get(source=source,
+                                                exp_id=str(self.exp.id))
+        self.assertEquals(skipped.reason, 'private')
+        self.assertEquals(skipped.datestamp, datetime(2012, 11, 27))
+
+        # the unchanged record is left alone
+        self.assertEquals(transfer_experiment(source), [])
+        self.assertEquals(len(states), 1)
+
+        # and ingested once it is due and public
+        skipped.recheck_after = datetime(2012, 11, 27)
+        skipped.save()
+        public_access[0] = Experiment.PUBLIC_ACCESS_FULL
+        self.assertEquals(len(transfer_experiment(source)), 1)
+        self.assertEquals(SkippedExperiment.objects.count(), 0)
+
+    def test_missing_key_skipped(self):
+        source = "http://127.0.0.1:9000"
+        self._setup_mocks(source)
+        flexmock(tasks).should_receive('getURL').with_args(
+            "%s/apps/reposproducer/key/%s/" % (source, self.exp.id)) \
+            .and_return('')
+
+        from tardis.apps.reposconsumer.tasks import ingest_experiment
+        self.assertEquals(ingest_experiment(source, str(self.exp.id),
+            str(self.user1.id), datetime(2012, 11, 27)), None)
+        skipped = SkippedExperiment.objects.get(source=source,
+                                                exp_id=str(self.exp.id))
+        self.assertEquals(skipped.reason, 'no key')
+
+    def test_unchanged_not_fetched(self):
+        """
+        An experiment already ingested from an unchanged record costs no
+        requests or writes
+        """
+        source = "http://127.0.0.1:9000"
+        self._setup_mocks(source)
+
+        from tardis.apps.reposconsumer.tasks import transfer_experiment
+        local_ids = transfer_experiment(source)
+        ingested = IngestedExperiment.objects.get(source=source,
+                                                  exp_id=str(self.exp.id))
+        self.assertEquals(ingested.experiment_id, local_ids[0])
+        self.assertEquals(ingested.datestamp, datetime(2012, 11, 27))
+        self.assertEquals(ingested.mets_digest, md5(open(path.join(
+            path.dirname(__file__), 'mets.xml')).read()).hexdigest())
+
+        flexmock(tasks).should_receive('ExperimentFetch').never()
+        self.assertEquals(transfer_experiment(source), [])
+        self.assertEquals(IngestedExperiment.objects.get(
+            pk=ingested.pk).updated, ingested.updated)
+
+    def test_run_summary(self):
+        """
+        Each run is recorded with its counts and stage timings, and sent
+        to the metrics sink
+        """
+        source = "http://127.0.0.1:9000"
+        self._setup_mocks(source)
+        sink = MemorySink()
+        previous = get_sink()
+        set_sink(sink)
+        try:
+            summary = {}
+            tasks.transfer_experiment(source, summary)
+            tasks.transfer_experiment(source)
+        finally:
+            set_sink(previous)
+
+        first, second = HarvestRun.objects.filter(source=source) \
+            .order_by('started')
+        self.assertEquals(summary['run'], first)
+        self.assertEquals((first.records, first.ingested, first.unchanged),
+                          (1, 1, 0))
+        self.assertEquals((second.records, second.ingested,
+                           second.unchanged), (1, 0, 1))
+        self.assertEquals(first.error, '')
+        stages = json.loads(first.stages)
+        for stage in ('identify', 'list_records', 'fetch_wait', 'mets',
+                      'parse_mets', 'datafiles', 'ingest'):
+            self.assertTrue(stages[stage]['count'] > 0, stage)
+        self.assertEquals(stages['ingest']['count'], 1)
+        self.assertEquals(sink.counters['127_0_0_1_9000.ingested'], 1)
+        self.assertEquals(len(sink.summaries), 2)
+
+    def test_changed_duplicate_flagged(self):
+        source = "http://127.0.0.1:9000"
+        self._setup_mocks(source)
+        key_schema = Schema.objects.get(namespace=settings.KEY_NAMESPACE)
+        key_name = ParameterName.objects.get(name=settings.KEY_NAME)
+        eps = ExperimentParameterSet(experiment=self.exp, schema=key_schema)
+        eps.save()
+        ExperimentParameter(parameterset=eps, name=key_name,
+            string_value="sdgfkhagkuashiuatihaghs7igtyweatihawtuhatjkhzsdg").save()
+
+        # a duplicate without a fingerprint gets one
+        from tardis.apps.reposconsumer.tasks import transfer_experiment
+        self.assertEquals(transfer_experiment(source), [])
+        ingested = IngestedExperiment.objects.get(source=source,
+                                                  exp_id=str(self.exp.id))
+        self.assertEquals(ingested.experiment_id, self.exp.id)
+        self.assertFalse(ingested.changed)
+
+        # which is flagged when the record has changed since
+        FingerprintIndex(source).record(str(self.exp.id), self.exp.id,
+            ingested.key_value, datetime(2012, 11, 1))
+        self.assertEquals(transfer_experiment(source), [])
+        self.assertTrue(IngestedExperiment.objects.get(
+            pk=ingested.pk).changed)
+
     def test_mets_fails(self):
         source = "http://127.0.0.1:9000"
         self._setup_mocks(source)
@@ -352,3 +546,367 @@ class TransferExpTest(TestCase):
             pass
         else:
             self.assertTrue(False, "Expected MetsParseError")
+
+    def _setup_list_records(self, source, **args):
+        metadata_fake = flexmock()
+        metadata_fake.should_receive('getField') \
+            .with_args('identifier') \
+            .and_return([str(self.exp.id)])
+        metadata_fake.should_receive('getField') \
+            .with_args('creator') \
+            .and_return([str(self.user1.id)])
+        header_fake = flexmock(isDeleted=lambda: False,
+                               datestamp=lambda: datetime(2012, 11, 27))
+        identify_fake1 = flexmock(baseURL=lambda:
+            "http://127.0.0.1:9000/apps/oaimph")
+        fake = flexmock(identify=lambda: identify_fake1,
+                        getNamespaces=lambda: {'oai': OAI_NS},
+                        buildRecords=lambda prefix, ns, registry, tree:
+                             ([(header_fake, metadata_fake, None)], None))
+        fake.should_receive('makeRequestErrorHandling') \
+            .with_args(verb='ListRecords', **args) \
+            .and_return(etree.XML(LIST_RECORDS_RESPONSE)).once()
+        flexmock(oaipmhclient).new_instances(fake)
+
+    def test_incremental_harvest(self):
+        source = "http://127.0.0.1:9000"
+        self._setup_mocks(source)
+        self._setup_list_records(source, metadataPrefix='oai_dc')
+
+        from tardis.apps.reposconsumer.tasks import transfer_experiment
+        local_ids = transfer_experiment(source)
+        self.assertEquals(len(local_ids), 1)
+
+        state = HarvestState.objects.get(source=source)
+        self.assertEquals(state.last_datestamp, datetime(2012, 11, 28, 1, 2, 3))
+        self.assertEquals(state.resumption_token, '')
+        self.assertEquals(state.harvest_started, None)
+
+        # next run only asks for changes since the last
+        clear_caches()
+        self._setup_list_records(source, metadataPrefix='oai_dc',
+                                 **{'from': '2012-11-28T01:02:03Z'})
+        transfer_experiment(source)
+
+    def test_identity_cached(self):
+        """
+        Later runs reuse the OAI-PMH clients, without checking the identity
+        of the source again
+        """
+        source = "http://127.0.0.1:9000"
+        self._setup_mocks(source)
+        from tardis.apps.reposconsumer.tasks import transfer_experiment
+        self.assertEquals(len(transfer_experiment(source)), 1)
+
+        fake = flexmock()
+        fake.should_receive('identify').never()
+        flexmock(oaipmhclient).new_instances(fake)
+        self.assertEquals(transfer_experiment(source), [])
+
+    def test_resume_harvest(self):
+        source = "http://127.0.0.1:9000"
+        HarvestState(source=source, resumption_token='token1',
+                     harvest_started=datetime(2012, 11, 20)).save()
+        self._setup_mocks(source)
+        self._setup_list_records(source, resumptionToken='token1')
+
+        from tardis.apps.reposconsumer.tasks import transfer_experiment
+        local_ids = transfer_experiment(source)
+        self.assertEquals(len(local_ids), 1)
+
+        state = HarvestState.objects.get(source=source)
+        self.assertEquals(state.last_datestamp, datetime(2012, 11, 20))
+        self.assertEquals(state.resumption_token, '')
+
+    def test_streamed_pages(self):
+        """
+        Records are ingested as each page arrives, so a failure fetching a
+        later page keeps the work done and the place reached
+        """
+        source = "http://127.0.0.1:9000"
+        self._setup_mocks(source)
+        client = flexmock(identify=lambda: flexmock(baseURL=lambda:
+                              "http://127.0.0.1:9000/apps/oaimph"),
+                          getNamespaces=lambda: {'oai': OAI_NS})
+        metadata_fake = flexmock()
+        metadata_fake.should_receive('getField') \
+            .with_args('identifier').and_return([str(self.exp.id)])
+        metadata_fake.should_receive('getField') \
+            .with_args('creator').and_return([str(self.user1.id)])
+        header_fake = flexmock(isDeleted=lambda: False,
+                               datestamp=lambda: datetime(2012, 11, 27))
+        client.should_receive('buildRecords') \
+            .and_return(([(header_fake, metadata_fake, None)], 'token1'))
+        client.should_receive('makeRequestErrorHandling') \
+            .with_args(verb='ListRecords', metadataPrefix='oai_dc') \
+            .and_return(etree.XML(LIST_RECORDS_RESPONSE))
+        client.should_receive('makeRequestErrorHandling') \
+            .with_args(verb='ListRecords', resumptionToken='token1') \
+            .and_raise(AttributeError)
+        flexmock(oaipmhclient).new_instances(client)
+
+        from tardis.apps.reposconsumer.tasks import transfer_experiment
+        try:
+            transfer_experiment(source)
+        except OAIPMHError:
+            pass
+        else:
+            self.assertTrue(False, "Expected OAIPMHError")
+
+        self.assertEquals(Experiment.objects.filter(title="test1").count(), 1)
+        state = HarvestState.objects.get(source=source)
+        self.assertEquals(state.resumption_token, 'token1')
+        self.assertEquals(state.last_datestamp, None)
+
+    def test_ingest_experiment_task(self):
+        source = "http://127.0.0.1:9000"
+        self._setup_mocks(source)
+
+        from tardis.apps.reposconsumer.tasks import ingest_experiment
+        local_id = ingest_experiment(source, str(self.exp.id),
+                                     str(self.user1.id))
+        exp = Experiment.objects.get(id=local_id)
+        self.assertEquals(exp.title, "test1")
+
+        # a local experiment already has the key, so is not ingested again
+        key_schema = Schema.objects.get(namespace=settings.KEY_NAMESPACE)
+        key_name = ParameterName.objects.get(name=settings.KEY_NAME)
+        eps = ExperimentParameterSet(experiment=exp, schema=key_schema)
+        eps.save()
+        ExperimentParameter(parameterset=eps, name=key_name,
+            string_value="sdgfkhagkuashiuatihaghs7igtyweatihawtuhatjkhzsdg").save()
+        self.assertEquals(ingest_experiment(source, str(self.exp.id),
+                                            str(self.user1.id)), None)
+
+    def test_batch_run(self):
+        """
+        State, acls and key come from one batch request when the source
+        offers them
+        """
+        source = "http://127.0.0.1:9000"
+        self._setup_mocks(source, batch=True)
+        flexmock(tasks).should_receive('getURL').with_args(
+            "%s/apps/reposproducer/batch/?ids=%s" % (source, self.exp.id)) \
+            .and_return('{"%s": {"expstate": %s, "acls": [\
+                {"pluginId": "django_user", "isOwner": true, "entityId": "1"},\
+                {"pluginId": "django_user", "isOwner": true, "entityId": "2"}],\
+                "key": "sdgfkhagkuashiuatihaghs7igtyweatihawtuhatjkhzsdg"}}'
+                % (self.exp.id, Experiment.PUBLIC_ACCESS_FULL)).once()
+        for endpoint in ('expstate', 'acls', 'key'):
+            flexmock(tasks).should_receive('getURL').with_args(
+                "%s/apps/reposproducer/%s/%s/"
+                % (source, endpoint, self.exp.id)).never()
+
+        from tardis.apps.reposconsumer.tasks import transfer_experiment
+        local_ids = transfer_experiment(source)
+        self.assertEquals(len(local_ids), 1)
+        exp = Experiment.objects.get(id=local_ids[0])
+        self.assertEquals(exp.title, "test1")
+        self.assertEquals(ExperimentACL.objects.filter(pluginId=django_user,
+                                   experiment__id=exp.id,
+                                   aclOwnershipType=ExperimentACL.OWNER_OWNED).count(), 2)
+
+    def test_batch_missing_experiment(self):
+        source = "http://127.0.0.1:9000"
+        self._setup_mocks(source, batch=True)
+        flexmock(tasks).should_receive('getURL').with_args(
+            "%s/apps/reposproducer/batch/?ids=%s" % (source, self.exp.id)) \
+            .and_return('{}')
+
+        from tardis.apps.reposconsumer.tasks import transfer_experiment
+        try:
+            transfer_experiment(source)
+        except BadAccessError:
+            pass
+        else:
+            self.assertTrue(False, "Expected BadAccessError")
+
+    def test_harvest_complete(self):
+        source = "http://127.0.0.1:9000"
+        HarvestState(source=source, resumption_token='token1',
+                     harvest_started=datetime(2012, 11, 20)).save()
+
+        from tardis.apps.reposconsumer.tasks import harvest_complete
+        local_ids = harvest_complete([3, None, 4], source,
+                                     datetime(2012, 11, 20))
+        self.assertEquals(local_ids, [3, 4])
+        state = HarvestState.objects.get(source=source)
+        self.assertEquals(state.last_datestamp, datetime(2012, 11, 20))
+        self.assertEquals(state.resumption_token, '')
+
+    def test_missing_key_schema(self):
+        """
+        Missing key configuration fails before the source is contacted
+        """
+        source = "http://127.0.0.1:9000"
+        fake = flexmock()
+        fake.should_receive('identify').never()
+        flexmock(oaipmhclient).new_instances(fake)
+        flexmock(tasks).should_receive('getURL').never()
+
+        from tardis.apps.reposconsumer.tasks import transfer_experiment
+        try:
+            transfer_experiment(source)
+        except BadAccessError:
+            pass
+        else:
+            self.assertTrue(False, "Expected BadAccessError")
+
+    def test_key_parameter_cached(self):
+        source = "http://127.0.0.1:9000"
+        self._setup_mocks(source)
+        key_schema, key_name = tasks._get_key_parameter()
+        with self.assertNumQueries(0):
+            self.assertEquals(tasks._get_key_parameter(),
+                              (key_schema, key_name))
+        # changing the schema invalidates the cache
+        key_schema.name = "Renamed Experiment Key"
+        key_schema.save()
+        with self.assertNumQueries(2):
+            self.assertEquals(tasks._get_key_parameter()[0].name,
+                              "Renamed Experiment Key")
+
+
+class ProducerHarvestTest(TestCase):
+    """
+    Harvests over OAI-PMH and HTTP from a local producer
+    """
+
+    def setUp(self):
+        clear_caches()
+        schema, _ = Schema.objects.get_or_create(
+            namespace=settings.KEY_NAMESPACE, name="Experiment Key")
+        ParameterName.objects.get_or_create(schema=schema,
+                                            name=settings.KEY_NAME)
+        self.producer = FakeProducer(experiments=5, page_size=2)
+        self.source = self.producer.start()
+
+    def tearDown(self):
+        self.producer.stop()
+
+    def test_paged_harvest(self):
+        local_ids = tasks.transfer_experiment(self.source)
+        self.assertEquals(len(local_ids), 5)
+        # three pages, followed by resumption tokens
+        self.assertEquals(self.producer.list_requests, 3)
+        self.assertEquals(self.producer.mets_requests, 5)
+        state = HarvestState.objects.get(source=self.source)
+        self.assertEquals(state.resumption_token, '')
+        self.assertTrue(state.last_datestamp > self.producer.datestamp(5))
+        self.assertEquals(Experiment.objects.get(id=local_ids[0]).title,
+                          "test1")
+
+        # nothing has changed since
+        self.assertEquals(tasks.transfer_experiment(self.source), [])
+        self.assertEquals(self.producer.list_requests, 4)
+        self.assertEquals(self.producer.mets_requests, 5)
+
+    def test_overlapping_run(self):
+        """
+        A run is skipped while another harvest of its source holds the
+        harvest lock, and holds that lock itself while running
+        """
+        lock = HarvestLock(self.source)
+        self.assertTrue(lock.acquire())
+        try:
+            self.assertEquals(tasks.transfer_experiment(self.source), None)
+        finally:
+            lock.release()
+        self.assertEquals(self.producer.list_requests, 0)
+
+        holders = []
+        ingest_experiments = tasks._ingest_experiments
+
+        def ingest(*args):
+            holders.append(HarvestLock(self.source).held_by())
+            return ingest_experiments(*args)
+
+        flexmock(tasks).should_receive('_ingest_experiments') \
+            .replace_with(ingest)
+        self.assertEquals(len(tasks.transfer_experiment(self.source)), 5)
+        self.assertTrue(holders[0])
+        self.assertFalse(lock.is_locked())
+
+    def test_fanout_failed_subtask(self):
+        """
+        In fan-out mode nothing is recorded as harvested, and the harvest
+        lock is held, until the chord callback runs
+        """
+        from celery.task import chords
+        dispatched = []
+
+        class FakeChord(object):
+
+            def __init__(self, subtasks):
+                self.subtasks = list(subtasks)
+
+            def __call__(self, callback):
+                self.callback = callback
+                dispatched.append(self)
+                return flexmock(task_id="chord%s" % len(dispatched))
+
+        flexmock(chords).should_receive('chord').replace_with(FakeChord)
+        with self.settings(REPOS_CONSUMER_FANOUT=True):
+            self.assertEquals(tasks.harvest_source(self.source), "chord1")
+            self.assertEquals(len(dispatched[0].subtasks), 5)
+            # listed over three pages, but no token is kept
+            self.assertEquals(self.producer.list_requests, 3)
+            state = HarvestState.objects.get(source=self.source)
+            self.assertEquals(state.resumption_token, '')
+            self.assertEquals(state.last_datestamp, None)
+            lock = HarvestLock(self.source)
+            self.assertTrue(lock.is_locked())
+            self.assertEquals(tasks.harvest_source(self.source), None)
+
+            # a subtask failed, so the callback never ran: once the lock
+            # lapses, every record is listed again
+            cache.delete(lock.lock_id)
+            self.assertEquals(tasks.harvest_source(self.source), "chord2")
+            self.assertEquals(len(dispatched[1].subtasks), 5)
+
+            callback = dispatched[1].callback
+            self.assertEquals(tasks.harvest_complete([3, None],
+                                                     *callback.args), [3])
+        state = HarvestState.objects.get(source=self.source)
+        self.assertTrue(state.last_datestamp > self.producer.datestamp(5))
+        self.assertFalse(lock.is_locked())
+
+
+class ExperimentFetchTest(unittest.TestCase):
+    """
+    Fetches against a local producer, with and without batch requests
+    """
+
+    def _fetch(self, batch):
+        producer = FakeProducer(experiments=5, batch=batch)
+        source = producer.start()
+        try:
+            clear_caches()
+            batch_size = tasks._get_batch_size(source)
+            results = []
+            with FetchPool(2) as pool:
+                exp_ids = [str(i) for i in range(1, 6)]
+                batch_result = None
+                if batch_size:
+                    batch_result = pool.submit(tasks._get_exp_batch, source,
+                                               exp_ids)
+                for exp_id in exp_ids:
+                    fetch = tasks.ExperimentFetch(pool, source, exp_id, "1",
+                                                  batch=batch_result)
+                    results.append((fetch.exp_state.result(),
+                                    fetch.owners.result(),
+                                    fetch.key.result()))
+            return batch_size, producer, results
+        finally:
+            producer.stop()
+
+    def test_batch_fallback(self):
+        batch_size, producer, per_id = self._fetch(batch=False)
+        self.assertEquals(batch_size, 0)
+        self.assertEquals(producer.batch_requests, 0)
+
+        batch_size, producer, batched = self._fetch(batch=True)
+        self.assertTrue(batch_size > 0)
+        self.assertEquals(producer.batch_requests, 1)
+        self.assertEquals(batched, per_id)
+        self.assertEquals(batched[0][2], "key-1")
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012, RMIT eResearch Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2012, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase
+from tardis.tardis_portal.models import Experiment, Schema, ParameterName
+from tardis.tardis_portal.models import ExperimentParameterSet, ExperimentParameter
+from tardis.apps.reposconsumer.keys import ExperimentKeyIndex, find_experiment_by_key
+from tardis.apps.reposconsumer.models import KEY_PARAMETER_VERSION
+
+
+class ExperimentKeyIndexTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='tom')
+        self.key_schema, _ = Schema.objects.get_or_create(
+            namespace=settings.KEY_NAMESPACE, name="Experiment Key")
+        self.key_name, _ = ParameterName.objects.get_or_create(
+            schema=self.key_schema, name=settings.KEY_NAME)
+        self.exps = []
+        for i in range(3):
+            exp = Experiment(title='exp%s' % i, created_by=self.user)
+            exp.save()
+            eps = ExperimentParameterSet(experiment=exp,
+                                         schema=self.key_schema)
+            eps.save()
+            ExperimentParameter(parameterset=eps, name=self.key_name,
+                                string_value="key%s" % i).save()
+            self.exps.append(exp)
+
+    def _add_key(self, exp, key_value):
+        eps = ExperimentParameterSet(experiment=exp, schema=self.key_schema)
+        eps.save()
+        ExperimentParameter(parameterset=eps, name=self.key_name,
+                            string_value=key_value).save()
+
+    def test_key_parameter_version(self):
+        """
+        Changing the key parameter in any process, without the tasks
+        loaded, tells workers to resolve it again
+        """
+        version = cache.get(KEY_PARAMETER_VERSION)
+        self.key_name.delete()
+        deleted = cache.get(KEY_PARAMETER_VERSION)
+        self.assertNotEquals(deleted, version)
+        ParameterName.objects.create(schema=self.key_schema,
+                                     name=settings.KEY_NAME)
+        self.assertNotEquals(cache.get(KEY_PARAMETER_VERSION), deleted)
+
+    def test_find_by_key(self):
+        with self.assertNumQueries(1):
+            exp_id = find_experiment_by_key(self.key_schema, self.key_name,
+                                            "key1")
+        self.assertEquals(exp_id, self.exps[1].id)
+        self.assertEquals(find_experiment_by_key(self.key_schema,
+            self.key_name, "nokey"), None)
+
+    def test_preloaded_index(self):
+        index = ExperimentKeyIndex(self.key_schema, self.key_name)
+        with self.assertNumQueries(1):
+            for i, exp in enumerate(self.exps):
+                self.assertEquals(index.lookup("key%s" % i), exp.id)
+            self.assertEquals(index.lookup("nokey"), None)
+
+    def test_unloaded_index(self):
+        index = ExperimentKeyIndex(self.key_schema, self.key_name,
+                                   preload=False)
+        with self.assertNumQueries(2):
+            self.assertEquals(index.lookup("key0"), self.exps[0].id)
+            self.assertEquals(index.lookup("nokey"), None)
+
+    def test_refresh(self):
+        index = ExperimentKeyIndex(self.key_schema, self.key_name)
+        self.assertEquals(index.lookup("key3"), None)
+        exp = Experiment(title='exp3', created_by=self.user)
+        exp.save()
+        self._add_key(exp, "key3")
+        self.assertEquals(index.lookup("key3"), None)
+        self.assertEquals(index.lookup("key3", refresh=True), exp.id)
+        with self.assertNumQueries(0):
+            self.assertEquals(index.lookup("key3"), exp.id)
+
+    def test_add(self):
+        index = ExperimentKeyIndex(self.key_schema, self.key_name)
+        self.assertEquals(index.lookup("newkey"), None)
+        index.add("newkey", 99)
+        self.assertEquals(index.lookup("newkey"), 99)
+        # existing keys are not overridden
+        index.add("key0", 99)
+        self.assertEquals(index.lookup("key0"), self.exps[0].id)
+
+    def test_duplicate_key(self):
+        """
+        A key held by several experiments is found in the first of them,
+        whichever had the key recorded first
+        """
+        first = Experiment(title='first', created_by=self.user)
+        first.save()
+        second = Experiment(title='second', created_by=self.user)
+        second.save()
+        self._add_key(second, "dupkey")
+        self._add_key(first, "dupkey")
+        index = ExperimentKeyIndex(self.key_schema, self.key_name)
+        self.assertEquals(index.lookup("dupkey"), first.id)
+        self.assertEquals(find_experiment_by_key(self.key_schema,
+            self.key_name, "dupkey"), first.id)
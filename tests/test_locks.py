@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012, RMIT eResearch Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2012, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import time
+from django.test import TestCase
+from tardis.apps.reposconsumer.locks import ExperimentLock, lock_stats
+
+
+class ExperimentLockTest(TestCase):
+
+    source = "http://127.0.0.1:9000"
+
+    def test_contention(self):
+        stats = lock_stats()
+        lock1 = ExperimentLock(self.source, "key1")
+        lock2 = ExperimentLock(self.source, "key1")
+        other = ExperimentLock(self.source, "key2")
+        other_source = ExperimentLock("http://127.0.0.1:9001", "key1")
+        try:
+            self.assertTrue(lock1.acquire())
+            self.assertFalse(lock2.acquire())
+            self.assertTrue(other.acquire())
+            self.assertTrue(other_source.acquire())
+        finally:
+            lock1.release()
+            other.release()
+            other_source.release()
+        self.assertTrue(lock2.acquire())
+        lock2.release()
+
+        new_stats = lock_stats()
+        self.assertEquals(new_stats['acquired'] - stats['acquired'], 4)
+        self.assertEquals(new_stats['contended'] - stats['contended'], 1)
+
+    def test_release_only_own_lease(self):
+        lock1 = ExperimentLock(self.source, "key1", expire=1)
+        lock2 = ExperimentLock(self.source, "key1")
+        self.assertTrue(lock1.acquire())
+        lock1._stop.set()
+        lock1._renewer.join()
+        time.sleep(1.5)
+        self.assertTrue(lock2.acquire())
+        lock1.release()
+        self.assertTrue(lock2.holds())
+        lock2.release()
+        self.assertFalse(lock2.holds())
+
+    def test_renewal(self):
+        lock = ExperimentLock(self.source, "key1", expire=1)
+        self.assertTrue(lock.acquire())
+        try:
+            time.sleep(2)
+            self.assertTrue(lock.holds())
+        finally:
+            lock.release()
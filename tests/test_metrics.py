@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012, RMIT eResearch Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2012, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import json
+import socket
+from flexmock import flexmock
+from django.test import TestCase
+from tardis.apps.reposconsumer.locks import ExperimentLock
+from tardis.apps.reposconsumer.metrics import MemorySink, MetricsSink, Run, \
+    StatsdSink, get_sink, percentile, set_sink
+from tardis.apps.reposconsumer.models import HarvestRun
+from tardis.apps.reposconsumer.transport import get_session
+
+
+class RunTest(TestCase):
+
+    source = "http://127.0.0.1:9000"
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEquals(percentile(values, 0.5), 51)
+        self.assertEquals(percentile(values, 0.99), 100)
+        self.assertEquals(percentile([3], 0.99), 3)
+        self.assertEquals(percentile([], 0.5), None)
+
+    def test_stages_and_counters(self):
+        sink = MemorySink()
+        run = Run(self.source, sink)
+        with run.stage('mets'):
+            pass
+        run.time('mets', 2.0)
+        run.incr('ingested')
+        run.incr('records', 3)
+        try:
+            with run.stage('parse_mets'):
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEquals(len(sink.timings['127_0_0_1_9000.mets']), 2)
+        self.assertEquals(len(sink.timings['127_0_0_1_9000.parse_mets']), 1)
+        self.assertEquals(sink.counters['127_0_0_1_9000.records'], 3)
+
+        summary = run.finish("ReposReadError: gone")
+        summary = HarvestRun.objects.get(pk=summary.pk)
+        self.assertEquals((summary.records, summary.ingested,
+                           summary.failed), (3, 1, 0))
+        self.assertEquals(summary.error, "ReposReadError: gone")
+        self.assertEquals(summary.queries, None)
+        stages = json.loads(summary.stages)
+        self.assertEquals(stages['mets']['count'], 2)
+        self.assertEquals(stages['mets']['max'], 2.0)
+        self.assertTrue(stages['mets']['total'] >= 2.0)
+        self.assertEquals(sink.summaries[0][0], '127_0_0_1_9000')
+        self.assertEquals(sink.summaries[0][1]['ingested'], 1)
+
+    def test_count_queries(self):
+        run = Run(self.source, MetricsSink(), count_queries=True)
+        with run.stage('ingest'):
+            HarvestRun.objects.count()
+            # counted once, by the outer stage
+            with run.stage('key_lookup'):
+                HarvestRun.objects.count()
+        self.assertEquals(run.queries, 2)
+        self.assertEquals(run.finish().queries, 2)
+
+    def test_bytes(self):
+        flexmock(get_session()).should_receive('host_stats') \
+            .and_return({'127.0.0.1:9000': {'bytes_received': 100,
+                                            'bytes_decoded': 150}}) \
+            .and_return({'127.0.0.1:9000': {'bytes_received': 400,
+                                            'bytes_decoded': 1150}}) \
+            .one_by_one()
+        summary = Run(self.source, MetricsSink()).finish()
+        self.assertEquals((summary.bytes_received, summary.bytes_decoded),
+                          (300, 1000))
+
+    def test_lock_counts(self):
+        run = Run(self.source, MetricsSink())
+        lock = ExperimentLock(self.source, "key1")
+        self.assertTrue(lock.acquire())
+        try:
+            self.assertFalse(ExperimentLock(self.source, "key1").acquire())
+        finally:
+            lock.release()
+        summary = run.finish()
+        self.assertEquals((summary.locks_acquired, summary.locks_contended,
+                           summary.locks_lost), (1, 1, 0))
+
+    def test_run_history(self):
+        with self.settings(REPOS_CONSUMER_RUN_HISTORY=2):
+            Run(self.source, MetricsSink()).finish()
+            Run("http://127.0.0.1:9001", MetricsSink()).finish()
+            second = Run(self.source, MetricsSink()).finish()
+            third = Run(self.source, MetricsSink()).finish()
+        self.assertEquals(sorted(HarvestRun.objects.filter(source=self.source)
+                                 .values_list('pk', flat=True)),
+                          [second.pk, third.pk])
+        # other sources are kept apart
+        self.assertEquals(HarvestRun.objects.exclude(
+            source=self.source).count(), 1)
+
+
+class SinkTest(TestCase):
+
+    def test_statsd(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5)
+        sink = StatsdSink(port=server.getsockname()[1], prefix='test')
+        try:
+            sink.timing('host.mets', 0.25)
+            self.assertEquals(server.recv(512), "test.host.mets:250|ms")
+            sink.incr('host.ingested', 2)
+            self.assertEquals(server.recv(512), "test.host.ingested:2|c")
+            sink.summary('host', {'records': 4, 'queries': None})
+            self.assertEquals(server.recv(512), "test.host.last_records:4|g")
+        finally:
+            server.close()
+
+    def test_configured_sink(self):
+        previous = get_sink()
+        try:
+            with self.settings(REPOS_CONSUMER_METRICS={
+                    'sink': 'tardis.apps.reposconsumer.metrics.StatsdSink',
+                    'port': 8126, 'queries': True}):
+                set_sink(None)
+                sink = get_sink()
+                self.assertTrue(isinstance(sink, StatsdSink))
+                self.assertEquals(sink.address, ('127.0.0.1', 8126))
+                self.assertTrue(Run("http://127.0.0.1:9000").count_queries)
+        finally:
+            set_sink(previous)
@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012, RMIT eResearch Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2012, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+from flexmock import flexmock
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.test import TestCase
+from fakeproducer import FakeProducer
+from querybudget import QueryLog, assert_within_budget, classify, \
+    normalise, report
+from tardis.tardis_portal.models import Experiment, Schema, ParameterName
+from tardis.tardis_portal.models import ExperimentParameterSet, ExperimentParameter
+from tardis.apps.reposconsumer import tasks
+from tardis.apps.reposconsumer.caches import clear_caches
+
+# The queries one ingest issues itself, counted along _ingest_experiment
+# with Django 1.4 on SQLite, once its users are known and the key index is
+# loaded, as for every ingest of a run after the first:
+#
+#   SELECT the creator and owners, together               1
+#   SELECT the key again, under the experiment's lock     1
+#   INSERT the placeholder experiment                     1
+#   SELECT the existing owner ACLs, INSERT the new ones   2
+#   SELECT the parsed experiment, UPDATE its datafiles    2
+#   save its description (Django 1.4: SELECT, UPDATE)     2
+#   INSERT its fingerprint                                1
+#
+# The METS parser of tardis_portal is logged apart (see PARSER_PER_DATAFILE).
+# Nothing the ingest issues itself depends on how many owners, datafiles
+# or local experiments there are.
+INGEST_BASE = 10
+PER_OWNER = 0
+PER_DATAFILE = 0
+PER_LOCAL_EXPERIMENT = 0
+
+# The queries of a run outside its ingests, counted the same way, for a
+# new source and the key parameter not yet cached:
+#
+#   SELECT the key Schema and ParameterName               2
+#   SELECT and INSERT the HarvestState                    2
+#   SELECT the skipped and ingested experiments           2
+#   SELECT the high-water mark, COUNT the backlog,
+#   INSERT the HarvestRun and SELECT the oldest to keep   4
+#   save the harvest state after each page (SELECT, UPDATE)   2 per page
+RUN_BASE = 10
+PER_PAGE = 2
+
+# The METS parser inserts one Dataset_File per datafile
+PARSER_PER_DATAFILE = 1
+
+# Allowed over each budget, for signal handlers of the installed
+# tardis_portal and SAVEPOINT statements on databases that log them
+MARGIN = 2
+
+# every experiment of the fake producer has two owners
+OWNERS = 2
+
+
+def ingest_budget(owners):
+    """
+    Returns the queries an ingest of an experiment of owners owners may
+    issue itself
+    """
+    return INGEST_BASE + PER_OWNER * owners + MARGIN
+
+
+def run_budget(pages):
+    """
+    Returns the queries a run of pages pages may issue outside its ingests
+    """
+    return RUN_BASE + PER_PAGE * pages + MARGIN
+
+
+class QueryLogTest(TestCase):
+
+    def test_classify(self):
+        self.assertEquals(classify('SELECT "a"."id" FROM "a" WHERE "a"."id" = 1'),
+                          'SELECT a')
+        self.assertEquals(classify('INSERT INTO "b" ("x") VALUES (2)'),
+                          'INSERT b')
+        self.assertEquals(classify('UPDATE "c" SET "x" = 3'), 'UPDATE c')
+        self.assertEquals(classify('SAVEPOINT s1'), 'SAVEPOINT')
+
+    def test_normalise(self):
+        self.assertEquals(
+            normalise("SELECT x FROM a WHERE id = 12 AND name = 'it''s'"),
+            normalise("SELECT x FROM a WHERE id = 3 AND name = 'other'"))
+        self.assertEquals(normalise("SELECT x FROM a WHERE id IN (1, 2, 3)"),
+                          "SELECT x FROM a WHERE id IN (...)")
+
+    def test_budget(self):
+        user = User.objects.create(username='tom')
+        with QueryLog() as log:
+            for i in range(3):
+                User.objects.get(id=user.id)
+            mark = log.mark()
+            User.objects.count()
+        self.assertEquals(len(log.statements), 4)
+        self.assertEquals(len(log.statements[mark:]), 1)
+        assert_within_budget(self, log.statements, 4, "the loop")
+        try:
+            assert_within_budget(self, log.statements, 3, "the loop")
+        except AssertionError as e:
+            message = str(e)
+        else:
+            self.fail("budget not enforced")
+        self.assertTrue("4 queries, over its budget of 3" in message)
+        # the repeated statement is shown first
+        self.assertTrue("    3 x SELECT" in message)
+        self.assertTrue("    4 SELECT auth_user" in report(log.statements))
+
+
+class IngestBudgetTest(TestCase):
+    """
+    Holds ingests from a local producer to their query budgets
+    """
+
+    def setUp(self):
+        clear_caches()
+        self.user = User.objects.create(username='local')
+        self.key_schema, _ = Schema.objects.get_or_create(
+            namespace=settings.KEY_NAMESPACE, name="Experiment Key")
+        self.key_name, _ = ParameterName.objects.get_or_create(
+            schema=self.key_schema, name=settings.KEY_NAME)
+
+        # log the statements of each ingest of the current harvest, and
+        # of the METS parser within it
+        ingest_experiment = tasks._ingest_experiment
+        parse_mets = tasks.parseMets
+
+        def counted(*args):
+            start = self.log.mark()
+            self.parsed = (start, start)
+            try:
+                return ingest_experiment(*args)
+            finally:
+                statements = self.log.statements
+                parse_start, parse_end = self.parsed
+                self.ingests.append(statements[start:parse_start]
+                                    + statements[parse_end:])
+                self.parses.append(statements[parse_start:parse_end])
+                self.windows.append((start, len(statements)))
+
+        def parsed(*args):
+            start = self.log.mark()
+            try:
+                return parse_mets(*args)
+            finally:
+                self.parsed = (start, self.log.mark())
+
+        flexmock(tasks).should_receive('_ingest_experiment') \
+            .replace_with(counted)
+        flexmock(tasks).should_receive('parseMets').replace_with(parsed)
+
+    def _add_local_experiments(self, count):
+        for i in range(count):
+            exp = Experiment.objects.create(title='local%s' % i,
+                                            created_by=self.user)
+            eps = ExperimentParameterSet.objects.create(experiment=exp,
+                schema=self.key_schema)
+            ExperimentParameter.objects.create(parameterset=eps,
+                name=self.key_name, string_value="local%s" % i)
+
+    def _harvest(self, name, experiments, datafiles, page_size=100):
+        """
+        Harvests a producer of experiments of datafiles datafiles,
+        returning the statements of the run outside its ingests, and those
+        each ingest issued itself and through the METS parser
+        """
+        producer = FakeProducer(experiments=experiments, page_size=page_size,
+                                datafiles=datafiles, key_prefix=name)
+        source = producer.start()
+        self.ingests = []
+        self.parses = []
+        self.windows = []
+        try:
+            with QueryLog() as self.log:
+                local_ids = tasks.transfer_experiment(source)
+        finally:
+            producer.stop()
+        self.assertEquals(len(local_ids), experiments)
+        outside = []
+        end = 0
+        for start, next_end in self.windows + [(None, None)]:
+            outside.extend(self.log.statements[end:start])
+            end = next_end
+        return outside, self.ingests, self.parses
+
+    def test_ingest_budget(self):
+        self._add_local_experiments(20)
+        statements, ingests, parses = self._harvest("budget", 5, 10,
+                                                    page_size=2)
+        # the first also creates the users and loads the key index
+        for i, ingest in enumerate(ingests[1:]):
+            assert_within_budget(self, ingest, ingest_budget(OWNERS),
+                                 "ingest of experiment %s" % (i + 2))
+        assert_within_budget(self, statements, run_budget(3),
+                             "harvest of 5 experiments, outside its ingests")
+
+    def test_datafiles(self):
+        statements, ingests, parses = self._harvest("small", 2, 1)
+        small, small_parse = ingests[-1], parses[-1]
+        statements, ingests, parses = self._harvest("large", 2, 51)
+        assert_within_budget(self, ingests[-1],
+                             len(small) + 50 * PER_DATAFILE,
+                             "ingest of 51 datafiles")
+        assert_within_budget(self, parses[-1],
+                             len(small_parse) + 50 * PARSER_PER_DATAFILE
+                             + MARGIN, "parse of 51 datafiles")
+
+    def test_local_experiments(self):
+        few = self._harvest("few", 2, 1)[1][-1]
+        self._add_local_experiments(100)
+        many = self._harvest("many", 2, 1)[1][-1]
+        assert_within_budget(self, many, len(few) + 100 * PER_LOCAL_EXPERIMENT,
+                             "ingest among 100 more local experiments")
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012, RMIT eResearch Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2012, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+from datetime import datetime, timedelta
+from flexmock import flexmock
+from django.test import TestCase
+from tardis.apps.reposconsumer import tasks
+from tardis.apps.reposconsumer.locks import HarvestLock
+from tardis.apps.reposconsumer.models import SourceSchedule
+from tardis.apps.reposconsumer.schedule import next_interval, \
+    due_schedules, harvest_done, clear_queued
+from tardis.apps.reposconsumer.fetch import get_concurrency
+
+FAST = "http://127.0.0.1:9000"
+SLOW = "http://127.0.0.1:9001"
+
+SOURCES = {FAST: {"min_interval": 10, "max_interval": 100},
+           SLOW: {"min_interval": 60, "concurrency": 2}}
+
+
+class ScheduleTest(TestCase):
+
+    def setUp(self):
+        for source in SOURCES:
+            clear_queued(source)
+
+    def test_next_interval(self):
+        # halves while records change, within the bounds
+        self.assertEquals(next_interval(40, 5, 1, 10, 100), 20)
+        self.assertEquals(next_interval(15, 5, 1, 10, 100), 10)
+        # grows while they do not
+        self.assertEquals(next_interval(40, 0, 1, 10, 100), 60)
+        self.assertEquals(next_interval(90, 0, 1, 10, 100), 100)
+        # but never less than twice a harvest takes
+        self.assertEquals(next_interval(40, 5, 30, 10, 100), 60)
+        self.assertEquals(next_interval(90, 0, 300, 10, 100), 600)
+
+    def test_due_schedules(self):
+        now = datetime(2012, 11, 28)
+        with self.settings(REPOS_CONSUMER_SOURCES=SOURCES):
+            due = due_schedules(now)
+            self.assertEquals(sorted(s.source for s in due), sorted(SOURCES))
+            self.assertEquals(SourceSchedule.objects.get(source=FAST).interval,
+                              10)
+
+            harvest_done(FAST, 0, 2, now=now)
+            harvest_done(SLOW, 3, 50, now=now)
+            self.assertEquals(due_schedules(now), [])
+            fast = SourceSchedule.objects.get(source=FAST)
+            self.assertEquals(fast.interval, 15)
+            self.assertEquals(fast.last_records, 0)
+            self.assertEquals(SourceSchedule.objects.get(source=SLOW)
+                              .interval, 100)
+            self.assertEquals([s.source for s in
+                               due_schedules(now + timedelta(seconds=20))],
+                              [FAST])
+            self.assertEquals(get_concurrency(SLOW), 2)
+
+    def test_schedule_harvests(self):
+        with self.settings(REPOS_CONSUMER_SOURCES=[FAST]):
+            flexmock(tasks.harvest_source).should_receive('delay') \
+                .with_args(FAST).once()
+            tasks.schedule_harvests()
+            # not queued again while due
+            SourceSchedule.objects.filter(source=FAST).update(next_run=None)
+            tasks.schedule_harvests()
+
+    def test_no_overlap(self):
+        lock = HarvestLock(FAST)
+        self.assertTrue(lock.acquire())
+        try:
+            flexmock(tasks.harvest_source).should_receive('delay').never()
+            flexmock(tasks).should_receive('transfer_experiment').never()
+            with self.settings(REPOS_CONSUMER_SOURCES=[FAST]):
+                tasks.schedule_harvests()
+                self.assertEquals(tasks.harvest_source(FAST), None)
+        finally:
+            lock.release()
+
+    def test_harvest_source(self):
+        def transfer(source, summary, lock):
+            # the run holds the harvest lock of its source
+            self.assertTrue(isinstance(lock, HarvestLock))
+            self.assertEquals(lock.source, FAST)
+            self.assertTrue(lock.holds())
+            summary['records'] = 4
+            return [1, 2]
+        flexmock(tasks).should_receive('transfer_experiment') \
+            .replace_with(transfer).once()
+        with self.settings(REPOS_CONSUMER_SOURCES=[FAST]):
+            due_schedules()
+            self.assertEquals(tasks.harvest_source(FAST), [1, 2])
+        schedule = SourceSchedule.objects.get(source=FAST)
+        self.assertEquals(schedule.last_records, 4)
+        self.assertTrue(schedule.next_run > datetime.now())
+        self.assertFalse(HarvestLock(FAST).is_locked())
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012, RMIT eResearch Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2012, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+from datetime import datetime
+from django.test import TestCase
+from tardis.apps.reposconsumer.models import SkippedExperiment
+from tardis.apps.reposconsumer.skips import SkipList, recheck_interval
+
+
+class SkipListTest(TestCase):
+
+    source = "http://127.0.0.1:9000"
+
+    def test_recheck_interval(self):
+        with self.settings(REPOS_CONSUMER_RECHECK_MIN=60,
+                           REPOS_CONSUMER_RECHECK_MAX=300):
+            self.assertEquals([recheck_interval(n) for n in range(1, 6)],
+                              [60, 120, 240, 300, 300])
+
+    def test_skip(self):
+        now = datetime(2012, 11, 28)
+        stamp = datetime(2012, 11, 27)
+        skips = SkipList(self.source)
+        self.assertFalse(skips.skips("1", stamp, now))
+        skips.skip("1", "2", stamp, 'private', now)
+        skipped = SkippedExperiment.objects.get(source=self.source,
+                                                exp_id="1")
+        self.assertEquals(skipped.reason, 'private')
+        self.assertEquals(skipped.checks, 1)
+
+        # persisted, so later runs skip it too
+        skips = SkipList(self.source)
+        self.assertEquals(len(skips), 1)
+        self.assertTrue(skips.skips("1", stamp, now))
+        self.assertEquals(list(skips.due(now)), [])
+        # until its record changes
+        self.assertFalse(skips.skips("1", datetime(2012, 11, 28), now))
+        # or it is due again
+        later = skipped.recheck_after
+        self.assertFalse(skips.skips("1", stamp, later))
+        self.assertEquals(list(skips.due(later)), [("1", "2", stamp)])
+
+        # skipped again, for twice as long
+        skips.skip("1", "2", stamp, 'private', later)
+        skipped = SkippedExperiment.objects.get(source=self.source,
+                                                exp_id="1")
+        self.assertEquals(skipped.checks, 2)
+        self.assertEquals(skipped.recheck_after - later,
+                          2 * (later - now))
+        self.assertEquals(list(skips.due(later)), [])
+
+        # a changed record backs off from the start
+        skips.skip("1", "2", datetime(2012, 11, 28), 'no key', later)
+        self.assertEquals(SkippedExperiment.objects.get(
+            source=self.source, exp_id="1").checks, 1)
+
+        skips.clear("1")
+        self.assertEquals(len(skips), 0)
+        self.assertEquals(SkipList(self.source).skips("1", stamp, now),
+                          False)
+
+    def test_other_sources(self):
+        SkipList("http://127.0.0.1:9001").skip("1", "2", None, 'private')
+        self.assertEquals(len(SkipList(self.source)), 0)
+        self.assertEquals(len(SkipList("http://127.0.0.1:9001", ["1"])), 1)
+        self.assertEquals(len(SkipList("http://127.0.0.1:9001", ["2"])), 0)
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012, RMIT eResearch Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2012, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from fakeproducer import FakeProducer
+from tardis.apps.reposconsumer.spool import MetsSpool
+from tardis.apps.reposconsumer.transport import HTTPSession
+
+
+class MetsSpoolTest(TestCase):
+
+    def setUp(self):
+        self.producer = FakeProducer(experiments=3)
+        self.source = self.producer.start()
+        self.session = HTTPSession(timeout=5)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.session.close()
+        self.producer.stop()
+        shutil.rmtree(self.directory)
+
+    def _url(self, exp_id):
+        return "%s/experiment/metsexport/%s/?force_http_urls" \
+            % (self.source, exp_id)
+
+    def _fetch(self, spool, exp_id):
+        return spool.fetch(self._url(exp_id), self.source, exp_id,
+                           self.session.download)
+
+    def _spooled(self, spool, exp_id):
+        return spool._paths(self.source, exp_id)[0]
+
+    def test_conditional_fetch(self):
+        spool = MetsSpool(self.directory)
+        path, meta = self._fetch(spool, 1)
+        self.assertEquals(open(path).read(), self.producer.mets)
+        self.assertEquals(meta['size'], len(self.producer.mets))
+        self.assertTrue(meta['etag'])
+
+        path2, meta2 = self._fetch(MetsSpool(self.directory), 1)
+        self.assertNotEquals(path2, path)
+        self.assertEquals(meta2, meta)
+        self.assertEquals(open(path2).read(), self.producer.mets)
+        self.assertEquals(self.producer.mets_requests, 2)
+        self.assertEquals(self.session.stats()['not_modified'], 1)
+
+    def test_evicted_after_not_modified(self):
+        spool = MetsSpool(self.directory)
+        self._fetch(spool, 1)
+        download = self.session.download
+
+        def evict_first(url, filename, headers):
+            result = download(url, filename, headers)
+            # as if evicted by another worker meanwhile
+            if result.not_modified:
+                os.remove(filename)
+            return result
+
+        path, meta = spool.fetch(self._url(1), self.source, 1, evict_first)
+        self.assertEquals(open(path).read(), self.producer.mets)
+        self.assertEquals(open(self._spooled(spool, 1)).read(),
+                          self.producer.mets)
+        self.assertEquals(self.producer.mets_requests, 3)
+
+    def test_eviction(self):
+        spool = MetsSpool(self.directory,
+                          max_bytes=2 * len(self.producer.mets))
+        for exp_id in (1, 2):
+            self._fetch(spool, exp_id)
+        os.utime(self._spooled(spool, 1), (1, 1))
+        self._fetch(spool, 3)
+        self.assertFalse(os.path.exists(self._spooled(spool, 1)))
+        self.assertTrue(os.path.exists(self._spooled(spool, 2)))
+        self.assertTrue(os.path.exists(self._spooled(spool, 3)))
+        self.assertEquals(len([name for name in os.listdir(self.directory)
+                               if not name.endswith('.pin')]), 4)
+
+    def test_pinned(self):
+        spool = MetsSpool(self.directory, max_bytes=len(self.producer.mets))
+        pinned, meta = self._fetch(spool, 1)
+        path1 = self._spooled(spool, 1)
+        self.assertEquals(os.stat(pinned).st_ino, os.stat(path1).st_ino)
+        os.utime(path1, (1, 1))
+        self._fetch(spool, 2)
+        self.assertFalse(os.path.exists(path1))
+        self.assertEquals(open(pinned).read(), self.producer.mets)
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012, RMIT eResearch Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2012, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import json
+import os
+import shutil
+import tempfile
+from hashlib import md5
+from unittest import TestCase
+from urllib2 import URLError, HTTPError
+from fakeproducer import FakeProducer
+from tardis.apps.reposconsumer.transport import HTTPSession
+
+
+class HTTPSessionTest(TestCase):
+
+    def setUp(self):
+        self.producer = FakeProducer(experiments=2)
+        self.source = self.producer.start()
+        self.session = HTTPSession(pool_size=2, timeout=5)
+
+    def tearDown(self):
+        self.session.close()
+        self.producer.stop()
+
+    def test_reuses_connections(self):
+        for i in range(5):
+            body = self.session.get("%s/apps/reposproducer/key/1/"
+                                    % self.source)
+            self.assertEquals(json.loads(body), "key-1")
+        stats = self.session.stats()
+        self.assertEquals(stats['requests'], 5)
+        self.assertEquals(stats['connections_opened'], 1)
+        self.assertEquals(stats['connections_reused'], 4)
+
+    def test_http_error(self):
+        try:
+            self.session.get("%s/apps/reposproducer/key/99/" % self.source)
+        except HTTPError as e:
+            self.assertEquals(e.code, 404)
+        else:
+            self.assertTrue(False, "Expected HTTPError")
+        # connection is still usable after an error response
+        self.session.get("%s/apps/reposproducer/key/1/" % self.source)
+        self.assertEquals(self.session.stats()['connections_opened'], 1)
+
+    def test_download(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'mets_upload.xml')
+            download = self.session.download(
+                "%s/experiment/metsexport/1/?force_http_urls" % self.source,
+                filename, chunk_size=100)
+            self.assertEquals(open(filename).read(), self.producer.mets)
+            self.assertEquals(download.size, len(self.producer.mets))
+            self.assertEquals(download.digest,
+                              md5(self.producer.mets).hexdigest())
+            self.assertFalse(download.not_modified)
+            self.assertEquals(os.listdir(tmpdir), ['mets_upload.xml'])
+
+            os.remove(filename)
+            try:
+                self.session.download("%s/experiment/metsexport/99/"
+                                      % self.source, filename)
+            except HTTPError:
+                pass
+            else:
+                self.assertTrue(False, "Expected HTTPError")
+            self.assertEquals(os.listdir(tmpdir), [])
+            self.assertEquals(self.session.stats()['connections_opened'], 1)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_compressed(self):
+        self.producer.compress = True
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'mets_upload.xml')
+            download = self.session.download(
+                "%s/experiment/metsexport/1/" % self.source, filename,
+                chunk_size=10)
+            self.assertEquals(open(filename).read(), self.producer.mets)
+            self.assertEquals(download.digest,
+                              md5(self.producer.mets).hexdigest())
+        finally:
+            shutil.rmtree(tmpdir)
+        body = self.session.get("%s/apps/reposproducer/key/1/" % self.source)
+        self.assertEquals(json.loads(body), "key-1")
+        stats = self.session.host_stats()[self.source[len("http://"):]]
+        self.assertEquals(stats['bytes_decoded'],
+                          len(self.producer.mets) + len(body))
+        self.assertTrue(stats['bytes_received'] < stats['bytes_decoded'])
+
+        # uncompressed when not asked for
+        session = HTTPSession(timeout=5, compress=False)
+        self.assertEquals(json.loads(session.get(
+            "%s/apps/reposproducer/key/1/" % self.source)), "key-1")
+        stats = session.host_stats()[self.source[len("http://"):]]
+        self.assertEquals(stats['bytes_received'], stats['bytes_decoded'])
+        session.close()
+
+    def test_url_error(self):
+        self.producer.stop()
+        try:
+            HTTPSession(timeout=5).get("%s/apps/reposproducer/key/1/"
+                                       % self.source)
+        except URLError:
+            pass
+        else:
+            self.assertTrue(False, "Expected URLError")
+        self.producer.start()
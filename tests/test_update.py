@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012, RMIT eResearch Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2012, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import os
+import shutil
+import tempfile
+from datetime import datetime
+from flexmock import flexmock
+from django.contrib.auth.models import User
+from django.test import TestCase
+from tardis.tardis_portal.models import Experiment, ExperimentACL, Dataset
+from tardis.tardis_portal.auth.localdb_auth import django_user
+from tardis.apps.reposconsumer import tasks
+from tardis.apps.reposconsumer.commits import CommitBatch
+from tardis.apps.reposconsumer.fingerprints import FingerprintIndex
+from tardis.apps.reposconsumer.metrics import MetricsSink, Run
+from tardis.apps.reposconsumer.update import read_mets, update_experiment
+
+METS = """<?xml version="1.0" encoding="UTF-8"?>
+<mets xmlns="http://www.loc.gov/METS/" xmlns:xlink="http://www.w3.org/1999/xlink" TYPE="study" OBJID="A-1">
+  <dmdSec ID="E-1">
+    <mdWrap MDTYPE="MODS">
+      <xmlData><mods:mods xmlns:mods="http://www.loc.gov/mods/v3"><mods:titleInfo><mods:title>%(title)s</mods:title></mods:titleInfo><mods:genre>experiment</mods:genre><mods:abstract>this is the description</mods:abstract><mods:name type="personal"><mods:namePart>Author1</mods:namePart></mods:name></mods:mods></xmlData>
+    </mdWrap>
+  </dmdSec>
+  <dmdSec ID="D-1">
+    <mdWrap MDTYPE="MODS">
+      <xmlData><mods:mods xmlns:mods="http://www.loc.gov/mods/v3"><mods:titleInfo><mods:title>ds1</mods:title></mods:titleInfo></mods:mods></xmlData>
+    </mdWrap>
+  </dmdSec>
+  <amdSec>
+    <techMD ID="A-1"><mdWrap OTHERMDTYPE="TARDISEXPERIMENT" MDTYPE="OTHER"/></techMD>
+    <techMD ID="A-2"><mdWrap OTHERMDTYPE="TARDISDATASET" MDTYPE="OTHER"/></techMD>
+  </amdSec>
+  <fileSec>
+    <fileGrp USE="original">
+%(files)s
+    </fileGrp>
+  </fileSec>
+  <structMap TYPE="logical">
+    <div ADMID="A-1" TYPE="investigation" DMDID="E-1">
+      <div ADMID="A-2" TYPE="dataset" DMDID="D-1">
+%(fptrs)s
+      </div>
+    </div>
+  </structMap>
+</mets>
+"""
+
+FILE = """      <file ID="F-%(i)d" MIMETYPE="text/plain" SIZE="10" CHECKSUM="%(md5)s" CHECKSUMTYPE="MD5" OWNERID="file%(i)d.txt">
+        <FLocat LOCTYPE="URL" xlink:href="http://127.0.0.1:9000/file%(i)d.txt"/>
+      </file>"""
+
+FPTR = """        <fptr FILEID="F-%(i)d"/>"""
+
+MD5 = "d41d8cd98f00b204e9800998ecf8427e"
+
+
+def write_mets(title, files):
+    """
+    Returns the name of a temporary METS file of one dataset holding the
+    (number, md5) files
+    """
+    f = tempfile.NamedTemporaryFile(suffix='.xml', delete=False)
+    f.write(METS % {
+        'title': title,
+        'files': "\n".join(FILE % {'i': i, 'md5': md5} for i, md5 in files),
+        'fptrs': "\n".join(FPTR % {'i': i} for i, md5 in files)})
+    f.close()
+    return f.name
+
+
+class UpdateExperimentTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='tom')
+        self.other = User.objects.create(username='joe')
+        self.filenames = []
+
+    def tearDown(self):
+        for filename in self.filenames:
+            os.remove(filename)
+
+    def _mets(self, title, files):
+        filename = write_mets(title, files)
+        self.filenames.append(filename)
+        return filename
+
+    def _ingest(self, filename):
+        exp = Experiment(title='Placeholder Title', created_by=self.user)
+        exp.save()
+        eid, sync_path = tasks._registerExperimentDocument(
+            filename=filename, created_by=self.user, expid=exp.id)
+        return Experiment.objects.get(id=eid)
+
+    def test_read_mets(self):
+        mets = read_mets(self._mets("test1", [(1, MD5), (2, MD5)]))
+        self.assertEquals(mets.title, "test1")
+        self.assertEquals(mets.description, "this is the description")
+        self.assertEquals(mets.authors, ["Author1"])
+        self.assertEquals(len(mets.datasets), 1)
+        self.assertEquals(mets.datasets[0].description, "ds1")
+        self.assertEquals([(df.filename, df.url, df.md5sum)
+                           for df in mets.datasets[0].datafiles],
+                          [("file1.txt", "http://127.0.0.1:9000/file1.txt",
+                            MD5),
+                           ("file2.txt", "http://127.0.0.1:9000/file2.txt",
+                            MD5)])
+
+    def test_update(self):
+        exp = self._ingest(self._mets("test1", [(1, MD5), (2, MD5),
+                                                 (3, MD5)]))
+        changed = "0" * 32
+        changes = update_experiment(exp,
+            self._mets("test2", [(1, changed), (3, MD5), (4, MD5)]),
+            owners=[self.other])
+        self.assertEquals(changes['experiment_changed'], 1)
+        self.assertEquals(changes['datafiles_changed'], 1)
+        self.assertEquals(changes['datafiles_added'], 1)
+        self.assertEquals(changes['datafiles_removed'], 1)
+        self.assertEquals(changes['datasets_added'], 0)
+        self.assertEquals(changes['acls_added'], 1)
+
+        exp = Experiment.objects.get(id=exp.id)
+        self.assertEquals(exp.title, "test2")
+        self.assertEquals(Dataset.objects.filter(experiments=exp).count(), 1)
+        datafiles = dict(exp.get_datafiles().values_list('filename',
+                                                         'md5sum'))
+        self.assertEquals(datafiles, {"file1.txt": changed,
+                                      "file3.txt": MD5,
+                                      "file4.txt": MD5})
+        self.assertTrue(exp.get_datafiles().get(filename="file4.txt")
+                        .stay_remote)
+        self.assertEquals(ExperimentACL.objects.filter(experiment=exp,
+            pluginId=django_user, entityId=str(self.other.id),
+            isOwner=True).count(), 1)
+
+    def test_unchanged(self):
+        exp = self._ingest(self._mets("test1", [(1, MD5), (2, MD5)]))
+        filename = self._mets("test2", [(1, MD5), (3, MD5)])
+        update_experiment(exp, filename, owners=[self.other])
+        datafiles = list(exp.get_datafiles().order_by('id')
+                         .values_list('id', flat=True))
+
+        changes = update_experiment(Experiment.objects.get(id=exp.id),
+                                    filename, owners=[self.other])
+        self.assertEquals(sum(changes.values()), 0)
+        self.assertEquals(list(exp.get_datafiles().order_by('id')
+                               .values_list('id', flat=True)), datafiles)
+
+    def test_update_task(self):
+        """
+        A changed remote experiment is only updated in place if asked to
+        """
+        exp = self._ingest(self._mets("test1", [(1, MD5)]))
+        fetch = flexmock(exp_id="1", datestamp=datetime(2012, 11, 28))
+        fingerprints = FingerprintIndex("http://127.0.0.1:9000")
+        fingerprints.record("1", exp.id, "key1", datetime(2012, 11, 27),
+                            "digest")
+        with self.settings(REPOS_CONSUMER_UPDATE=False):
+            self.assertFalse(tasks._needs_update(fetch, fingerprints))
+        with self.settings(REPOS_CONSUMER_UPDATE=True):
+            self.assertTrue(tasks._needs_update(fetch, fingerprints))
+            fetch.datestamp = datetime(2012, 11, 27)
+            self.assertFalse(tasks._needs_update(fetch, fingerprints))
+
+            # moved into the experiment, as a spooled METS would be
+            filename = write_mets("test2", [(1, MD5), (2, MD5)])
+            flexmock(tasks).should_receive('_get_mets') \
+                .replace_with(lambda source, exp_id:
+                    (filename, {'md5': "digest2"}))
+            with CommitBatch() as commits:
+                tasks._update_experiment("http://127.0.0.1:9000", fetch,
+                    "key1", exp.id, Experiment.PUBLIC_ACCESS_FULL, [],
+                    fingerprints, Run("http://127.0.0.1:9000", MetricsSink()),
+                    commits)
+        exp = Experiment.objects.get(id=exp.id)
+        self.assertEquals(exp.title, "test2")
+        self.assertEquals(exp.get_datafiles().count(), 2)
+        self.assertEquals(fingerprints.get("1").mets_digest, "digest2")
+
+    def test_failed_update_keeps_mets(self):
+        """
+        A failed update leaves the experiment's METS as it was
+        """
+        original = self._mets("test1", [(1, MD5)])
+        exp = self._ingest(original)
+        metsname = os.path.join(exp.get_or_create_directory(),
+                                'mets_upload.xml')
+        shutil.copyfile(original, metsname)
+        fetch = flexmock(exp_id="1", datestamp=datetime(2012, 11, 28))
+        fingerprints = FingerprintIndex("http://127.0.0.1:9000")
+        fingerprints.record("1", exp.id, "key1", datetime(2012, 11, 27),
+                            "digest")
+        bad = tempfile.NamedTemporaryFile(suffix='.xml', delete=False)
+        bad.write("<mets")
+        bad.close()
+        flexmock(tasks).should_receive('_get_mets') \
+            .replace_with(lambda source, exp_id:
+                (bad.name, {'md5': "digest2"}))
+        with CommitBatch() as commits:
+            self.assertRaises(tasks.MetsParseError, tasks._update_experiment,
+                "http://127.0.0.1:9000", fetch, "key1", exp.id,
+                Experiment.PUBLIC_ACCESS_FULL, [], fingerprints,
+                Run("http://127.0.0.1:9000", MetricsSink()), commits)
+        self.assertEquals(open(metsname).read(), open(original).read())
+        self.assertFalse(os.path.exists(bad.name))
+        self.assertEquals(fingerprints.get("1").mets_digest, "digest")
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012, RMIT eResearch Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2012, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+
+import json
+from datetime import datetime
+from django.core.cache import cache
+from django.test import TestCase
+from django.test.client import RequestFactory
+from tardis.apps.reposconsumer import views
+from tardis.apps.reposconsumer.locks import HarvestLock
+from tardis.apps.reposconsumer.models import HarvestRun, SourceSchedule
+
+
+class StatusTest(TestCase):
+
+    source = "http://127.0.0.1:9000"
+
+    def setUp(self):
+        cache.delete(views.STATUS_KEY)
+
+    def _status(self):
+        response = views.status(RequestFactory().get('/'))
+        self.assertEquals(response['Content-Type'], 'application/json')
+        return json.loads(response.content)['sources']
+
+    def test_status(self):
+        HarvestRun.objects.create(source=self.source,
+            started=datetime(2012, 11, 27), duration=4.0, records=10,
+            ingested=2, bytes_received=400, backlog=3,
+            high_water_mark=datetime(2012, 11, 26),
+            caches=json.dumps({'user_profiles': {'hits': 3, 'misses': 1},
+                               'source_identities': {'hits': 0, 'misses': 0}}))
+        SourceSchedule.objects.create(source=self.source, interval=60,
+                                      next_run=datetime(2012, 11, 28))
+        lock = HarvestLock(self.source)
+        self.assertTrue(lock.acquire())
+        try:
+            with self.settings(REPOS_CONSUMER_SOURCES=[self.source]):
+                status = self._status()[self.source]
+        finally:
+            lock.release()
+        self.assertEquals(status['last_run']['started'],
+                          "2012-11-27T00:00:00")
+        self.assertEquals(status['last_run']['duration'], 4.0)
+        self.assertEquals(status['last_run']['error'], None)
+        self.assertEquals(status['high_water_mark'], "2012-11-26T00:00:00")
+        self.assertEquals(status['backlog'], 3)
+        self.assertEquals(status['next_run'], "2012-11-28T00:00:00")
+        self.assertEquals(status['throughput']['records_per_second'], 2.5)
+        self.assertEquals(status['throughput']['bytes_per_second'], 100)
+        self.assertEquals(status['caches']['user_profiles']['hit_rate'],
+                          0.75)
+        self.assertEquals(status['caches']['source_identities']['hit_rate'], None)
+        self.assertEquals(status['lock_holder'], lock.holder)
+
+    def test_never_run(self):
+        with self.settings(REPOS_CONSUMER_SOURCES=[self.source]):
+            status = self._status()[self.source]
+        self.assertEquals(status['last_run'], None)
+        self.assertEquals(status['lock_holder'], None)
+
+    def test_cached(self):
+        with self.settings(REPOS_CONSUMER_SOURCES=[self.source]):
+            self.assertEquals(self._status()[self.source]['last_run'], None)
+            HarvestRun.objects.create(source=self.source,
+                started=datetime(2012, 11, 27), duration=1.0)
+            with self.assertNumQueries(0):
+                status = self._status()
+            self.assertEquals(status[self.source]['last_run'], None)
@@ -0,0 +1,399 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012, RMIT eResearch Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2012, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+"""
+Keep-alive HTTP client for requests to producers.
+
+.. moduleauthor::  Ian Thomas <ianedwardthomas@gmail.com>
+
+"""
+
+import hashlib
+import httplib
+import logging
+import os
+import socket
+import tempfile
+import threading
+import urlparse
+import zlib
+from urllib2 import URLError, HTTPError
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_POOL_SIZE = 8
+DEFAULT_TIMEOUT = 60
+MAX_REDIRECTS = 5
+CHUNK_SIZE = 64 * 1024
+
+
+class Download(object):
+    """
+    The outcome of :py:meth:`HTTPSession.download`.
+
+    :attribute not_modified: True if a conditional request found the
+        body unchanged, in which case nothing was downloaded
+    :attribute size: the number of bytes downloaded
+    :attribute digest: the md5 hexdigest of the body
+    :attribute etag: the ETag response header, or None
+    :attribute last_modified: the Last-Modified response header, or None
+    """
+
+    def __init__(self, response, size=0, digest=None):
+        self.not_modified = response is None
+        self.size = size
+        self.digest = digest
+        self.etag = None
+        self.last_modified = None
+        if response is not None:
+            self.etag = response.getheader('etag')
+            self.last_modified = response.getheader('last-modified')
+
+
+class _Body(object):
+    """
+    Reads the body of a response, decoding gzip or deflate content
+    encoding as it streams, and counting bytes received and decoded.
+    """
+
+    def __init__(self, response, counter):
+        self._response = response
+        self._count = counter
+        encoding = (response.getheader('content-encoding') or '').lower()
+        self._raw_deflate = False
+        if encoding == 'gzip':
+            self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            self._decoder = zlib.decompressobj()
+        else:
+            self._decoder = None
+        self._started = False
+
+    def _decode(self, data):
+        try:
+            return self._decoder.decompress(data)
+        except zlib.error:
+            if self._started or self._raw_deflate:
+                raise
+            # some servers send deflate without the zlib wrapper
+            self._raw_deflate = True
+            self._decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self._decoder.decompress(data)
+
+    def getheader(self, name, default=None):
+        return self._response.getheader(name, default)
+
+    def read(self, amt=None):
+        """
+        Returns up to about amt bytes of decoded body, or all of it, and an
+        empty string only once the body is exhausted
+        """
+        while True:
+            if amt is None:
+                data = self._response.read()
+            else:
+                data = self._response.read(amt)
+            if self._decoder is None:
+                self._count('bytes_received', len(data))
+                self._count('bytes_decoded', len(data))
+                return data
+            self._count('bytes_received', len(data))
+            if data:
+                decoded = self._decode(data)
+                self._started = True
+            else:
+                decoded = self._decoder.flush()
+            self._count('bytes_decoded', len(decoded))
+            if decoded or not data:
+                return decoded
+
+
+class HTTPSession(object):
+    """
+    HTTP client keeping persistent connections to each host it talks to.
+
+    :param pool_size: the number of idle connections kept per host
+    :param timeout: socket timeout in seconds
+    :param max_per_host: the maximum number of connections open at once
+        to any host, or None for no limit
+    :param host_limits: dict of host (netloc) -> max connections,
+        overriding max_per_host
+    :param compress: whether to ask for gzip or deflate encoded responses
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT,
+                 max_per_host=None, host_limits=None, compress=True):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.max_per_host = max_per_host
+        self.host_limits = host_limits or {}
+        self.compress = compress
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._slots = {}
+        self._host_stats = {}
+        self._stats = {'requests': 0,
+                       'connections_opened': 0,
+                       'connections_reused': 0,
+                       'retries': 0,
+                       'not_modified': 0}
+
+    def _count(self, counter, n=1):
+        with self._lock:
+            self._stats[counter] += n
+
+    def stats(self):
+        """
+        Returns a dict of the request and connection counters
+        """
+        with self._lock:
+            return dict(self._stats)
+
+    def _host_counter(self, host):
+        def count(counter, n):
+            with self._lock:
+                stats = self._host_stats.setdefault(host,
+                    {'bytes_received': 0, 'bytes_decoded': 0})
+                stats[counter] += n
+        return count
+
+    def host_stats(self):
+        """
+        Returns a dict of host -> counts of body bytes received over the
+        network and after decoding any content encoding
+        """
+        with self._lock:
+            return dict((host, dict(stats))
+                        for host, stats in self._host_stats.items())
+
+    def _host_slots(self, host):
+        with self._lock:
+            if host not in self._slots:
+                limit = self.host_limits.get(host, self.max_per_host)
+                if limit:
+                    self._slots[host] = threading.BoundedSemaphore(limit)
+                else:
+                    self._slots[host] = None
+            return self._slots[host]
+
+    def _get_connection(self, scheme, host):
+        """
+        Returns (connection, reused), taking an idle connection if there
+        is one.
+        """
+        with self._lock:
+            idle = self._idle.get((scheme, host))
+            if idle:
+                self._stats['connections_reused'] += 1
+                return idle.pop(), True
+            self._stats['connections_opened'] += 1
+        if scheme == 'https':
+            conn = httplib.HTTPSConnection(host, timeout=self.timeout)
+        else:
+            conn = httplib.HTTPConnection(host, timeout=self.timeout)
+        return conn, False
+
+    def _release_connection(self, scheme, host, conn):
+        with self._lock:
+            idle = self._idle.setdefault((scheme, host), [])
+            if len(idle) < self.pool_size:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def _request(self, url, headers, consume):
+        """
+        Performs a single GET of url on a pooled connection, returning
+        (response, body).  The body of a successful response is
+        consume() of its decoding :py:class:`_Body`, of any other the raw
+        body.
+        """
+        parts = urlparse.urlsplit(url)
+        selector = parts.path or '/'
+        if parts.query:
+            selector += '?' + parts.query
+        while True:
+            conn, reused = self._get_connection(parts.scheme, parts.netloc)
+            try:
+                conn.request('GET', selector, headers=headers)
+                response = conn.getresponse()
+            except (httplib.HTTPException, socket.error) as e:
+                conn.close()
+                if reused:
+                    # the server may have dropped an idle connection
+                    self._count('retries')
+                    continue
+                raise URLError(e)
+            try:
+                if 200 <= response.status < 300:
+                    body = consume(_Body(response,
+                                         self._host_counter(parts.netloc)))
+                else:
+                    body = response.read()
+            except (httplib.HTTPException, socket.error) as e:
+                conn.close()
+                raise URLError(e)
+            except:
+                conn.close()
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                self._release_connection(parts.scheme, parts.netloc, conn)
+            return response, body
+
+    def _open(self, url, headers, consume):
+        """
+        Requests url, following redirects, and returns the final
+        (response, body), where body is consume() of the decoded body if
+        successful.
+
+        Raises HTTPError for error responses and URLError if the host
+        could not be reached, as urllib2.urlopen does.
+        """
+        headers = dict(headers or {})
+        if self.compress:
+            headers.setdefault('Accept-Encoding', 'gzip, deflate')
+        for i in range(MAX_REDIRECTS + 1):
+            self._count('requests')
+            host = urlparse.urlsplit(url).netloc
+            slots = self._host_slots(host)
+            if slots:
+                slots.acquire()
+            try:
+                response, body = self._request(url, headers, consume)
+            finally:
+                if slots:
+                    slots.release()
+            if response.status in (301, 302, 303, 307) \
+                    and response.getheader('location'):
+                url = urlparse.urljoin(url, response.getheader('location'))
+                continue
+            if response.status >= 400:
+                raise HTTPError(url, response.status, response.reason,
+                                response.msg, None)
+            return response, body
+        raise HTTPError(url, response.status, "too many redirects",
+                        response.msg, None)
+
+    def get(self, url, headers=None):
+        """
+        Returns the body of url, following redirects.
+        """
+        response, body = self._open(url, headers, lambda body: body.read())
+        return body
+
+    def download(self, url, filename, headers=None, chunk_size=CHUNK_SIZE):
+        """
+        Streams the body of url to filename without holding it in memory,
+        returning a :py:class:`Download`.
+
+        The body is written to a temporary file in the same directory,
+        which is renamed to filename only once complete.  For conditional
+        requests, a 304 Not Modified response leaves filename untouched.
+        """
+        directory, name = os.path.split(filename)
+
+        def consume(body):
+            fd, partname = tempfile.mkstemp(dir=directory,
+                                            prefix='.%s.' % name,
+                                            suffix='.part')
+            digest = hashlib.md5()
+            size = 0
+            try:
+                f = os.fdopen(fd, 'wb')
+                try:
+                    while True:
+                        chunk = body.read(chunk_size)
+                        if not chunk:
+                            break
+                        f.write(chunk)
+                        digest.update(chunk)
+                        size += len(chunk)
+                finally:
+                    f.close()
+                os.rename(partname, filename)
+            except:
+                os.remove(partname)
+                raise
+            return Download(body, size, digest.hexdigest())
+
+        response, download = self._open(url, headers, consume)
+        if response.status == 304:
+            self._count('not_modified')
+            return Download(None)
+        if not isinstance(download, Download):
+            raise HTTPError(url, response.status, response.reason,
+                            response.msg, None)
+        return download
+
+    def close(self):
+        """
+        Closes all idle connections
+        """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    Returns the HTTPSession shared by this worker process, configured from
+    settings.REPOS_CONSUMER_HTTP_POOL_SIZE, REPOS_CONSUMER_HTTP_TIMEOUT,
+    REPOS_CONSUMER_HTTP_MAX_PER_HOST, REPOS_CONSUMER_HTTP_HOST_LIMITS and
+    REPOS_CONSUMER_HTTP_COMPRESS.
+    """
+    global _session, _session_pid
+    with _session_lock:
+        # connections must not be shared with a forked parent
+        if _session is None or _session_pid != os.getpid():
+            _session = HTTPSession(
+                pool_size=getattr(settings, 'REPOS_CONSUMER_HTTP_POOL_SIZE',
+                                  DEFAULT_POOL_SIZE),
+                timeout=getattr(settings, 'REPOS_CONSUMER_HTTP_TIMEOUT',
+                                DEFAULT_TIMEOUT),
+                max_per_host=getattr(settings,
+                                     'REPOS_CONSUMER_HTTP_MAX_PER_HOST', None),
+                host_limits=getattr(settings,
+                                    'REPOS_CONSUMER_HTTP_HOST_LIMITS', None),
+                compress=getattr(settings, 'REPOS_CONSUMER_HTTP_COMPRESS',
+                                 True))
+            _session_pid = os.getpid()
+        return _session
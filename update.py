@@ -0,0 +1,498 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2012, RMIT eResearch Office
+#   (RMIT University, Australia)
+# Copyright (c) 2010-2012, Monash e-Research Centre
+#   (Monash University, Australia)
+# Copyright (c) 2010-2011, VeRSI Consortium
+#   (Victorian eResearch Strategic Initiative, Australia)
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#    *  Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    *  Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#    *  Neither the name of the VeRSI, the VeRSI Consortium members, nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+"""
+In-place update of an ingested experiment from a newer METS document.
+
+Only what differs between the document and the local experiment is
+written, so an update touching a few datafiles of a large experiment
+costs little more than reading the document and the local datafiles.
+
+.. moduleauthor::  Ian Thomas <ianedwardthomas@gmail.com>
+
+"""
+
+import logging
+from datetime import datetime
+from lxml import etree
+from tardis.tardis_portal.models import Author_Experiment, Dataset, \
+    Dataset_File, Schema, ParameterName, \
+    ExperimentParameterSet, ExperimentParameter, DatasetParameterSet, \
+    DatasetParameter, DatafileParameterSet, DatafileParameter
+from tardis.apps.reposconsumer.acls import add_owner_acls
+
+logger = logging.getLogger(__name__)
+
+METS_NS = 'http://www.loc.gov/METS/'
+MODS_NS = 'http://www.loc.gov/mods/v3'
+XLINK_NS = 'http://www.w3.org/1999/xlink'
+
+# rows per DELETE ... WHERE id IN (...)
+DELETE_CHUNK = 500
+
+
+def _mets(tag):
+    return '{%s}%s' % (METS_NS, tag)
+
+
+def _mods(tag):
+    return '{%s}%s' % (MODS_NS, tag)
+
+
+class MetsDatafile(object):
+    """
+    A datafile as described by a METS file element
+    """
+    __slots__ = ('filename', 'url', 'size', 'md5sum', 'mimetype', 'admid',
+                 'parameter_sets')
+
+    def __init__(self, element):
+        self.filename = element.get('OWNERID') or ''
+        self.size = element.get('SIZE') or ''
+        self.md5sum = element.get('CHECKSUM') or ''
+        self.mimetype = element.get('MIMETYPE') or ''
+        self.admid = element.get('ADMID')
+        self.parameter_sets = []
+        self.url = ''
+        flocat = element.find(_mets('FLocat'))
+        if flocat is not None:
+            self.url = flocat.get('{%s}href' % XLINK_NS) or ''
+
+    def fields(self):
+        """
+        Returns the Dataset_File fields described
+        """
+        return {'url': self.url, 'size': self.size,
+                'md5sum': self.md5sum, 'mimetype': self.mimetype}
+
+
+class MetsDataset(object):
+    """
+    A dataset as described by a METS structMap div, with its datafiles
+    in document order
+    """
+
+    def __init__(self, description, parameter_sets):
+        self.description = description
+        self.parameter_sets = parameter_sets
+        self.datafiles = []
+
+
+class MetsExperiment(object):
+    """
+    The experiment described by a METS document, in the form ingested by
+    :py:func:`tardis.tardis_portal.metsparser.parseMets`.
+
+    Parameter sets are given as sorted lists of (schema namespace,
+    sorted list of (parameter name, value)).
+    """
+
+    def __init__(self):
+        self.title = ''
+        self.description = ''
+        self.authors = []
+        self.parameter_sets = []
+        self.datasets = []
+
+
+def _parameter_sets(md_wrap):
+    """
+    Returns the parameter sets held by a techMD mdWrap, as the children
+    of its xmlData named in the namespace of their schema
+    """
+    parameter_sets = []
+    xml_data = md_wrap.find(_mets('xmlData')) if md_wrap is not None \
+        else None
+    if xml_data is None:
+        return parameter_sets
+    for element in xml_data:
+        if not isinstance(element.tag, basestring):
+            continue
+        params = sorted((etree.QName(p).localname, (p.text or '').strip())
+                        for p in element if isinstance(p.tag, basestring))
+        parameter_sets.append((etree.QName(element).namespace, params))
+    return sorted(parameter_sets)
+
+
+def read_mets(filename):
+    """
+    Returns the :py:class:`MetsExperiment` described by the METS document
+    filename, reading it incrementally
+    """
+    mods = {}
+    tech_md = {}
+    files = {}
+    investigation = None
+    exp = MetsExperiment()
+    for event, element in etree.iterparse(filename, events=('end',)):
+        tag = element.tag
+        if tag == _mets('dmdSec'):
+            mods[element.get('ID')] = element
+            continue
+        elif tag == _mets('techMD'):
+            tech_md[element.get('ID')] = \
+                _parameter_sets(element.find(_mets('mdWrap')))
+        elif tag == _mets('file'):
+            files[element.get('ID')] = MetsDatafile(element)
+        elif tag == _mets('structMap'):
+            investigation = element.find(_mets('div'))
+            break
+        else:
+            continue
+        element.clear()
+
+    if investigation is None:
+        return exp
+    exp_mods = mods.get(investigation.get('DMDID'))
+    if exp_mods is not None:
+        exp.title = exp_mods.findtext('.//%s/%s'
+            % (_mods('titleInfo'), _mods('title'))) or ''
+        exp.description = exp_mods.findtext('.//%s' % _mods('abstract')) \
+            or ''
+        exp.authors = [name.findtext(_mods('namePart')) or ''
+                       for name in exp_mods.findall('.//%s/%s'
+                           % (_mods('mods'), _mods('name')))]
+    exp.parameter_sets = tech_md.get(investigation.get('ADMID'), [])
+    for div in investigation.findall(_mets('div')):
+        ds_mods = mods.get(div.get('DMDID'))
+        description = ''
+        if ds_mods is not None:
+            description = ds_mods.findtext('.//%s/%s'
+                % (_mods('titleInfo'), _mods('title'))) or ''
+        dataset = MetsDataset(description,
+                              tech_md.get(div.get('ADMID'), []))
+        for fptr in div.iter(_mets('fptr')):
+            datafile = files.get(fptr.get('FILEID'))
+            if datafile is not None:
+                datafile.parameter_sets = tech_md.get(datafile.admid, [])
+                dataset.datafiles.append(datafile)
+        exp.datasets.append(dataset)
+    return exp
+
+
+def _parse_datetime(value):
+    for format in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S',
+                   '%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, format)
+        except ValueError:
+            pass
+    return None
+
+
+class _ParameterWriter(object):
+    """
+    Diffs and writes the parameter sets of one kind of object
+    (experiment, dataset or datafile), resolving schemas and parameter
+    names once per update.
+
+    Only parameter sets of the schemas used by the document are compared
+    and replaced, so that those added locally (such as the experiment key)
+    are kept.
+    """
+
+    def __init__(self, names, set_model, param_model, owner_field):
+        self.names = names
+        self.set_model = set_model
+        self.param_model = param_model
+        self.owner_field = owner_field
+
+    def local(self, **owner_filter):
+        """
+        Returns the local parameter sets of the objects matching
+        owner_filter, as a dict of owner id -> parameter sets in the form
+        of :py:class:`MetsExperiment`
+        """
+        filters = dict(('parameterset__%s' % k, v)
+                       for k, v in owner_filter.items())
+        rows = self.param_model.objects.filter(**filters).values_list(
+            'parameterset__%s' % self.owner_field, 'parameterset',
+            'parameterset__schema__namespace', 'name__name',
+            'name__data_type', 'string_value', 'numerical_value',
+            'datetime_value')
+        sets = {}
+        for owner, ps, namespace, name, data_type, string, number, when \
+                in rows:
+            if (namespace, None) not in self.names:
+                continue
+            if data_type == ParameterName.NUMERIC:
+                value = number
+            elif data_type == ParameterName.DATETIME:
+                value = when.isoformat() if when else ''
+            else:
+                value = string
+            sets.setdefault(owner, {}).setdefault((ps, namespace), []) \
+                .append((name, value))
+        # owners with sets but no parameters have no rows, and compare as
+        # having no parameter sets
+        return dict((owner, sorted((namespace, sorted(params))
+                                   for (ps, namespace), params
+                                   in by_set.items()))
+                    for owner, by_set in sets.items())
+
+    def normalise(self, parameter_sets):
+        """
+        Returns parameter_sets from a METS document with values typed as
+        local ones are read, leaving out unknown schemas and names
+        """
+        normalised = []
+        for namespace, params in parameter_sets:
+            typed = []
+            for name, value in params:
+                pn = self.names.get((namespace, name))
+                if pn is None:
+                    continue
+                if pn.data_type == ParameterName.NUMERIC:
+                    try:
+                        value = float(value)
+                    except ValueError:
+                        continue
+                elif pn.data_type == ParameterName.DATETIME:
+                    when = _parse_datetime(value)
+                    if when is None:
+                        continue
+                    value = when.isoformat()
+                typed.append((name, value))
+            if (namespace, None) in self.names:
+                normalised.append((namespace, sorted(typed)))
+        return sorted(normalised)
+
+    def replace(self, owner, parameter_sets):
+        """
+        Replaces the parameter sets of owner with the normalised
+        parameter_sets
+        """
+        namespaces = [namespace for namespace, name in self.names
+                      if name is None]
+        self.set_model.objects.filter(schema__namespace__in=namespaces,
+                                      **{self.owner_field: owner}).delete()
+        params = []
+        for namespace, values in parameter_sets:
+            ps = self.set_model(schema=self.names[(namespace, None)],
+                                **{self.owner_field: owner})
+            ps.save()
+            for name, value in values:
+                pn = self.names[(namespace, name)]
+                param = self.param_model(parameterset=ps, name=pn)
+                if pn.data_type == ParameterName.NUMERIC:
+                    param.numerical_value = value
+                elif pn.data_type == ParameterName.DATETIME:
+                    param.datetime_value = _parse_datetime(value)
+                else:
+                    param.string_value = value
+                params.append(param)
+        self.param_model.objects.bulk_create(params)
+
+
+def _resolve_names(mets):
+    """
+    Returns a dict of (namespace, name) -> ParameterName, and of
+    (namespace, None) -> Schema, for the schemas used by mets
+    """
+    namespaces = set()
+    for namespace, params in mets.parameter_sets:
+        namespaces.add(namespace)
+    for dataset in mets.datasets:
+        for namespace, params in dataset.parameter_sets:
+            namespaces.add(namespace)
+        for datafile in dataset.datafiles:
+            for namespace, params in datafile.parameter_sets:
+                namespaces.add(namespace)
+    names = {}
+    for schema in Schema.objects.filter(namespace__in=namespaces):
+        names[(schema.namespace, None)] = schema
+    for pn in ParameterName.objects.filter(schema__namespace__in=namespaces) \
+            .select_related('schema'):
+        names[(pn.schema.namespace, pn.name)] = pn
+    return names
+
+
+def _delete(model, ids):
+    ids = list(ids)
+    for i in range(0, len(ids), DELETE_CHUNK):
+        model.objects.filter(pk__in=ids[i:i + DELETE_CHUNK]).delete()
+
+
+def _update_datafiles(dataset, mets_dataset, writer, changes):
+    """
+    Brings the datafiles of dataset, and their parameters, into line with
+    mets_dataset.  Datafiles are matched by filename.
+    """
+    local = {}
+    for row in Dataset_File.objects.filter(dataset=dataset).values_list(
+            'id', 'filename', 'url', 'size', 'md5sum', 'mimetype'):
+        local.setdefault(row[1], row)
+    local_params = writer.local(dataset_file__dataset=dataset)
+
+    created = []
+    seen = set()
+    for datafile in mets_dataset.datafiles:
+        if datafile.filename in seen:
+            continue
+        seen.add(datafile.filename)
+        fields = datafile.fields()
+        row = local.pop(datafile.filename, None)
+        if row is None:
+            created.append(datafile)
+            continue
+        if row[2:] != (fields['url'], fields['size'], fields['md5sum'],
+                       fields['mimetype']):
+            Dataset_File.objects.filter(pk=row[0]).update(**fields)
+            changes['datafiles_changed'] += 1
+        if datafile.parameter_sets or row[0] in local_params:
+            sets = writer.normalise(datafile.parameter_sets)
+            if sets != local_params.get(row[0], []):
+                writer.replace(Dataset_File(pk=row[0]), sets)
+                changes['parameter_sets_changed'] += 1
+
+    plain = []
+    for datafile in created:
+        df = Dataset_File(dataset=dataset, filename=datafile.filename,
+            protocol=datafile.url.partition('://')[0]
+                if '://' in datafile.url else '',
+            stay_remote=True, **datafile.fields())
+        sets = writer.normalise(datafile.parameter_sets)
+        if sets:
+            # needs its id for the parameter sets
+            df.save()
+            writer.replace(df, sets)
+        else:
+            plain.append(df)
+    # NOTE: bulk inserts, so Dataset_File save signals are not sent
+    Dataset_File.objects.bulk_create(plain)
+    changes['datafiles_added'] += len(created)
+
+    _delete(Dataset_File, [row[0] for row in local.values()])
+    changes['datafiles_removed'] += len(local)
+
+
+def _update_datasets(exp, mets, writers, changes):
+    """
+    Brings the datasets of exp into line with mets.  Datasets are matched
+    by description, in order.
+    """
+    local = {}
+    for dataset in Dataset.objects.filter(experiments=exp).order_by('id'):
+        local.setdefault(dataset.description, []).append(dataset)
+    local_params = writers['dataset'].local(dataset__experiments=exp)
+
+    for mets_dataset in mets.datasets:
+        matches = local.get(mets_dataset.description)
+        if matches:
+            dataset = matches.pop(0)
+        else:
+            dataset = Dataset(description=mets_dataset.description)
+            dataset.save()
+            dataset.experiments.add(exp)
+            changes['datasets_added'] += 1
+        sets = writers['dataset'].normalise(mets_dataset.parameter_sets)
+        if sets != local_params.get(dataset.id, []):
+            writers['dataset'].replace(dataset, sets)
+            changes['parameter_sets_changed'] += 1
+        _update_datafiles(dataset, mets_dataset, writers['datafile'],
+                          changes)
+
+    for datasets in local.values():
+        for dataset in datasets:
+            if dataset.experiments.count() > 1:
+                # still part of other experiments
+                dataset.experiments.remove(exp)
+            else:
+                dataset.delete()
+            changes['datasets_removed'] += 1
+
+
+def update_experiment(exp, filename, public_access=None, owners=(),
+                      audit_message=''):
+    """
+    Updates the local experiment exp in place from the METS document
+    filename, writing only what has changed.  Returns a dict of counts of
+    the changes made.
+
+    This writes in the caller's transaction, which should be rolled back
+    if it fails (see
+    :py:class:`~tardis.apps.reposconsumer.commits.CommitBatch`).
+
+    :param exp: the local experiment
+    :type exp: :py:class:`tardis.tardis_portal.models.Experiment`
+    :param filename: path of the METS document
+    :param public_access: the public access state at the source
+    :param owners: the local owners at the source, whose missing owner
+        ACLs are added
+    :type owners: list of :py:class:`django.contrib.auth.models.User`
+    :param audit_message: appended to the description, as when ingested
+    """
+    mets = read_mets(filename)
+    names = _resolve_names(mets)
+    writers = {
+        'experiment': _ParameterWriter(names, ExperimentParameterSet,
+                                       ExperimentParameter, 'experiment'),
+        'dataset': _ParameterWriter(names, DatasetParameterSet,
+                                    DatasetParameter, 'dataset'),
+        'datafile': _ParameterWriter(names, DatafileParameterSet,
+                                     DatafileParameter, 'dataset_file'),
+    }
+    changes = dict.fromkeys(['experiment_changed', 'authors_changed',
+        'parameter_sets_changed', 'datasets_added', 'datasets_removed',
+        'datafiles_added', 'datafiles_changed', 'datafiles_removed',
+        'acls_added'], 0)
+
+    description = mets.description + audit_message
+    if (exp.title, exp.description) != (mets.title, description) or \
+            (public_access is not None and
+             exp.public_access != public_access):
+        exp.title = mets.title
+        exp.description = description
+        if public_access is not None:
+            exp.public_access = public_access
+        exp.save()
+        changes['experiment_changed'] = 1
+
+    authors = list(Author_Experiment.objects.filter(experiment=exp)
+                   .order_by('order').values_list('author', flat=True))
+    if authors != mets.authors:
+        Author_Experiment.objects.filter(experiment=exp).delete()
+        Author_Experiment.objects.bulk_create([
+            Author_Experiment(experiment=exp, order=order, author=author)
+            for order, author in enumerate(mets.authors)])
+        changes['authors_changed'] = 1
+
+    sets = writers['experiment'].normalise(mets.parameter_sets)
+    if sets != writers['experiment'].local(experiment=exp).get(exp.id, []):
+        writers['experiment'].replace(exp, sets)
+        changes['parameter_sets_changed'] += 1
+
+    _update_datasets(exp, mets, writers, changes)
+
+    changes['acls_added'] = add_owner_acls(exp.id,
+                                           [user.id for user in owners])
+    return changes
@@ -1,5 +1,5 @@
 from django.conf.urls.defaults import patterns, url
 
 urlpatterns = patterns('',
-    url(r'^$', 'tardis.apps.reposconsumer.views.hello', name="hello"),
-)
\ No newline at end of file
+    url(r'^$', 'tardis.apps.reposconsumer.views.status', name="status"),
+)
@@ -1,10 +1,112 @@
+import json
+from django.conf import settings
+from django.core.cache import cache
 from django.http import HttpResponse
-from django.template import Context, loader
+from tardis.apps.reposconsumer.locks import HarvestLock
+from tardis.apps.reposconsumer.models import HarvestRun, HarvestState, \
+    SourceSchedule
+from tardis.apps.reposconsumer.schedule import get_sources
 
+STATUS_KEY = "reposconsumer-status"
 
-def hello(request):
-    template = loader.get_template('hello.html')
-    context = Context({
-        'text': "hello world",
+DEFAULT_STATUS_TTL = 10
+
+
+def _isoformat(value):
+    if value is None:
+        return None
+    return value.isoformat()
+
+
+def _per_second(count, duration):
+    if not duration:
+        return None
+    return count / duration
+
+
+def _hit_rates(caches):
+    rates = {}
+    for name, stats in caches.items():
+        lookups = stats['hits'] + stats['misses']
+        rates[name] = dict(stats,
+            hit_rate=float(stats['hits']) / lookups if lookups else None)
+    return rates
+
+
+def _source_status(source, run, schedule):
+    """
+    Returns the status of source from its last run and schedule, either
+    of which may be None
+    """
+    status = {
+        'lock_holder': HarvestLock(source).held_by(),
+        'next_run': _isoformat(schedule and schedule.next_run),
+        'last_run': None,
+    }
+    if run is None:
+        return status
+    status.update({
+        'last_run': {
+            'started': _isoformat(run.started),
+            'duration': run.duration,
+            'records': run.records,
+            'ingested': run.ingested,
+            'updated': run.updated,
+            'unchanged': run.unchanged,
+            'duplicates': run.duplicates,
+            'skipped': run.skipped,
+            'failed': run.failed,
+            'bytes_received': run.bytes_received,
+            'bytes_decoded': run.bytes_decoded,
+            'locks_acquired': run.locks_acquired,
+            'locks_contended': run.locks_contended,
+            'locks_lost': run.locks_lost,
+            'queries': run.queries,
+            'error': run.error or None,
+        },
+        'high_water_mark': _isoformat(run.high_water_mark),
+        'backlog': run.backlog,
+        'throughput': {
+            'records_per_second': _per_second(run.records, run.duration),
+            'ingested_per_second': _per_second(run.ingested, run.duration),
+            'bytes_per_second': _per_second(run.bytes_received,
+                                            run.duration),
+        },
+        'caches': _hit_rates(json.loads(run.caches or '{}')),
     })
-    return HttpResponse(template.render(context))
+    return status
+
+
+def harvest_status():
+    """
+    Returns a dict of source -> status of the configured sources, or of
+    every source harvested if none are configured.
+
+    The status is read from the summary of the last run of each source,
+    so the experiment tables are never queried.
+    """
+    sources = list(get_sources())
+    if not sources:
+        sources = HarvestState.objects.values_list('source', flat=True)
+    schedules = dict((schedule.source, schedule) for schedule
+                     in SourceSchedule.objects.filter(source__in=sources))
+    status = {}
+    for source in sources:
+        runs = list(HarvestRun.objects.filter(source=source)[:1])
+        status[source] = _source_status(source, runs[0] if runs else None,
+                                        schedules.get(source))
+    return status
+
+
+def status(request):
+    """
+    Serves the harvest status of each source as JSON, cached for
+    settings.REPOS_CONSUMER_STATUS_TTL seconds so frequent monitoring
+    requests cost nothing
+    """
+    body = cache.get(STATUS_KEY)
+    if body is None:
+        body = json.dumps({'sources': harvest_status()}, sort_keys=True)
+        cache.set(STATUS_KEY, body, getattr(settings,
+            'REPOS_CONSUMER_STATUS_TTL', DEFAULT_STATUS_TTL))
+    return HttpResponse(body, mimetype='application/json')